@@ -1,15 +1,28 @@
 from __future__ import absolute_import, division, print_function
 
+import sys
+
 from .backends import *
 from .buckets import *
+from .compression import *
 from .config import *
 from .exceptions import *
 from .keymakers import *
 from .log import logger, logger_config
+from .memory import *
+from .packbuckets import *
+from .sqlitebuckets import *
+from .tieredbuckets import *
 from .utilities import *
 
-__all__ = (backends.__all__ + buckets.__all__ + config.__all__ +
-           exceptions.__all__ + keymakers.__all__ + utilities.__all__)
+__all__ = (backends.__all__ + buckets.__all__ + compression.__all__ +
+           config.__all__ + exceptions.__all__ + keymakers.__all__ +
+           memory.__all__ + packbuckets.__all__ + sqlitebuckets.__all__ +
+           tieredbuckets.__all__ + utilities.__all__)
+
+if sys.version_info >= (3, 5):
+    from .asyncbuckets import *
+    __all__ += asyncbuckets.__all__
 
 __author__ = 'Frazer McLean <frazer@frazermclean.co.uk>'
 __version__ = '0.12.1'
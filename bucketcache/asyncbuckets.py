@@ -0,0 +1,265 @@
+"""asyncio support, which requires Python 3.5+."""
+from __future__ import absolute_import, division, print_function
+
+import asyncio
+import weakref
+from functools import partial
+
+from .buckets import Bucket
+from .exceptions import KeyInvalidError, KeyStaleError
+from .log import logger
+from .utilities import to_timedelta
+
+__all__ = ('AsyncBucket',)
+
+
+class AsyncBucket(Bucket):
+    """Bucket with awaitable methods, for use with :py:mod:`asyncio`.
+
+    File I/O and (de)serialization are done in `executor`, so the event loop
+    isn't blocked while keys are loaded or saved.
+
+    Parameters:
+        executor: :py:class:`concurrent.futures.Executor` used for file I/O.
+                  Default: the event loop's default executor.
+
+    Other parameters are the same as :py:class:`~bucketcache.Bucket`. The
+    bucket is always thread safe, because work for different keys is done
+    in different threads.
+
+    The synchronous interface still works, but blocks the event loop.
+    """
+    def __init__(self, path, executor=None, **kwargs):
+        kwargs['thread_safe'] = True
+        super(AsyncBucket, self).__init__(path, **kwargs)
+        self.executor = executor
+
+    async def get(self, key):
+        """Return value for `key`.
+
+        Raises:
+            KeyError: if the key is missing or has expired.
+        """
+        key_hash = self._hash_for_key(key)
+        try:
+            obj = await _run_io(self, self._get_obj_from_hash, key_hash)
+        except KeyInvalidError:
+            raise KeyError(self._abbreviate(key))
+        return obj.value
+
+    async def set(self, key, value):
+        """Set `key` to `value`."""
+        key_hash = self._hash_for_key(key)
+        await _run_io(self, self._set_value_with_hash, key_hash, value)
+
+    async def delete(self, key):
+        """Delete `key`.
+
+        Raises:
+            KeyError: if the key is missing or has expired.
+        """
+        await _run_io(self, self.__delitem__, key)
+
+    async def contains(self, key):
+        """Return `True` if `key` is in the bucket."""
+        return await _run_io(self, self.__contains__, key)
+
+    async def get_or_set(self, key, function, stale_while_revalidate=None):
+        """Return value for `key`, awaiting coroutine function `function` to
+        set it if the key is missing or has expired.
+
+        See :py:meth:`Bucket.get_or_set <bucketcache.Bucket.get_or_set>`. The
+        stale value is replaced by a task on the running event loop.
+        """
+        key_hash = self._hash_for_key(key)
+        grace = to_timedelta(stale_while_revalidate)
+        flight = _flight_for(self)
+
+        async def call_and_cache():
+            value = await function()
+            await _run_io(self, self._set_value_with_hash, key_hash, value)
+            return value
+
+        async def load_or_call_once():
+            try:
+                obj = await _run_io(self, self._get_obj_from_hash, key_hash)
+            except KeyInvalidError:
+                return await call_and_cache(), True
+            return obj.value, False
+
+        try:
+            obj = await _run_io(self, self._get_obj_from_hash, key_hash,
+                                stale_grace=grace)
+        except KeyStaleError as e:
+            flight.revalidate(key_hash, call_and_cache)
+            return e.obj.value
+        except KeyInvalidError:
+            (value, _), _ = await flight.do(key_hash, load_or_call_once)
+            return value
+        return obj.value
+
+
+class _AsyncFlight(object):
+    """Coalesce concurrent coroutine calls for the same key on one event loop
+    into a single task.
+
+    Like :py:class:`~bucketcache.locks.SingleFlight`, but waiting doesn't
+    block the event loop. As for ``Bucket._call_flight``, every task returns
+    a tuple of the value and whether the function was called.
+    """
+    def __init__(self):
+        self._tasks = dict()
+
+    async def do(self, key, function):
+        """Await `function()`, or the task already in progress for `key`.
+
+        Returns:
+            Tuple of the result, and whether it was shared with (i.e. not
+            awaited by) the caller.
+        """
+        task = self._tasks.get(key)
+        shared = task is not None
+        if not shared:
+            task = self._start(key, function)
+
+        # If the caller is cancelled, the task carries on for anyone else
+        # waiting on it.
+        result = await asyncio.shield(task)
+        return result, shared
+
+    def revalidate(self, key, function):
+        """Await `function()` in a background task, unless a task for `key`
+        is already in progress.
+        """
+        if key in self._tasks:
+            return
+
+        async def call():
+            return await function(), True
+
+        logger.info('Revalidating stale key hash {}', key)
+        task = self._start(key, call)
+        task.add_done_callback(partial(self._log_failure, key))
+
+    def _start(self, key, function):
+        task = asyncio.ensure_future(function())
+        self._tasks[key] = task
+        task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        return task
+
+    @staticmethod
+    def _log_failure(key, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Failed to revalidate key hash {}: {!r}',
+                         key, task.exception())
+
+
+# Flights for each bucket, for each event loop.
+_flights = weakref.WeakKeyDictionary()
+
+
+def _flight_for(bucket):
+    loop = asyncio.get_event_loop()
+    bucket_flights = _flights.setdefault(loop, weakref.WeakKeyDictionary())
+    flight = bucket_flights.get(bucket)
+    if flight is None:
+        flight = bucket_flights[bucket] = _AsyncFlight()
+    return flight
+
+
+async def _run_io(bucket, function, *args, **kwargs):
+    """Call `function` in the bucket's executor if it is thread safe, or
+    directly otherwise.
+    """
+    if not bucket.thread_safe:
+        return function(*args, **kwargs)
+
+    loop = asyncio.get_event_loop()
+    executor = getattr(bucket, 'executor', None)
+    return await loop.run_in_executor(
+        executor, partial(function, *args, **kwargs))
+
+
+def make_coroutine_wrapper(factory, make_key, check_key, skip_cache,
+                           fire_callback, raise_if_exception):
+    """Return caller for :py:func:`decorator.decorator` which caches the
+    result of a coroutine function.
+
+    The helper functions are those used by
+    :py:class:`~bucketcache.utilities.DecoratorFactory` for normal functions.
+    """
+    bucket = factory.bucket
+
+    async def load_or_call(f, key_hash, args, kwargs, varargs, callargs):
+        flight = _flight_for(bucket)
+
+        async def call_and_cache():
+            logger.info('Calling coroutine function {}', f)
+            try:
+                res = await f(*args, **kwargs)
+            except factory.cache_exceptions as e:
+                await _run_io(bucket, factory.cache_exception, key_hash, e)
+                raise
+            await _run_io(bucket, bucket._set_value_with_hash, key_hash, res)
+            return res
+
+        async def load(stale_grace=None):
+            try:
+                obj = await _run_io(bucket, bucket._get_obj_from_hash,
+                                    key_hash, stale_grace=stale_grace)
+            except KeyStaleError as e:
+                obj = e.obj
+                flight.revalidate(key_hash, call_and_cache)
+            raise_if_exception(obj)
+            fire_callback(obj, varargs, callargs)
+            return obj.value
+
+        async def load_or_call_once():
+            try:
+                return await load(), False
+            except KeyInvalidError:
+                return await call_and_cache(), True
+
+        async def lock_and_call():
+            lock = bucket._lock_for_hash(
+                key_hash, timeout=factory.lock_timeout,
+                stale_timeout=factory.stale_lock_timeout)
+            acquiring = asyncio.ensure_future(_run_io(bucket, lock.acquire))
+            try:
+                acquired = await asyncio.shield(acquiring)
+                if not acquired:
+                    logger.warning('Timed out waiting for lock: {}',
+                                   lock.path)
+                return await load_or_call_once()
+            finally:
+                if acquiring.done():
+                    lock.release()
+                else:
+                    # Cancelled while the executor is still acquiring the
+                    # lock, which must be released once it has been.
+                    acquiring.add_done_callback(lambda _: lock.release())
+
+        if skip_cache(callargs):
+            return await call_and_cache(), True
+
+        try:
+            result = await load(stale_grace=factory.stale_while_revalidate)
+            return result, False
+        except KeyInvalidError:
+            # Tasks that miss the same key while the function is being
+            # awaited wait for its result.
+            call = lock_and_call if factory.lock else load_or_call_once
+            (result, called), shared = await flight.do(key_hash, call)
+            return result, called and not shared
+
+    async def wrapper(f, *args, **kwargs):
+        signature, key_hash, varargs, callargs = make_key(args, kwargs)
+        ret, called = await load_or_call(f, key_hash, args, kwargs, varargs,
+                                         callargs)
+
+        if called:
+            check_key(signature, key_hash)
+
+        return ret
+
+    return wrapper
@@ -1,7 +1,9 @@
 from __future__ import absolute_import, division, print_function
 
 import json
+import mmap
 from abc import ABCMeta, abstractmethod
+from collections import namedtuple
 from datetime import datetime
 
 import six
@@ -24,12 +26,35 @@ try:
 except ImportError:
     msgpack_available = False
 
+# Largest object length that msgpack's Unpacker accepts in every version.
+_MSGPACK_MAX_LEN = 2 ** 31 - 1
+
 __all__ = (
     'PickleBackend',
     'JSONBackend',
     'MessagePackBackend',
 )
 
+Metadata = namedtuple('Metadata', ['expiration_date'])
+
+# Version of the file format, saved in each file's metadata, so that future
+# formats are treated as unreadable rather than misread. Files saved before
+# the metadata was versioned don't have one.
+_FORMAT_VERSION = 1
+
+# Pickled in place of the version number. Versions of bucketcache that don't
+# write metadata can't unpickle it, so they treat files as unreadable too.
+_PickleFormat = namedtuple('_PickleFormat', ['version'])
+
+
+def _check_format(version, fp):
+    """Raise :py:exc:`~bucketcache.exceptions.BackendLoadError` unless
+    `version`, from the metadata of `fp`, is supported.
+    """
+    if version is not None and version != _FORMAT_VERSION:
+        msg = '{!r} has unsupported format version {!r}.'
+        raise BackendLoadError(msg.format(fp.name, version))
+
 
 @autorepr
 @six.add_metaclass(ABCMeta)
@@ -46,6 +71,9 @@ class Backend(object):
 
     - :py:meth:`dump`
     - :py:meth:`from_file`
+
+    Classes should also override :py:meth:`metadata_from_file` if their
+    format allows the expiration date to be read without loading the value.
     """
     abstract_attributes = {'binary_format', 'default_config', 'file_extension'}
 
@@ -128,6 +156,25 @@ class Backend(object):
         """
         raise NotImplementedError
 
+    @classmethod
+    def metadata_from_file(cls, fp, config=None):
+        """Class method for reading metadata from file.
+
+        :param fp: File containing stored data.
+        :type fp: :py:term:`file-like object`
+        :param config: Configuration passed from
+                       :py:class:`~bucketcache.buckets.Bucket`
+        :type config: :py:class:`~bucketcache.config.Config`
+        :rtype: :py:class:`Metadata`
+
+        The default implementation loads the whole file using
+        :py:meth:`from_file`. Like :py:meth:`from_file`, it should raise
+        :py:exc:`~bucketcache.exceptions.BackendLoadError` if the metadata
+        can't be read.
+        """
+        obj = cls.from_file(fp, config=config)
+        return Metadata(expiration_date=obj.expiration_date)
+
     @abstractmethod
     def dump(self, fp):
         """Called to save state to file.
@@ -142,15 +189,80 @@ class Backend(object):
 
 
 class PickleBackend(Backend):
-    """Backend that serializes objects using Pickle."""
+    """Backend that serializes objects using Pickle.
+
+    The file contains a pickled dictionary of metadata, followed by the
+    pickled value. Files containing a single pickled dictionary with both
+    are also read.
+
+    If :py:attr:`PickleConfig.buffer_threshold` is set and the value has
+    large buffers, the metadata is followed by a pickled table of the length
+    of the pickled value and of each buffer, then by the value, then by the
+    buffers, each starting at a multiple of :py:attr:`buffer_alignment`.
+    """
     binary_format = True
     default_config = PickleConfig
     file_extension = 'pickle'
 
+    # Out-of-band buffers start on page boundaries, so that they are aligned
+    # for any data type and each page is only mapped by one buffer.
+    buffer_alignment = 4096
+
     @classmethod
     def from_file(cls, fp, config=None):
         config = cls.valid_config(config)
+        data = cls._load_metadata(fp, config)
+        if data.pop('out_of_band', False):
+            data['value'] = cls._load_out_of_band(fp, config)
+        elif 'value' not in data:
+            data['value'] = cls._load(fp, config)
+
+        return cls(config=config, **data)
+
+    @classmethod
+    def _load_out_of_band(cls, fp, config):
+        value_length, buffer_lengths = cls._load(fp, config)
+        start = fp.tell()
+
+        # Mapped buffers remain valid after the file is closed, or replaced.
+        try:
+            view = memoryview(
+                mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+        except (AttributeError, IOError, OSError, ValueError):
+            if not hasattr(fp, 'getbuffer'):
+                msg = '{!r} could not be memory-mapped.'.format(fp.name)
+                raise BackendLoadError(msg)
+            # In-memory stream, e.g. decompressed data.
+            view = fp.getbuffer()
+        buffers = []
+        offset = _align(start + value_length, cls.buffer_alignment)
+        for length in buffer_lengths:
+            if offset + length > len(view):
+                msg = '{!r} is truncated.'.format(fp.name)
+                raise BackendLoadError(msg)
+            buffers.append(view[offset:offset + length])
+            offset = _align(offset + length, cls.buffer_alignment)
+
+        return cls._load(fp, config, buffers=buffers)
+
+    @classmethod
+    def metadata_from_file(cls, fp, config=None):
+        config = cls.valid_config(config)
+        data = cls._load_metadata(fp, config)
+        return Metadata(expiration_date=data['expiration_date'])
 
+    @classmethod
+    def _load_metadata(cls, fp, config):
+        data = cls._load(fp, config)
+        if not isinstance(data, dict) or 'expiration_date' not in data:
+            msg = '{!r} has no metadata.'.format(fp.name)
+            raise BackendLoadError(msg)
+        version = data.pop('format', None)
+        _check_format(getattr(version, 'version', version), fp)
+        return data
+
+    @classmethod
+    def _load(cls, fp, config, buffers=None):
         if six.PY3:
             dconfig = config.asdict()
             keys = ('fix_imports', 'encoding', 'errors')
@@ -158,31 +270,73 @@ class PickleBackend(Backend):
             kwargs = {k: v for k, v in six.iteritems(dconfig) if k in keys}
         else:
             kwargs = dict()
+        if buffers is not None:
+            kwargs['buffers'] = buffers
 
         possible_exceptions = (pickle.UnpicklingError, AttributeError,
                                EOFError, ImportError, IndexError)
         try:
-            data = pickle.load(fp, **kwargs)
+            return pickle.load(fp, **kwargs)
         except possible_exceptions:
             msg = '{!r} could not be unpickled.'.format(fp.name)
             raise BackendLoadError(msg)
 
-        return cls(config=config, **data)
-
     def dump(self, fp):
-        data = {k: self.__dict__[k] for k in ('value', 'expiration_date')}
+        metadata = {'expiration_date': self.expiration_date,
+                    'format': _PickleFormat(_FORMAT_VERSION)}
         if six.PY3:
             dconfig = self.config.asdict()
             keys = ('protocol', 'fix_imports')
             assert set(keys) <= set(dconfig)
             kwargs = {k: v for k, v in six.iteritems(dconfig) if k in keys}
-            pickle.dump(data, fp, **kwargs)
         else:
-            pickle.dump(data, fp, protocol=self.config.protocol)
+            kwargs = {'protocol': self.config.protocol}
+
+        threshold = self.config.buffer_threshold
+        if threshold is None:
+            pickle.dump(metadata, fp, **kwargs)
+            pickle.dump(self.value, fp, **kwargs)
+            return
+
+        buffers = []
+
+        def buffer_callback(buffer):
+            raw = buffer.raw()
+            if raw.nbytes < threshold:
+                # Write small buffers in-band.
+                return True
+            buffers.append(raw)
+            return False
+
+        value = pickle.dumps(self.value, buffer_callback=buffer_callback,
+                             **kwargs)
+        if not buffers:
+            pickle.dump(metadata, fp, **kwargs)
+            fp.write(value)
+            return
+
+        metadata['out_of_band'] = True
+        pickle.dump(metadata, fp, **kwargs)
+        pickle.dump((len(value), [raw.nbytes for raw in buffers]), fp,
+                    **kwargs)
+        fp.write(value)
+        for raw in buffers:
+            padding = _align(fp.tell(), self.buffer_alignment) - fp.tell()
+            fp.write(b'\0' * padding)
+            fp.write(raw)
+
+
+def _align(offset, alignment):
+    return -(-offset // alignment) * alignment
 
 
 class JSONBackend(Backend):
-    """Backend that stores objects using JSON."""
+    """Backend that stores objects using JSON.
+
+    The first line of the file is a JSON object of metadata, which is
+    followed by the value. Files containing a single JSON object with both
+    are also read.
+    """
     binary_format = False
     default_config = JSONConfig
     file_extension = 'json'
@@ -198,18 +352,62 @@ class JSONBackend(Backend):
         kwargs = {k: v for k, v in six.iteritems(dconfig) if k in keys}
         kwargs['cls'] = dconfig['load_cls']
 
+        metadata = cls._load_metadata(fp)
         try:
-            data = json.load(fp, **kwargs)
-        except ValueError:
+            if metadata is None:
+                fp.seek(0)
+                data = json.load(fp, **kwargs)
+                value = data['value']
+                expiration_date = data['expiration_date']
+            else:
+                value = json.load(fp, **kwargs)
+                expiration_date = metadata['expiration_date']
+        except (ValueError, KeyError, TypeError):
             msg = 'json file {!r} could not be loaded.'.format(fp.name)
             raise BackendLoadError(msg)
-        value = data['value']
-        expiration_date = data['expiration_date']
+
         if expiration_date:
             expiration_date = parse(expiration_date)
 
         return cls(config=config, value=value, expiration_date=expiration_date)
 
+    @classmethod
+    def metadata_from_file(cls, fp, config=None):
+        metadata = cls._load_metadata(fp)
+        if metadata is None:
+            fp.seek(0)
+            return super(JSONBackend, cls).metadata_from_file(
+                fp, config=config)
+
+        expiration_date = metadata['expiration_date']
+        if expiration_date:
+            expiration_date = parse(expiration_date)
+        return Metadata(expiration_date=expiration_date)
+
+    # Longer than any metadata line written by dump.
+    _max_metadata_length = 128
+
+    @classmethod
+    def _load_metadata(cls, fp):
+        """Read metadata from first line of `fp`, or return `None` if the file
+        doesn't start with a line of metadata.
+        """
+        # Files with a single JSON object may be on one long line, which is
+        # only read up to the length of a metadata line, so that it isn't
+        # parsed twice.
+        line = fp.readline(cls._max_metadata_length)
+        if not line.endswith('\n'):
+            return None
+        try:
+            metadata = json.loads(line)
+        except ValueError:
+            return None
+        if (not isinstance(metadata, dict) or 'value' in metadata or
+                'expiration_date' not in metadata):
+            return None
+        _check_format(metadata.get('format'), fp)
+        return metadata
+
     def dump(self, fp):
         if self.expiration_date:
             expiration_date = self.expiration_date.isoformat()
@@ -223,12 +421,19 @@ class JSONBackend(Backend):
         kwargs = {k: v for k, v in six.iteritems(dconfig) if k in keys}
         kwargs['cls'] = dconfig['dump_cls']
 
-        data = {'value': self.value, 'expiration_date': expiration_date}
-        json.dump(data, fp, **kwargs)
+        # Written on one line, so it can be read without parsing the value.
+        metadata = {'expiration_date': expiration_date,
+                    'format': _FORMAT_VERSION}
+        fp.write(json.dumps(metadata) + '\n')
+        json.dump(self.value, fp, **kwargs)
 
 
 class MessagePackBackend(Backend):
-    """Backend that stores objects using MessagePack."""
+    """Backend that stores objects using MessagePack.
+
+    The file contains a map of metadata, followed by the value. Files
+    containing a single map with both are also read.
+    """
     binary_format = True
     default_config = MessagePackConfig
     file_extension = 'msgpack'
@@ -242,35 +447,74 @@ class MessagePackBackend(Backend):
     @classmethod
     def from_file(cls, fp, config=None):
         config = cls.valid_config(config)
+        unpacker = cls._unpacker(fp, config)
+        data = cls._unpack_metadata(unpacker, fp)
+        if 'value' in data:
+            value = data['value']
+        else:
+            value = cls._unpack(unpacker, fp)
+
+        expiration_date = data['expiration_date']
+        if expiration_date:
+            expiration_date = parse(expiration_date)
+        return cls(value=value, expiration_date=expiration_date)
+
+    @classmethod
+    def metadata_from_file(cls, fp, config=None):
+        config = cls.valid_config(config)
+        unpacker = cls._unpacker(fp, config)
+        data = cls._unpack_metadata(unpacker, fp)
+
+        expiration_date = data['expiration_date']
+        if expiration_date:
+            expiration_date = parse(expiration_date)
+        return Metadata(expiration_date=expiration_date)
 
+    @staticmethod
+    def _unpacker(fp, config):
         dconfig = config.asdict()
         keys = ('object_hook', 'list_hook', 'use_list', 'object_pairs_hook')
         assert set(keys) <= set(dconfig)
         kwargs = {k: v for k, v in six.iteritems(dconfig) if k in keys}
         kwargs['encoding'] = dconfig['unpack_encoding']
+        # Unlike msgpack.unpack, Unpacker limits the size of objects, to 100
+        # MiB by default in msgpack 1.0 and less in 0.6, so the largest
+        # limits supported by every version are passed.
+        kwargs['max_buffer_size'] = 0
+        for limit in ('max_str_len', 'max_bin_len', 'max_array_len',
+                      'max_map_len', 'max_ext_len'):
+            kwargs[limit] = _MSGPACK_MAX_LEN
+        return msgpack.Unpacker(fp, **kwargs)
 
-        possible_exceptions = (msgpack.exceptions.ExtraData,
-                               msgpack.exceptions.UnpackException)
+    @classmethod
+    def _unpack_metadata(cls, unpacker, fp):
+        data = cls._unpack(unpacker, fp)
+        if not isinstance(data, dict) or 'expiration_date' not in data:
+            msg = 'MessagePack file {!r} has no metadata.'.format(fp.name)
+            raise BackendLoadError(msg)
+        _check_format(data.get('format'), fp)
+        return data
+
+    @staticmethod
+    def _unpack(unpacker, fp):
+        possible_exceptions = (msgpack.exceptions.OutOfData,
+                               msgpack.exceptions.UnpackException,
+                               ValueError)
         try:
-            data = msgpack.unpack(fp, **kwargs)
+            return unpacker.unpack()
+        except msgpack.exceptions.BufferFull:
+            # The file may be valid, so it mustn't be treated as missing.
+            raise
         except possible_exceptions:
             msg = 'MessagePack file {!r} could not be unpacked.'.format(fp.name)
             raise BackendLoadError(msg)
 
-        value = data['value']
-        expiration_date = data['expiration_date']
-        if expiration_date:
-            expiration_date = parse(expiration_date)
-        return cls(value=value, expiration_date=expiration_date)
-
     def dump(self, fp):
         if self.expiration_date:
             expiration_date = self.expiration_date.isoformat()
         else:
             expiration_date = None
 
-        data = {'value': self.value, 'expiration_date': expiration_date}
-
         dconfig = self.config.asdict()
         keys = ('default', 'unicode_errors', 'use_single_float', 'autoreset',
                 'use_bin_type')
@@ -278,4 +522,7 @@ class MessagePackBackend(Backend):
         kwargs = {k: v for k, v in six.iteritems(dconfig) if k in keys}
         kwargs['encoding'] = dconfig['pack_encoding']
 
-        msgpack.pack(data, fp, **kwargs)
+        metadata = {'expiration_date': expiration_date,
+                    'format': _FORMAT_VERSION}
+        msgpack.pack(metadata, fp, **kwargs)
+        msgpack.pack(self.value, fp, **kwargs)
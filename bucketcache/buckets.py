@@ -2,10 +2,17 @@ from __future__ import absolute_import, division, print_function
 
 import errno
 import inspect
-from collections import Container
+import io
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from datetime import datetime, timedelta
-from hashlib import md5
+from functools import partial
+from itertools import groupby
 from pathlib import Path
 
 import six
@@ -13,12 +20,26 @@ from boltons.formatutils import DeferredValue as DV
 from represent import ReprHelperMixin
 
 from .backends import Backend, PickleBackend
+from .compat.collections import Container
 from .compat.contextlib import suppress
+from .compat.os import scandir
+from .compression import compressed_backend
 from .exceptions import (
-    BackendLoadError, KeyExpirationError, KeyFileNotFoundError, KeyInvalidError)
+    BackendLoadError, KeyExpirationError, KeyFileNotFoundError,
+    KeyInvalidError, KeyStaleError)
+from .index import INDEX_NAME, ManifestIndex
 from .keymakers import DefaultKeyMaker
+from .locks import (
+    LOCK_SUFFIX, FileLock, NullStripedLock, SingleFlight, StripedLock,
+    fcntl_available)
 from .log import log_handled_exception, logger, logger_config
-from .utilities import DecoratorFactory, PrunedFilesInfo, raise_invalid_keys
+from .maintenance import MaintenanceWorker
+from .memory import MemoryCache, StripedMemoryCache
+from .utilities import (
+    TEMPORARY_SUFFIX, DecoratorFactory, DiskUsage, GetManyResult, KeyHasher,
+    KeyPrefix, NamedBytesIO, PrunedFilesInfo, PruneProgress, atomic_open,
+    expiration_from_stat, expiration_mtime_ns, link_or_rename,
+    raise_invalid_keys, to_timedelta, to_timestamp, unlink_if_exists)
 
 __all__ = ('Bucket', 'DeferredWriteBucket', 'deferred_write')
 
@@ -33,6 +54,46 @@ class Bucket(ReprHelperMixin, Container, object):
         config: `Config` instance for backend.
         keymaker: `KeyMaker` instance for object -> key serialization.
         lifetime: Key lifetime.
+        max_memory_entries: Maximum number of objects held in memory.
+        max_memory_bytes: Maximum total size of objects held in memory,
+                          measured by the size of their cached files.
+        memory_policy: Eviction policy used when a memory limit is exceeded.
+                       Default: :py:class:`~bucketcache.memory.LRUPolicy`
+        fanout_depth: Number of directory levels between `path` and the
+                      cached files. Default: 0 (all files in `path`)
+        fanout_width: Number of hash characters used to name each directory
+                      level, e.g. depth 2 and width 2 stores files as
+                      ``ab/cd/abcd....pickle``.
+        thread_safe: Allow the bucket to be used from multiple threads.
+        index: Keep an index of cached files, so that
+               :py:meth:`prune_directory` and :py:meth:`disk_usage` don't
+               need to read every file.
+        max_disk_bytes: Maximum total size of cached files. Implies `index`.
+        max_disk_entries: Maximum number of cached files. Implies `index`.
+        disk_policy: Eviction policy used when a disk limit is exceeded,
+                     ``'lru'`` (least recently used) or ``'lfu'`` (least
+                     frequently used). Default: ``'lru'``
+        maintenance_interval: Seconds between runs of a background thread
+                              that deletes expired files, enforces disk
+                              limits and compacts the index. Implies
+                              `thread_safe`. Default: `None` (no background
+                              thread)
+        maintenance_io_rate: Maximum number of files examined or deleted per
+                             second by the background thread. Default: `None`
+                             (no limit)
+        compression: :py:class:`~bucketcache.compression.Compression`
+                     instance or codec name (e.g. ``'zlib'``), to compress
+                     files written by the backend (see
+                     :py:func:`~bucketcache.compression.compressed_backend`).
+        hash_algorithm: Name of :py:mod:`hashlib` algorithm (e.g.
+                        ``'blake2b'`` or ``'sha256'``), or hash constructor,
+                        used to make key hashes. Default: ``'md5'``
+        hash_digest_size: Number of bytes of each digest to use. Default:
+                          `None` (all of it)
+        hash_encoding: Encoding of key hashes in file names, ``'hex'`` or
+                       ``'base32'``. Default: ``'hex'``
+        md5_compat: Move objects saved with the default md5 key hashes to
+                    their new key hashes when they are accessed.
         kwargs: Keyword arguments to pass to :py:class:`datetime.timedelta`
                 as shortcut for lifetime.
 
@@ -40,10 +101,78 @@ class Bucket(ReprHelperMixin, Container, object):
     :type config: :py:class:`~bucketcache.config.Config`
     :type keymaker: :py:class:`~bucketcache.keymakers.KeyMaker`
     :type lifetime: :py:class:`~datetime.timedelta`
+    :type memory_policy: :py:class:`~bucketcache.memory.EvictionPolicy`
+
+    Objects evicted from memory remain on disk, and are loaded again when
+    next accessed.
+
+    Very large buckets should use a fan-out layout to keep directories small.
+    Existing files can be moved into the configured layout using
+    :py:meth:`migrate_layout`.
+
+    With `thread_safe`, work on each key is serialized by one of a fixed set
+    of locks chosen by key hash, and the in-memory cache is split into
+    independently locked segments (see
+    :py:class:`~bucketcache.memory.StripedMemoryCache`). Threads using
+    different keys rarely contend, so read-mostly workloads scale across
+    cores where the interpreter allows it.
+
+    With `index`, the size, expiration date and last access of each file are
+    recorded in an append-only index file in `path`. It is rebuilt from a
+    directory scan if it is missing or corrupt. Every bucket using the
+    directory with the same backend should use the index, otherwise it won't
+    know about their files.
+
+    When a disk limit is exceeded by a write, files are evicted until the
+    bucket is within its limits again. Rather than finding the best file to
+    evict, a few files are sampled from the index and the worst of them is
+    evicted, so writes never scan the directory.
+
+    With `maintenance_interval`, expired files and files over the disk limits
+    are deleted by a background thread instead of the threads using the
+    bucket. Call :py:meth:`close` to stop the thread, or use the bucket as a
+    context manager.
     """
 
+    # Temporary files older than this (in seconds) are assumed to be left over
+    # from interrupted writes.
+    _temporary_file_lifetime = 3600
+
+    # Number of locks and in-memory cache segments used by thread-safe buckets.
+    _key_lock_stripes = 64
+    _memory_stripes = 16
+
+    # Maximum number of threads used to revalidate stale objects.
+    _revalidation_workers = 4
+
+    # Maximum number of threads used for file I/O by get_many etc.
+    _io_workers = 8
+
+    # Maximum number of legacy hashes remembered for md5_compat.
+    _max_legacy_hashes = 4096
+
+    # Number of files handed to the I/O threads at a time while pruning.
+    _prune_batch_size = 1024
+
+    # Number of index entries sampled to choose each file evicted by the disk
+    # limits, and maximum number of files evicted by one write.
+    _eviction_samples = 16
+    _max_evictions_per_write = 8
+
+    _disk_policies = ('lru', 'lfu')
+
+    # Whether each object is saved in its own file in the directory, which
+    # DeferredWriteBucket writes to.
+    _file_per_object = True
+
     def __init__(self, path, backend=None, config=None, keymaker=None,
-                 lifetime=None, **kwargs):
+                 lifetime=None, max_memory_entries=None, max_memory_bytes=None,
+                 memory_policy=None, fanout_depth=0, fanout_width=2,
+                 thread_safe=False, index=False, max_disk_bytes=None,
+                 max_disk_entries=None, disk_policy='lru',
+                 maintenance_interval=None, maintenance_io_rate=None,
+                 compression=None, hash_algorithm='md5', hash_digest_size=None,
+                 hash_encoding='hex', md5_compat=False, **kwargs):
         if kwargs:
             valid_kwargs = {'days', 'seconds', 'microseconds', 'milliseconds',
                             'minutes', 'hours', 'weeks'}
@@ -58,8 +187,49 @@ class Bucket(ReprHelperMixin, Container, object):
                                  "but not both.")
             lifetime = timedelta(**kwargs)
 
+        self._read_flight = SingleFlight()
+        # Every call coalesced by _call_flight returns a tuple of the value
+        # and whether the function was called, as revalidation and misses
+        # for the same key hash wait for each other.
+        self._call_flight = SingleFlight()
+
+        self._background_lock = threading.Lock()
+        self._executor = None
+        self._revalidating = set()
+
+        if maintenance_interval is not None:
+            # The maintenance thread uses the bucket too.
+            thread_safe = True
+
         # Now we're thinking with portals.
-        self._cache = dict()
+        if thread_safe:
+            self._key_locks = StripedLock(self._key_lock_stripes)
+            self._cache = StripedMemoryCache(max_entries=max_memory_entries,
+                                             max_bytes=max_memory_bytes,
+                                             policy=memory_policy,
+                                             sizeof=_obj_sizeof,
+                                             stripes=self._memory_stripes)
+        else:
+            self._key_locks = NullStripedLock()
+            self._cache = MemoryCache(max_entries=max_memory_entries,
+                                      max_bytes=max_memory_bytes,
+                                      policy=memory_policy,
+                                      sizeof=_obj_sizeof)
+        self._thread_safe = thread_safe
+
+        self._key_hasher = KeyHasher(hash_algorithm,
+                                     digest_size=hash_digest_size,
+                                     encoding=hash_encoding)
+        hasher = self._key_hasher
+        if md5_compat and ((hasher.algorithm, hasher.digest_size,
+                            hasher.encoding) != ('md5', None, 'hex')):
+            self._legacy_hasher = KeyHasher()
+        else:
+            self._legacy_hasher = None
+        # Hash state for the backend name, which every key hash starts with.
+        self._seed_key_prefix = None
+        # Legacy hashes of recently hashed keys, for md5_compat.
+        self._legacy_hashes = dict()
 
         _path = Path(path)
 
@@ -68,10 +238,11 @@ class Bucket(ReprHelperMixin, Container, object):
 
         self._path = _path.resolve()
 
-        if backend is not None:
-            self.backend = backend
-        else:
-            self.backend = PickleBackend
+        if backend is None:
+            backend = PickleBackend
+        if compression is not None:
+            backend = compressed_backend(backend, compression)
+        self.backend = backend
 
         self.config = config
 
@@ -82,10 +253,143 @@ class Bucket(ReprHelperMixin, Container, object):
 
         self.lifetime = lifetime
 
+        if fanout_depth < 0:
+            raise ValueError('fanout_depth cannot be negative.')
+        if fanout_width < 1:
+            raise ValueError('fanout_width must be positive.')
+
+        self._fanout_depth = fanout_depth
+        self._fanout_width = fanout_width
+
+        for name, limit in [('max_disk_bytes', max_disk_bytes),
+                            ('max_disk_entries', max_disk_entries)]:
+            if limit is not None and limit <= 0:
+                raise ValueError('{} must be positive.'.format(name))
+        for name, value in [('maintenance_interval', maintenance_interval),
+                            ('maintenance_io_rate', maintenance_io_rate)]:
+            if value is not None and value <= 0:
+                raise ValueError('{} must be positive.'.format(name))
+        if disk_policy not in self._disk_policies:
+            raise ValueError('disk_policy must be one of {}.'.format(
+                ', '.join(repr(p) for p in self._disk_policies)))
+
+        self._max_disk_bytes = max_disk_bytes
+        self._max_disk_entries = max_disk_entries
+        self._disk_policy = disk_policy
+
+        if max_disk_bytes is not None or max_disk_entries is not None:
+            index = True
+
+        if index:
+            index_name = INDEX_NAME.format(self.backend.file_extension)
+            self._index = ManifestIndex(self._path / index_name,
+                                        scan=self._scan_files)
+        else:
+            self._index = None
+
+        self._open_storage()
+
+        if maintenance_interval is not None:
+            self._maintenance = MaintenanceWorker(
+                self, maintenance_interval, io_rate=maintenance_io_rate)
+            self._maintenance.start()
+        else:
+            self._maintenance = None
+
+    def _open_storage(self):
+        """Prepare storage, before background maintenance starts. For
+        subclasses that don't store each object in its own file.
+        """
+
+    def close(self):
+        """Stop background work, and write buffered index records.
+
+        The bucket can still be used afterwards, but expired files are
+        deleted by the threads using it again.
+        """
+        maintenance = self._maintenance
+        if maintenance is not None:
+            maintenance.stop()
+            self._maintenance = None
+
+        with self._background_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+        if self._index is not None:
+            self._index.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     @property
     def path(self):
         return self._path
 
+    @property
+    def fanout_depth(self):
+        return self._fanout_depth
+
+    @property
+    def fanout_width(self):
+        return self._fanout_width
+
+    @property
+    def thread_safe(self):
+        return self._thread_safe
+
+    @property
+    def index(self):
+        return self._index is not None
+
+    @property
+    def max_disk_bytes(self):
+        return self._max_disk_bytes
+
+    @property
+    def max_disk_entries(self):
+        return self._max_disk_entries
+
+    @property
+    def disk_policy(self):
+        return self._disk_policy
+
+    @property
+    def maintenance_interval(self):
+        if self._maintenance is None:
+            return None
+        return self._maintenance.interval
+
+    @property
+    def maintenance_io_rate(self):
+        if self._maintenance is None:
+            return None
+        return self._maintenance.io_rate
+
+    @property
+    def hash_algorithm(self):
+        return self._key_hasher.algorithm
+
+    @property
+    def hash_digest_size(self):
+        return self._key_hasher.digest_size
+
+    @property
+    def hash_encoding(self):
+        return self._key_hasher.encoding
+
+    @property
+    def md5_compat(self):
+        return self._legacy_hasher is not None
+
+    @property
+    def compression(self):
+        return getattr(self.backend, 'compression', None)
+
     @property
     def backend(self):
         return self._backend
@@ -120,38 +424,209 @@ class Bucket(ReprHelperMixin, Container, object):
             self._lifetime = value
 
     def __contains__(self, item):
+        key_hash = self._hash_for_key(item)
+        return self._contains_hash(key_hash)
+
+    def _contains_hash(self, key_hash):
+        """Check for unexpired object, without loading it from file."""
+        in_memory = self._memory_contains_hash(key_hash)
+        if in_memory is not None:
+            return in_memory
+
         try:
-            self[item]
-        except KeyError:
+            expired = self._call_with_legacy_hash(self._hash_has_expired,
+                                                  key_hash)
+        except KeyInvalidError:
             return False
-        else:
-            return True
+
+        if expired:
+            with self._key_locks.lock_for(key_hash):
+                if key_hash not in self._cache:
+                    self._unlink_expired_hash(key_hash)
+        return not expired
+
+    def _memory_contains_hash(self, key_hash):
+        """Check for unexpired object in memory, returning `None` if it isn't
+        in memory.
+        """
+        try:
+            self._get_obj_from_hash(key_hash, load_file=False)
+        except KeyExpirationError:
+            return False
+        except KeyInvalidError:
+            return None
+        return True
 
     def __setitem__(self, key, value):
         key_hash = self._hash_for_key(key)
-        obj = self._update_or_make_obj_with_hash(key_hash, value)
-        self._set_obj_with_hash(key_hash, obj)
+        self._set_value_with_hash(key_hash, value)
 
     def setitem(self, key, value):
         """Provide setitem method as alternative to ``bucket[key] = value``"""
         return self.__setitem__(key, value)
 
-    def _update_or_make_obj_with_hash(self, key_hash, value):
+    def _set_value_with_hash(self, key_hash, value, lifetime=None):
+        """Set `value` for `key_hash`, expiring after `lifetime` instead of
+        the bucket's lifetime if it is given.
+        """
+        with self._key_locks.lock_for(key_hash):
+            obj = self._update_or_make_obj_with_hash(key_hash, value,
+                                                     lifetime=lifetime)
+            self._set_obj_with_hash(key_hash, obj)
+
+    def _update_or_make_obj_with_hash(self, key_hash, value, lifetime=None):
         try:
             obj = self._get_obj_from_hash(key_hash, load_file=False)
             obj.value = value
         except KeyInvalidError:
             obj = self.backend(value, config=self.config)
 
-        obj.expiration_date = self._object_expiration_date()
+        obj.expiration_date = self._object_expiration_date(lifetime)
         return obj
 
     def _set_obj_with_hash(self, key_hash, obj):
-        file_path = self._path_for_hash(key_hash)
-        with open(str(file_path), self._write_mode) as f:
+        size = self._write_obj_with_hash(key_hash, obj)
+        self._cache.set(key_hash, obj, size=size)
+
+    def _set_objs_with_hashes(self, objs):
+        """Save list of (key hash, object) pairs, writing files in
+        parallel.
+        """
+        def dump(item):
+            key_hash, obj = item
+            with self._key_locks.lock_for(key_hash):
+                return self._write_obj_with_hash(key_hash, obj)
+
+        sizes = self._map_io(dump, objs)
+        for (key_hash, obj), size in zip(objs, sizes):
+            self._cache.set(key_hash, obj, size=size)
+
+    def _write_obj_with_hash(self, key_hash, obj):
+        """Write `obj` to file and record it in the index, returning the
+        file size.
+        """
+        size = self._dump_obj(self._path_for_hash(key_hash), obj)
+        if self._index is not None:
+            self._index.set(key_hash, size, to_timestamp(obj.expiration_date))
+            if self._maintenance is None:
+                self._enforce_disk_limits(
+                    exclude=key_hash,
+                    max_evictions=self._max_evictions_per_write)
+            elif self._over_disk_limits():
+                self._maintenance.wake()
+        return size
+
+    def _over_disk_limits(self):
+        index = self._index
+        if index is None:
+            return False
+        if self._max_disk_bytes is not None:
+            if index.size > self._max_disk_bytes:
+                return True
+        if self._max_disk_entries is not None:
+            if len(index) > self._max_disk_entries:
+                return True
+        return False
+
+    def _enforce_disk_limits(self, exclude=None, max_evictions=None,
+                             throttle=None):
+        """Evict files until the bucket is within its disk limits, or until
+        `max_evictions` files have been evicted.
+
+        Each file evicted is the worst of a random sample of index entries,
+        according to :py:attr:`disk_policy`. `exclude` is never evicted.
+        `throttle` is called before each eviction, and stops eviction if it
+        returns `False`.
+        """
+        if self._max_disk_bytes is None and self._max_disk_entries is None:
+            return
+
+        if self._disk_policy == 'lfu':
+            def badness(entry):
+                return -entry.hits, -entry.last_access
+        else:
+            def badness(entry):
+                return -entry.last_access
+
+        evicted = 0
+        while max_evictions is None or evicted < max_evictions:
+            if not self._over_disk_limits():
+                return
+            if throttle is not None and not throttle():
+                return
+            candidates = [
+                (badness(entry), key_hash)
+                for key_hash, entry in self._index.sample(
+                    self._eviction_samples)
+                if key_hash != exclude]
+            for _, key_hash in sorted(candidates, reverse=True):
+                if self._evict_hash(key_hash):
+                    evicted += 1
+                    break
+            else:
+                # Nothing else to evict, or every candidate is in use.
+                return
+
+    def _evict_hash(self, key_hash):
+        """Delete file and object for `key_hash` if nothing else is using
+        the key, returning `True` if it was evicted.
+        """
+        lock = self._key_locks.lock_for(key_hash)
+        # Waiting could deadlock with a thread evicting the key we hold.
+        if not lock.acquire(False):
+            return False
+        try:
+            logger.debug('Evicting file for key hash: {}', key_hash)
+            self._unlink_hash(key_hash)
+            self._forget_hash(key_hash)
+        finally:
+            lock.release()
+        return True
+
+    def _dump_obj(self, file_path, obj):
+        """Write `obj` to `file_path` atomically, and return the file size.
+
+        The object is written to a temporary file which is renamed over
+        `file_path`, so other threads and processes never read a partially
+        written file. The file's modification time is set to encode the
+        object's expiration date (see :py:meth:`_stat_has_expired`).
+        """
+        self._make_parent_directory(file_path)
+        expiration = to_timestamp(obj.expiration_date)
+        with atomic_open(file_path, self._write_mode,
+                         mtime_ns=expiration_mtime_ns(expiration)) as f:
             obj.dump(f)
+            f.flush()
+            return os.fstat(f.fileno()).st_size
 
-        self._cache[key_hash] = obj
+    def _serialize_obj(self, obj):
+        """Return `obj` serialized by the backend as bytes, for subclasses
+        that don't store each object in its own file. Text backends are
+        encoded as UTF-8.
+        """
+        if self.backend.binary_format:
+            buffer = io.BytesIO()
+        else:
+            buffer = six.StringIO()
+        obj.dump(buffer)
+        data = buffer.getvalue()
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+        return data
+
+    def _deserialize_obj(self, data, name):
+        """Load object from `data` returned by :py:meth:`_serialize_obj`.
+        `name` describes where it was stored, for error messages.
+        """
+        stream = NamedBytesIO(data, name)
+        if not self.backend.binary_format:
+            stream = io.TextIOWrapper(stream, encoding='utf-8')
+        try:
+            return self.backend.from_file(stream, config=self.config)
+        except BackendLoadError:
+            msg = 'Backend {} failed to load: {}'.format(self.backend, name)
+            log_handled_exception(msg)
+            raise KeyInvalidError(msg)
 
     def __getitem__(self, key):
         obj = self._get_obj(key)
@@ -162,6 +637,152 @@ class Bucket(ReprHelperMixin, Container, object):
         """Provide getitem method as alternative to ``bucket[key]``."""
         return self.__getitem__(key)
 
+    def get_or_set(self, key, function, stale_while_revalidate=None):
+        """Return value for `key`, calling `function` to set it if the key
+        is missing or has expired.
+
+        Parameters:
+            key: Key to get.
+            function: Function called with no arguments to make value.
+            stale_while_revalidate: Grace period after a key expires, during
+                                    which the expired value is returned
+                                    immediately while `function` is called in
+                                    a background thread to replace it.
+
+        :type stale_while_revalidate: :py:class:`~datetime.timedelta`
+
+        Concurrent calls for the same missing key call `function` once.
+        """
+        key_hash = self._hash_for_key(key)
+        grace = to_timedelta(stale_while_revalidate)
+
+        def call_and_cache():
+            value = function()
+            self._set_value_with_hash(key_hash, value)
+            return value
+
+        def load_or_call_once():
+            # Another thread may have set the key since we last checked.
+            with suppress(KeyInvalidError):
+                return self._get_obj_from_hash(key_hash).value, False
+            return call_and_cache(), True
+
+        try:
+            return self._get_obj_from_hash(key_hash, stale_grace=grace).value
+        except KeyStaleError as e:
+            self._revalidate(key_hash, call_and_cache)
+            return e.obj.value
+        except KeyInvalidError:
+            (value, _), _ = self._call_flight.do(key_hash, load_or_call_once)
+            return value
+
+    def get_many(self, keys):
+        """Get values for many keys at once.
+
+        Parameters:
+            keys: Iterable of keys, which must be hashable.
+
+        Returns:
+            Mapping of keys to values for keys that were found, and a list of
+            missing (or expired) keys.
+
+        :rtype: :py:class:`~bucketcache.utilities.GetManyResult`
+
+        Objects in memory are returned first, and the remaining files are
+        loaded in parallel.
+        """
+        found = OrderedDict()
+        missing = []
+        to_load = []
+        for key in keys:
+            key_hash = self._hash_for_key(key)
+            try:
+                obj = self._get_obj_from_hash(key_hash, load_file=False)
+            except KeyExpirationError:
+                missing.append(key)
+            except KeyInvalidError:
+                to_load.append((key, key_hash))
+            else:
+                found[key] = obj.value
+
+        def load(item):
+            _, key_hash = item
+            with suppress(KeyInvalidError):
+                return self._call_with_legacy_hash(
+                    self._load_obj_with_hash, key_hash, skip_expired=True)
+
+        loaded = self._map_io(load, to_load)
+
+        # Objects are only added to the in-memory cache from this thread, so
+        # that the bucket doesn't need to be thread safe.
+        for (key, key_hash), result in zip(to_load, loaded):
+            if result is not None:
+                obj, size = result
+                self._cache.setdefault(key_hash, obj, size=size)
+                with suppress(KeyInvalidError):
+                    obj = self._get_obj_from_hash(key_hash, load_file=False)
+                    found[key] = obj.value
+                    continue
+            missing.append(key)
+
+        return GetManyResult(found=found, missing=missing)
+
+    def set_many(self, items):
+        """Set many keys at once.
+
+        Parameters:
+            items: Mapping, or iterable of (key, value) pairs.
+
+        Files are written in parallel.
+        """
+        if hasattr(items, 'items'):
+            items = six.iteritems(items)
+
+        objs = OrderedDict()
+        for key, value in items:
+            key_hash = self._hash_for_key(key)
+            objs[key_hash] = self._update_or_make_obj_with_hash(
+                key_hash, value)
+
+        self._set_objs_with_hashes(list(objs.items()))
+
+    def delete_many(self, keys):
+        """Delete many keys at once.
+
+        Parameters:
+            keys: Iterable of keys.
+
+        Returns:
+            List of keys that weren't in the bucket.
+
+        Files are deleted in parallel.
+        """
+        keys = list(keys)
+        key_hashes = [self._hash_for_key(key) for key in keys]
+        # Like __delitem__, expired objects count as missing. Memory is
+        # checked in this thread, in case the bucket isn't thread-safe.
+        in_memory = [self._memory_contains_hash(key_hash)
+                     for key_hash in key_hashes]
+        in_file = self._map_io(self._delete_unexpired_file_with_hash,
+                               key_hashes)
+        for key_hash in key_hashes:
+            self._forget_hash(key_hash)
+        return [key for key, memory, found
+                in zip(keys, in_memory, in_file)
+                if not (found if memory is None else memory)]
+
+    def _map_io(self, function, items):
+        """Return list of ``function(item)`` for each item, called in
+        parallel on a bounded thread pool.
+        """
+        items = list(items)
+        if len(items) <= 1:
+            return [function(item) for item in items]
+
+        workers = min(len(items), self._io_workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(function, items))
+
     def _get_obj(self, key):
         key_hash = self._hash_for_key(key)
         try:
@@ -171,40 +792,96 @@ class Bucket(ReprHelperMixin, Container, object):
         else:
             return obj
 
-    def _get_obj_from_hash(self, key_hash, load_file=True):
-        file_path = self._path_for_hash(key_hash)
+    def _get_obj_from_hash(self, key_hash, load_file=True, stale_grace=None):
+        """Get object from memory, or from file if `load_file` is `True`.
 
-        if key_hash in self._cache:
-            obj = self._cache[key_hash]
-        elif load_file:
-            logger.info('Attempt load from file: {}', file_path)
+        If the object has expired less than `stale_grace` ago,
+        :py:exc:`~bucketcache.exceptions.KeyStaleError` is raised with the
+        object, and its file is left in place. Otherwise, expired objects are
+        deleted.
+        """
+        obj = self._cache.get(key_hash)
+
+        if obj is None and load_file:
+            # Concurrent reads of the same file are coalesced into one. Stale
+            # objects can be used within the grace period, so they must be
+            # loaded, and those reads can't follow one that skips them.
+            skip_expired = stale_grace is None
+            load = partial(self._load_obj_into_cache, key_hash,
+                           skip_expired=skip_expired)
             try:
-                with file_path.open(self._read_mode) as f:
-                    obj = self.backend.from_file(f, config=self.config)
-            except IOError as e:
-                if e.errno == errno.ENOENT:
-                    msg = 'File not found: {}'.format(file_path)
-                    log_handled_exception(msg)
-                    raise KeyFileNotFoundError(msg)
-                else:
-                    msg = 'Unexpected exception trying to load file: {}'
-                    logger.exception(msg, file_path)
-                    raise
-            except BackendLoadError:
-                msg = 'Backend {} failed to load file: {}'
-                msg = msg.format(self.backend, file_path)
-                log_handled_exception(msg)
-                raise KeyInvalidError(msg)
-            except Exception:
-                msg = 'Unhandled exception trying to load file: {}'
-                logger.exception(msg, file_path)
+                obj, _ = self._read_flight.do((key_hash, skip_expired), load)
+            except KeyExpirationError:
+                # The file's modification time shows that it has expired.
+                with self._key_locks.lock_for(key_hash):
+                    if key_hash not in self._cache:
+                        self._unlink_expired_hash(key_hash)
                 raise
-
-            self._cache[key_hash] = obj
-        else:
+        elif obj is None:
             raise KeyInvalidError("<key hash not found in internal "
                                   "cache '{}'>".format(key_hash))
 
+        if self._has_expired(obj):
+            if stale_grace is not None and self._is_stale(obj, stale_grace):
+                raise KeyStaleError("<key hash '{}'>".format(key_hash), obj)
+
+            with self._key_locks.lock_for(key_hash):
+                # Another thread may have replaced the object in the meantime,
+                # in which case the file belongs to the new object.
+                replaced = self._cache.get(key_hash) not in (obj, None)
+                if not replaced and self._has_expired(obj):
+                    self._unlink_expired_hash(key_hash)
+                    self._cache.pop(key_hash, None)
+                    expired = True
+                else:
+                    expired = False
+            if expired:
+                raise KeyExpirationError("<key hash '{}'>".format(key_hash))
+            return self._get_obj_from_hash(key_hash, load_file=load_file,
+                                           stale_grace=stale_grace)
+
+        if self._index is not None:
+            self._index.touch(key_hash)
+        return obj
+
+    def _is_stale(self, obj, grace):
+        """Return `True` if expired `obj` is still usable within `grace`."""
+        expiration_date = obj.expiration_date
+        if not expiration_date:
+            return False
+        if self.lifetime and expiration_date > self._object_expiration_date():
+            # Saved with a longer lifetime, so not just stale.
+            return False
+        return datetime.utcnow() <= expiration_date + grace
+
+    def _revalidate(self, key_hash, function):
+        """Call `function` in a background thread to replace the stale object
+        for `key_hash`, unless this is already being done.
+        """
+        with self._background_lock:
+            if key_hash in self._revalidating:
+                return
+            self._revalidating.add(key_hash)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._revalidation_workers)
+
+        logger.info('Revalidating stale key hash {}', key_hash)
+        self._executor.submit(self._run_revalidation, key_hash, function)
+
+    def _run_revalidation(self, key_hash, function):
+        def call():
+            return function(), True
+
+        try:
+            self._call_flight.do(key_hash, call)
+        except Exception:
+            logger.exception('Failed to revalidate key hash {}', key_hash)
+        finally:
+            with self._background_lock:
+                self._revalidating.discard(key_hash)
+
+    def _has_expired(self, obj):
         if self.lifetime:
             # If object expires after now + lifetime, then it was saved with a
             # previous Bucket() with a longer lifetime. Let's expire the key.
@@ -219,31 +896,246 @@ class Bucket(ReprHelperMixin, Container, object):
         else:
             lifetime_changed = False
 
-        if obj.has_expired() or lifetime_changed:
-            file_path.unlink()
-            del self._cache[key_hash]
-            raise KeyExpirationError("<key hash '{}'>".format(key_hash))
+        return obj.has_expired() or lifetime_changed
 
-        return obj
+    def _stat_has_expired(self, stat):
+        """Check expiration using the modification time of a file, which is
+        set to encode the expiration date when it is written.
+
+        Returns:
+            `True` or `False`, or `None` if the modification time doesn't
+            encode an expiration date (e.g. the file was saved by an older
+            version), or is too close to now to tell, in which case the file
+            must be loaded to find out.
+        """
+        known, expiration = expiration_from_stat(stat)
+        if not known:
+            return None
+        # The expiration date was rounded up to the next second, so if the
+        # answer depends on that second, the exact date is needed.
+        if self.lifetime and expiration is not None:
+            latest = to_timestamp(self._object_expiration_date())
+            if latest < expiration <= latest + 1:
+                return None
+        if expiration is not None:
+            now = to_timestamp(datetime.utcnow())
+            if expiration - 1 < now <= expiration:
+                return None
+        return self._timestamp_has_expired(expiration)
+
+    def _timestamp_has_expired(self, expiration):
+        """Check expiration of object with POSIX timestamp `expiration`
+        (`None` if it never expires), like :py:meth:`_has_expired`.
+        """
+        if self.lifetime:
+            # Objects saved with a previous, longer lifetime have expired.
+            if expiration is None:
+                return True
+            latest = to_timestamp(self._object_expiration_date())
+            if expiration > latest:
+                return True
+        return (expiration is not None and
+                expiration < to_timestamp(datetime.utcnow()))
+
+    def _load_obj_into_cache(self, key_hash, skip_expired=False):
+        obj, size = self._call_with_legacy_hash(
+            self._load_obj_with_hash, key_hash, skip_expired=skip_expired)
+        # If another thread cached an object while we were loading, it may
+        # have come from a newer file.
+        return self._cache.setdefault(key_hash, obj, size=size)
+
+    def _load_obj_with_hash(self, key_hash, skip_expired=False):
+        """Load object for `key_hash` from storage, like
+        :py:meth:`_load_obj_from_file`.
+        """
+        return self._load_obj_from_file(self._path_for_hash(key_hash),
+                                        skip_expired=skip_expired)
+
+    def _load_obj_from_file(self, file_path, skip_expired=False):
+        """Load object from `file_path`, bypassing the in-memory cache.
+
+        If `skip_expired` is `True` and the file's modification time shows
+        that it has expired,
+        :py:exc:`~bucketcache.exceptions.KeyExpirationError` is raised
+        without loading it.
+
+        Returns:
+            Tuple of object and file size.
+        """
+        logger.info('Attempt load from file: {}', file_path)
+        with self._open_for_read(file_path) as f:
+            stat = os.fstat(f.fileno())
+            expired = skip_expired and self._stat_has_expired(stat)
+            if not expired:
+                obj = self.backend.from_file(f, config=self.config)
+
+        if expired:
+            raise KeyExpirationError('File has expired: {}'.format(file_path))
+
+        return obj, stat.st_size
+
+    def _hash_has_expired(self, key_hash):
+        """Check expiration of object for `key_hash` in storage, without
+        loading its value.
+        """
+        expired, _ = self._file_has_expired(self._path_for_hash(key_hash))
+        return expired
+
+    def _file_has_expired(self, file_path, stat=None):
+        """Check expiration of file without loading its value. The file is
+        only opened if its stat result (`stat`, or read from the file system
+        if not given) doesn't show whether it has expired.
+
+        Returns:
+            Tuple of whether the file has expired, and its size.
+        """
+        if stat is None:
+            stat = self._stat_file(file_path)
+        expired = self._stat_has_expired(stat)
+        if expired is None:
+            with self._open_for_read(file_path) as f:
+                expired = self._timestamp_has_expired(
+                    self._metadata_expiration(f))
+        return expired, stat.st_size
+
+    def _metadata_expiration(self, f):
+        """Read expiration date of open file `f` from its metadata, as a
+        POSIX timestamp (`None` if it never expires).
+        """
+        metadata = self.backend.metadata_from_file(f, config=self.config)
+        return to_timestamp(metadata.expiration_date)
+
+    def _read_file_expiration(self, file_path):
+        """Read expiration date of file from its modification time, or
+        from its metadata if necessary.
+
+        Returns:
+            Tuple of expiration date as POSIX timestamp (`None` if the file
+            never expires), and the file's stat result.
+        """
+        stat = self._stat_file(file_path)
+        _, expiration = expiration_from_stat(stat)
+        # The date in the modification time is rounded up, which only changes
+        # whether the file has expired when _stat_has_expired can't tell.
+        if self._stat_has_expired(stat) is None:
+            with self._open_for_read(file_path) as f:
+                expiration = self._metadata_expiration(f)
+        return expiration, stat
+
+    def _stat_file(self, file_path):
+        """Return stat result of `file_path`, raising
+        :py:exc:`~bucketcache.exceptions.KeyFileNotFoundError` if it's
+        missing.
+        """
+        try:
+            return os.stat(str(file_path))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            msg = 'File not found: {}'.format(file_path)
+            log_handled_exception(msg)
+            raise KeyFileNotFoundError(msg)
+
+    @contextmanager
+    def _open_for_read(self, file_path):
+        """Open `file_path`, raising
+        :py:exc:`~bucketcache.exceptions.KeyInvalidError` if it's missing or
+        can't be loaded by the backend.
+        """
+        try:
+            with file_path.open(self._read_mode) as f:
+                yield f
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                msg = 'File not found: {}'.format(file_path)
+                log_handled_exception(msg)
+                raise KeyFileNotFoundError(msg)
+            else:
+                msg = 'Unexpected exception trying to load file: {}'
+                logger.exception(msg, file_path)
+                raise
+        except BackendLoadError:
+            msg = 'Backend {} failed to load file: {}'
+            msg = msg.format(self.backend, file_path)
+            log_handled_exception(msg)
+            raise KeyInvalidError(msg)
+        except Exception:
+            msg = 'Unhandled exception trying to load file: {}'
+            logger.exception(msg, file_path)
+            raise
 
     def __delitem__(self, key):
-        file_path, key_hash = self._path_and_hash_for_key(key)
-        if key in self:
-            file_path.unlink()
-            del self._cache[key_hash]
-        else:
-            raise KeyError(self._abbreviate(key))
+        key_hash = self._hash_for_key(key)
+        with self._key_locks.lock_for(key_hash):
+            if self._contains_hash(key_hash):
+                self._delete_file_with_hash(key_hash)
+                self._forget_hash(key_hash)
+            else:
+                raise KeyError(self._abbreviate(key))
 
-    def prune_directory(self):
+    def _delete_file_with_hash(self, key_hash):
+        """Delete file for `key_hash`, returning `True` if it existed."""
+        with self._key_locks.lock_for(key_hash):
+            return self._unlink_hash(key_hash)
+
+    def _delete_unexpired_file_with_hash(self, key_hash):
+        """Delete file for `key_hash`, returning `True` if it existed and
+        hadn't expired.
+        """
+        with self._key_locks.lock_for(key_hash):
+            try:
+                expired = self._call_with_legacy_hash(self._hash_has_expired,
+                                                      key_hash)
+            except KeyInvalidError:
+                return False
+            self._unlink_hash(key_hash)
+            return not expired
+
+    def _unlink_hash(self, key_hash):
+        """Delete file for `key_hash` and remove it from the index."""
+        unlinked = unlink_if_exists(self._path_for_hash(key_hash))
+        if self._index is not None:
+            if unlinked or self._index.get(key_hash) is not None:
+                self._index.discard(key_hash)
+        return unlinked
+
+    def _unlink_expired_hash(self, key_hash):
+        """Delete expired file for `key_hash`, unless the maintenance thread
+        will delete it.
+        """
+        if self._maintenance is None:
+            self._unlink_hash(key_hash)
+
+    def _forget_hash(self, key_hash):
+        """Remove object for `key_hash` from memory, returning `True` if it
+        was there.
+        """
+        return self._cache.pop(key_hash, None) is not None
+
+    def prune_directory(self, resume_from=None):
         """Delete any objects that can be loaded and are expired according to
         the current lifetime setting.
 
         A file will be deleted if the following conditions are met:
 
         - The file extension matches :py:meth:`bucketcache.backends.Backend.file_extension`
-        - The object can be loaded by the configured backend.
+        - The object's metadata can be loaded by the configured backend.
         - The object's expiration date has passed.
 
+        Values aren't loaded, and nothing is added to the in-memory cache.
+        Expiration dates are read from file modification times, or from each
+        file's metadata if necessary. If the bucket has an index, they are
+        read from the index instead. Files are checked and deleted in
+        parallel.
+
+        Temporary files and lock files left behind by interrupted processes
+        are also deleted once they are more than an hour old.
+
+        Parameters:
+            resume_from: Checkpoint from
+                         :py:meth:`iter_prune_directory`. Partitions up to
+                         and including the checkpoint are skipped.
+
         Returns:
             File size and number of files deleted.
 
@@ -257,33 +1149,312 @@ class Bucket(ReprHelperMixin, Container, object):
             This is not destructive, because only files that have expired
             according to the lifetime of the original bucket are deleted.
         """
-        glob = '*.{ext}'.format(ext=self.backend.file_extension)
+        progress = None
+        for progress in self.iter_prune_directory(resume_from=resume_from):
+            pass
+        if progress is None:
+            return PrunedFilesInfo(size=0, num=0)
+        return PrunedFilesInfo(size=progress.size, num=progress.num)
+
+    def iter_prune_directory(self, resume_from=None):
+        """Prune the directory like :py:meth:`prune_directory`, yielding
+        progress as each partition is finished.
+
+        With a fan-out layout, each top-level directory is a partition, and
+        they are pruned in order of name. Otherwise, the whole bucket is one
+        partition. Each :py:class:`~bucketcache.utilities.PruneProgress` has
+        the totals so far, and the checkpoint (the name of the last partition
+        finished). If pruning is interrupted, pass the last checkpoint as
+        `resume_from` to skip the partitions already pruned.
+
+        The final progress also includes temporary and lock files.
+        """
+        return self._iter_prune(_no_throttle, resume_from=resume_from)
+
+    def _iter_prune(self, throttle, resume_from=None):
+        """Implement :py:meth:`iter_prune_directory`. `throttle` is called
+        before each file is examined, and stops pruning if it returns `False`.
+        """
+        if self._index is not None:
+            partitions = self._indexed_partitions()
+            prune_file = self._prune_indexed_file
+        else:
+            partitions = self._scanned_partitions()
+            prune_file = self._prune_scanned_file
+
         totalsize = 0
         totalnum = 0
-        for f in self._path.glob(glob):
-            filesize = f.stat().st_size
-            key_hash = f.stem
-            in_cache = key_hash in self._cache
-            try:
-                self._get_obj_from_hash(key_hash)
-            except KeyExpirationError:
-                # File has been deleted by `_get_obj_from_hash`
-                totalsize += filesize
-                totalnum += 1
-            except KeyInvalidError:
-                pass
-            except Exception:
+        checked = 0
+        checkpoint = resume_from
+
+        with ThreadPoolExecutor(max_workers=self._io_workers) as executor:
+            def prune_batch(batch):
+                pruned = [result for result in executor.map(prune_file, batch)
+                          if result is not None]
+                # Memory is updated in this thread, in case the bucket isn't
+                # thread-safe.
+                for key_hash, _ in pruned:
+                    self._cache.pop(key_hash, None)
+                return sum(size for _, size in pruned), len(pruned), len(batch)
+
+            for partition, items in partitions:
+                if resume_from is not None and partition <= resume_from:
+                    continue
+
+                batch = []
+                for item in items:
+                    if not throttle():
+                        return
+                    batch.append(item)
+                    if len(batch) < self._prune_batch_size:
+                        continue
+                    size, num, batch_checked = prune_batch(batch)
+                    totalsize += size
+                    totalnum += num
+                    checked += batch_checked
+                    batch = []
+
+                size, num, batch_checked = prune_batch(batch)
+                totalsize += size
+                totalnum += num
+                checked += batch_checked
+
+                checkpoint = partition
+                yield PruneProgress(size=totalsize, num=totalnum,
+                                    checked=checked, checkpoint=checkpoint)
+
+        size, num = self._prune_leftover_files(throttle)
+        yield PruneProgress(size=totalsize + size, num=totalnum + num,
+                            checked=checked, checkpoint=checkpoint)
+
+    def _scanned_partitions(self):
+        """Yield ``(name, entries)`` for each partition, where `entries` is
+        an iterator of :py:func:`os.scandir` entries for cached files.
+        """
+        if not self._fanout_depth:
+            yield '', self._scan_directory(str(self._path), 0)
+            return
+
+        names = sorted(
+            entry.name for entry in scandir(str(self._path))
+            if not entry.name.startswith('.') and entry.is_dir())
+        for name in names:
+            directory = os.path.join(str(self._path), name)
+            yield name, self._scan_directory(directory,
+                                             self._fanout_depth - 1)
+
+    def _scan_directory(self, directory, depth):
+        """Yield :py:func:`os.scandir` entries for cached files `depth`
+        directory levels below `directory`.
+        """
+        suffix = '.' + self.backend.file_extension
+        try:
+            entries = scandir(directory)
+        except OSError as e:
+            # Deleted since the parent directory was read.
+            if e.errno != errno.ENOENT:
                 raise
-            else:
-                if not in_cache:
-                    del self._cache[key_hash]
-        return PrunedFilesInfo(size=totalsize, num=totalnum)
+            return
+
+        for entry in entries:
+            # Temporary files and the index start with a dot.
+            if entry.name.startswith('.'):
+                continue
+            if depth:
+                if entry.is_dir():
+                    for child in self._scan_directory(entry.path, depth - 1):
+                        yield child
+            elif entry.name.endswith(suffix) and entry.is_file():
+                yield entry
+
+    def _indexed_partitions(self):
+        """Yield ``(name, items)`` for each partition, where `items` is an
+        iterator of (key hash, :py:class:`~bucketcache.index.IndexEntry`)
+        pairs for files that have expired according to the index.
+        """
+        width = self._fanout_width if self._fanout_depth else 0
+
+        def partition(item):
+            return item[0][:width]
+
+        items = [item for item in self._index.items()
+                 if self._timestamp_has_expired(item[1].expiration)]
+        items.sort(key=partition)
+        for name, group in groupby(items, key=partition):
+            yield name, group
+
+    def _prune_scanned_file(self, entry):
+        """Delete file for :py:func:`os.scandir` entry if it has expired,
+        reading the expiration date from its modification time, or from its
+        metadata if necessary.
+
+        Returns:
+            ``(key_hash, size)``, or `None` if the file wasn't deleted.
+        """
+        file_path = Path(entry.path)
+        try:
+            # scandir entries cache their stat result on some platforms.
+            stat = entry.stat()
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+        try:
+            expired, filesize = self._file_has_expired(file_path, stat=stat)
+        except KeyInvalidError:
+            return None
+
+        if expired:
+            key_hash = file_path.stem
+            with self._key_locks.lock_for(key_hash):
+                if self._unlink_hash(key_hash):
+                    return key_hash, filesize
+        return None
+
+    def _prune_indexed_file(self, item):
+        """Delete file for expired (key hash,
+        :py:class:`~bucketcache.index.IndexEntry`) pair.
+
+        Returns:
+            ``(key_hash, size)``, or `None` if the file wasn't deleted.
+        """
+        key_hash, entry = item
+        with self._key_locks.lock_for(key_hash):
+            # The file may have been replaced since the index was read.
+            current = self._index.get(key_hash)
+            if current is None or current.expiration != entry.expiration:
+                return None
+            if self._unlink_hash(key_hash):
+                return key_hash, entry.size
+        return None
+
+    def _prune_leftover_files(self, throttle):
+        """Delete temporary files and lock files left behind by interrupted
+        processes, returning their total size and number.
+        """
+        totalsize = 0
+        totalnum = 0
+
+        temp_glob = '*/' * self._fanout_depth + '.*' + TEMPORARY_SUFFIX
+        cutoff = time.time() - self._temporary_file_lifetime
+        for f in self._path.glob(temp_glob):
+            if not throttle():
+                break
+            with suppress(OSError):
+                stat = f.stat()
+                if stat.st_mtime < cutoff and unlink_if_exists(f):
+                    totalsize += stat.st_size
+                    totalnum += 1
+
+        if fcntl_available:
+            # Lock files are removed when released, but can be left behind
+            # by processes that exit while holding them.
+            lock_glob = '*/' * self._fanout_depth + '*' + LOCK_SUFFIX
+            for f in self._path.glob(lock_glob):
+                if not throttle():
+                    break
+                with suppress(OSError):
+                    if f.stat().st_mtime < cutoff:
+                        with FileLock(f, timeout=0):
+                            pass
+
+        return totalsize, totalnum
+
+    def _run_maintenance(self, throttle, full=True):
+        """Do housekeeping for
+        :py:class:`~bucketcache.maintenance.MaintenanceWorker`.
+
+        Files over the disk limits are always evicted. A `full` run also
+        deletes expired files and compacts the index if it contains many
+        superseded records.
+        """
+        self._enforce_disk_limits(throttle=throttle)
+        if not full:
+            return
+
+        progress = None
+        for progress in self._iter_prune(throttle):
+            pass
+        if progress is not None and progress.num:
+            logger.info('Maintenance deleted {} expired files.', progress.num)
+
+        index = self._index
+        if index is not None:
+            index.flush()
+            if index.redundant_records > len(index) // 4 and throttle():
+                index.compact()
+
+    def _scan_files(self):
+        """Yield ``(key_hash, size, expiration, last_access)`` for each file,
+        to rebuild the index.
+        """
+        for f in self._path.glob(self._glob):
+            try:
+                expiration, stat = self._read_file_expiration(f)
+            except (KeyInvalidError, OSError):
+                continue
+            yield f.stem, stat.st_size, expiration, stat.st_atime
+
+    def disk_usage(self):
+        """Return total size and number of cached files.
+
+        If the bucket has an index, this doesn't need to scan the directory.
+
+        :rtype: :py:class:`~bucketcache.utilities.DiskUsage`
+        """
+        if self._index is not None:
+            size, num = self._index.usage()
+        else:
+            size = num = 0
+            for f in self._path.glob(self._glob):
+                with suppress(OSError):
+                    size += f.stat().st_size
+                    num += 1
+        return DiskUsage(size=size, num=num)
+
+    def migrate_layout(self):
+        """Move files saved with a different fan-out layout (e.g. before
+        `fanout_depth` was used) to their location in the current layout.
+
+        Returns:
+            Number of files moved.
+
+        .. note::
+
+            Only files with this bucket's backend file extension are moved.
+            Directories left empty by the migration are removed.
+        """
+        pattern = '*.{ext}'.format(ext=self.backend.file_extension)
+        moved = 0
+        old_directories = set()
+        for f in list(self._path.rglob(pattern)):
+            new_path = self._path_for_hash(f.stem)
+            if f == new_path:
+                continue
+            self._make_parent_directory(new_path)
+            os.rename(str(f), str(new_path))
+            old_directories.add(f.parent)
+            moved += 1
+
+        # Remove emptied directories, deepest first, stopping at the first
+        # directory that is still in use.
+        for directory in sorted(old_directories, key=lambda p: len(p.parts),
+                                reverse=True):
+            while directory != self._path:
+                try:
+                    directory.rmdir()
+                except OSError:
+                    break
+                directory = directory.parent
+
+        return moved
 
     def unload_key(self, key):
         """Remove key from memory, leaving file in place."""
         key_hash = self._hash_for_key(key)
-        if key in self:
-            del self._cache[key_hash]
+        with self._key_locks.lock_for(key_hash):
+            self._cache.pop(key_hash, None)
 
     def __call__(self, *args, **kwargs):
         """Use Bucket instance as a decorator.
@@ -323,9 +1494,67 @@ class Bucket(ReprHelperMixin, Container, object):
 
             get('spam')
             get('spam', log=True)  # Cache used even though arguments differ.
+
+        Use `lock=True` so that only one process calls the function when
+        there is a cache miss, while the others wait for its result. Locks
+        are held on lock files next to the cached files, which requires
+        :py:mod:`fcntl`.
+
+        .. code:: python
+
+            @bucket(lock=True, lock_timeout=60, stale_lock_timeout=600)
+            def expensive(a, b):
+                ...
+
+        `lock_timeout` is the maximum time to wait for another process before
+        calling the function anyway (by default, wait indefinitely).
+        `stale_lock_timeout` is the time after which a lock is assumed to be
+        held by a hung process, and is broken. Both can be given in seconds
+        or as :py:class:`~datetime.timedelta`.
+
+        Use `stale_while_revalidate` to return cached results for a grace
+        period after they expire, while the function is called in a
+        background thread to replace them.
+
+        .. code:: python
+
+            @bucket(stale_while_revalidate=timedelta(minutes=5))
+            def get(name):
+                ...
+
+        Use `cache_exceptions` to cache exceptions of the given types raised
+        by the function, so that calls with the same arguments raise them
+        again without calling the function. `exception_lifetime` is a
+        shorter lifetime for cached exceptions (by default, the bucket's
+        lifetime). The backend must be able to serialize the exceptions,
+        e.g. :py:class:`~bucketcache.backends.PickleBackend`.
+
+        .. code:: python
+
+            @bucket(cache_exceptions=(LookupError, ValueError),
+                    exception_lifetime=timedelta(minutes=1))
+            def fetch(name):
+                ...
+
+        Coroutine functions are awaited, and their results are cached.
+        Concurrent calls on the same event loop for a missing key await a
+        single call. File I/O is done in an executor if the bucket is thread
+        safe (e.g. :py:class:`~bucketcache.AsyncBucket`), or blocks the event
+        loop otherwise.
+
+        .. code:: python
+
+            @bucket
+            async def fetch(url):
+                ...
         """
         f = None
-        default_kwargs = {'method': False, 'nocache': None, 'ignore': None}
+        default_kwargs = {'method': False, 'nocache': None, 'ignore': None,
+                          'lock': False, 'lock_timeout': None,
+                          'stale_lock_timeout': None,
+                          'stale_while_revalidate': None,
+                          'cache_exceptions': None,
+                          'exception_lifetime': None}
 
         error = ('To use an instance of {}() as a decorator, '
                  'use @bucket or @bucket(<args>) '
@@ -358,21 +1587,20 @@ class Bucket(ReprHelperMixin, Container, object):
                            'Invalid decorator argument{s}: {keys}')
 
         kwargs.update({k: default_kwargs[k] for k in missing_kwargs})
-        method = kwargs['method']
-        nocache = kwargs['nocache']
-        ignore = kwargs['ignore']
+
+        if kwargs['lock'] and not fcntl_available:
+            raise TypeError('lock=True requires the fcntl module, which is '
+                            'not available on this platform.')
 
         if f:
             # We've been passed f as a standard decorator. Instantiate cached
             # function class and return the decorator.
-            cf = DecoratorFactory(bucket=self, method=method, nocache=nocache,
-                                  ignore=ignore)
+            cf = DecoratorFactory(bucket=self, **kwargs)
             return cf.decorate(f)
         else:
             # We've been called with decorator arguments, so we need to return
             # a function that makes a decorator.
-            cf = DecoratorFactory(bucket=self, method=method, nocache=nocache,
-                                  ignore=ignore)
+            cf = DecoratorFactory(bucket=self, **kwargs)
 
             def make_decorator(f):
                 return cf.decorate(f)
@@ -390,26 +1618,152 @@ class Bucket(ReprHelperMixin, Container, object):
 
     def _path_for_hash(self, key_hash):
         filename = '{}.{}'.format(key_hash, self.backend.file_extension)
-        return self._path / filename
+        width = self._fanout_width
+        directories = [key_hash[i * width:(i + 1) * width]
+                       for i in range(self._fanout_depth)]
+        return self._path.joinpath(*directories) / filename
+
+    def _lock_for_hash(self, key_hash, timeout=None, stale_timeout=None):
+        """Return :py:class:`~bucketcache.locks.FileLock` for `key_hash`,
+        which can be used to serialize work on the key between processes.
+        """
+        file_path = self._path_for_hash(key_hash)
+        self._make_parent_directory(file_path)
+        lock_path = file_path.with_name(file_path.name + LOCK_SUFFIX)
+        return FileLock(lock_path, timeout=timeout,
+                        stale_timeout=stale_timeout)
 
-    def _hash_for_key(self, key):
+    @property
+    def _glob(self):
+        """Glob pattern matching cached files in the current layout."""
+        return '*/' * self._fanout_depth + '*.' + self.backend.file_extension
+
+    @staticmethod
+    def _make_parent_directory(file_path):
+        try:
+            file_path.parent.mkdir(parents=True)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _key_prefix(self, items=(), size=None):
+        """Return :py:class:`~bucketcache.utilities.KeyPrefix` for
+        :py:meth:`_hash_for_key`, for keys that are tuples of `size` items
+        starting with `items`.
+
+        The backend name and the bytes for `items` are hashed now, and the
+        hash objects are copied for each key. Without `size`, only the
+        backend name is hashed, and keys can be any object.
+        """
+        items = tuple(items)
+        split = None
+        if size is not None:
+            split = self.keymaker.split_tuple_key(items, size)
+        if split is None:
+            if items:
+                # The key maker can't split keys, so the whole key is
+                # hashed each time.
+                return KeyPrefix(items, self.backend, self.keymaker,
+                                 write_rest=None, hash_obj=None,
+                                 legacy_hash_obj=None)
+            head, write_rest = b'', self.keymaker.write_key
+        else:
+            head, write_rest = split
+
+        seed = self.backend.__name__.encode('utf-8')
+        hash_obj = self._key_hasher.new(seed + head)
+        legacy_hash_obj = None
+        if self._legacy_hasher is not None:
+            legacy_hash_obj = self._legacy_hasher.new(seed + head)
+        return KeyPrefix(items, self.backend, self.keymaker, write_rest,
+                         hash_obj, legacy_hash_obj)
+
+    def _hash_for_key(self, key, prefix=None):
+        """Return key hash for `key`. If `prefix` is given (see
+        :py:meth:`_key_prefix`), `key` is the rest of the items of the
+        tuple to hash.
+        """
         if logger_config.log_full_keys:
             dkey = key
         else:
             dkey = DV(lambda: self._abbreviate(key))
         logger.debug('_hash_for_key <{}>', dkey)
 
-        md5hash = md5(self.backend.__name__.encode('utf-8'))
-        for batch in self.keymaker.make_key(key):
+        if prefix is not None and (prefix.write_rest is None or
+                                   prefix.backend is not self.backend or
+                                   prefix.keymaker is not self.keymaker):
+            key = prefix.items + tuple(key)
+            prefix = None
+        if prefix is None:
+            prefix = self._seed_key_prefix
+            if (prefix is None or prefix.backend is not self.backend or
+                    prefix.keymaker is not self.keymaker):
+                prefix = self._seed_key_prefix = self._key_prefix()
+
+        hash_obj = prefix.hash_obj.copy()
+        legacy_hash_obj = prefix.legacy_hash_obj
+        if legacy_hash_obj is not None:
+            legacy_hash_obj = legacy_hash_obj.copy()
+
+        def update(batch):
             if logger_config.log_full_keys:
                 logger.debug('_hash_for_key received bytes: {}', batch)
-            md5hash.update(batch)
+            hash_obj.update(batch)
+            if legacy_hash_obj is not None:
+                legacy_hash_obj.update(batch)
 
-        digest = md5hash.hexdigest()
+        prefix.write_rest(key, update)
+
+        digest = self._key_hasher.encode(hash_obj)
         logger.debug('_hash_for_key finished with digest {}', digest)
 
+        if legacy_hash_obj is not None and digest not in self._cache:
+            # Remembered for _call_with_legacy_hash, which moves the object
+            # saved with the legacy hash if digest isn't found.
+            if len(self._legacy_hashes) >= self._max_legacy_hashes:
+                self._legacy_hashes.clear()
+            self._legacy_hashes[digest] = self._legacy_hasher.encode(
+                legacy_hash_obj)
+
         return digest
 
+    def _call_with_legacy_hash(self, function, key_hash, **kwargs):
+        """Return ``function(key_hash, **kwargs)``. If it raises
+        :py:exc:`~bucketcache.exceptions.KeyFileNotFoundError` and
+        `md5_compat` is enabled, the object saved with the key's legacy hash
+        is moved to `key_hash`, and `function` is called again.
+        """
+        try:
+            return function(key_hash, **kwargs)
+        except KeyFileNotFoundError:
+            legacy_hash = self._legacy_hashes.pop(key_hash, None)
+            if legacy_hash is None:
+                raise
+        self._adopt_legacy_hash(legacy_hash, key_hash)
+        return function(key_hash, **kwargs)
+
+    def _adopt_legacy_hash(self, legacy_hash, key_hash):
+        """Move object saved with `legacy_hash` to `key_hash`, unless there
+        is already an object for `key_hash`. Used by `md5_compat`.
+        """
+        file_path = self._path_for_hash(key_hash)
+        legacy_path = self._path_for_hash(legacy_hash)
+        if file_path.exists() or not legacy_path.exists():
+            return
+
+        with self._key_locks.lock_for(key_hash):
+            self._make_parent_directory(file_path)
+            if not link_or_rename(legacy_path, file_path):
+                # Moved by another thread or process, or replaced by a new
+                # object.
+                return
+            logger.info('Moved md5 file {} to {}', legacy_path, file_path)
+            if self._index is not None:
+                with suppress(KeyInvalidError, OSError):
+                    expiration, stat = self._read_file_expiration(file_path)
+                    self._index.discard(legacy_hash)
+                    self._index.set(key_hash, stat.st_size, expiration)
+
     @staticmethod
     def _abbreviate(obj):
         string = repr(obj)
@@ -418,9 +1772,11 @@ class Bucket(ReprHelperMixin, Container, object):
         else:
             return string
 
-    def _object_expiration_date(self):
-        if self.lifetime:
-            return datetime.utcnow() + self.lifetime
+    def _object_expiration_date(self, lifetime=None):
+        if lifetime is None:
+            lifetime = self.lifetime
+        if lifetime:
+            return datetime.utcnow() + lifetime
         else:
             return None
 
@@ -436,6 +1792,31 @@ class Bucket(ReprHelperMixin, Container, object):
         r.keyword_with_value('path', str(self.path))
         r.keyword_from_attr('config')
         r.keyword_with_value('backend', self.backend.__name__, raw=True)
+        if self.fanout_depth:
+            r.keyword_from_attr('fanout_depth')
+            r.keyword_from_attr('fanout_width')
+        if self.index:
+            r.keyword_from_attr('index')
+        if self.max_disk_bytes is not None:
+            r.keyword_from_attr('max_disk_bytes')
+        if self.max_disk_entries is not None:
+            r.keyword_from_attr('max_disk_entries')
+        if self.disk_policy != 'lru':
+            r.keyword_from_attr('disk_policy')
+        if self.maintenance_interval is not None:
+            r.keyword_from_attr('maintenance_interval')
+        if self.maintenance_io_rate is not None:
+            r.keyword_from_attr('maintenance_io_rate')
+        if self.compression is not None:
+            r.keyword_from_attr('compression')
+        if self.hash_algorithm != 'md5':
+            r.keyword_from_attr('hash_algorithm')
+        if self.hash_digest_size is not None:
+            r.keyword_from_attr('hash_digest_size')
+        if self.hash_encoding != 'hex':
+            r.keyword_from_attr('hash_encoding')
+        if self.md5_compat:
+            r.keyword_from_attr('md5_compat')
         if self.lifetime:
             for attr in ('days', 'seconds', 'microseconds'):
                 value = getattr(self.lifetime, attr)
@@ -447,19 +1828,68 @@ class DeferredWriteBucket(Bucket):
     """Alternative implementation of :py:class:`~bucketcache.buckets.Bucket`
     that defers writing to file until
     :py:meth:`~bucketcache.buckets.DeferredWriteBucket.sync` is called.
+
+    Objects waiting to be written are kept until the next sync, even if they
+    are evicted from the bucket's in-memory cache.
     """
+    def __init__(self, *args, **kwargs):
+        super(DeferredWriteBucket, self).__init__(*args, **kwargs)
+        self._pending = dict()
+
     @classmethod
     def from_bucket(cls, bucket):
+        if not bucket._file_per_object:
+            # The objects would be written to files that the bucket never
+            # reads.
+            raise TypeError('Writes to {} cannot be deferred.'.format(
+                type(bucket).__name__))
+
+        # The memory cache, key locks and index are shared with the original
+        # bucket, so they aren't created here. An index could need a full
+        # scan of the directory to open.
         self = cls(path=bucket.path, backend=bucket.backend,
                    config=bucket.config, keymaker=bucket.keymaker,
-                   lifetime=bucket.lifetime)
+                   lifetime=bucket.lifetime,
+                   fanout_depth=bucket.fanout_depth,
+                   fanout_width=bucket.fanout_width,
+                   disk_policy=bucket.disk_policy,
+                   hash_algorithm=bucket.hash_algorithm,
+                   hash_digest_size=bucket.hash_digest_size,
+                   hash_encoding=bucket.hash_encoding,
+                   md5_compat=bucket.md5_compat)
         self._cache = bucket._cache
+        self._key_locks = bucket._key_locks
+        self._thread_safe = bucket.thread_safe
+        self._index = bucket._index
+        self._max_disk_bytes = bucket.max_disk_bytes
+        self._max_disk_entries = bucket.max_disk_entries
+        # Housekeeping is left to the original bucket's thread.
+        self._maintenance = bucket._maintenance
         return self
 
     def _set_obj_with_hash(self, key_hash, obj):
         """Reimplement Bucket._set_obj_with_hash to skip writing to file."""
+        self._pending[key_hash] = obj
         self._cache[key_hash] = obj
 
+    def _set_objs_with_hashes(self, objs):
+        for key_hash, obj in objs:
+            self._set_obj_with_hash(key_hash, obj)
+
+    def _forget_hash(self, key_hash):
+        pending = self._pending.pop(key_hash, None) is not None
+        in_memory = super(DeferredWriteBucket, self)._forget_hash(key_hash)
+        return in_memory or pending
+
+    def _get_obj_from_hash(self, key_hash, load_file=True, stale_grace=None):
+        # An unsynced object may have been evicted from memory, in which case
+        # the file is missing or out of date.
+        obj = self._pending.get(key_hash)
+        if obj is not None and key_hash not in self._cache:
+            self._cache[key_hash] = obj
+        return super(DeferredWriteBucket, self)._get_obj_from_hash(
+            key_hash, load_file=load_file, stale_grace=stale_grace)
+
     def unload_key(self, key):
         """Remove key from memory, leaving file in place.
 
@@ -470,13 +1900,27 @@ class DeferredWriteBucket(Bucket):
 
     def sync(self):
         """Commit deferred writes to file."""
-        for key_hash, obj in six.iteritems(self._cache):
-            # Objects are checked for expiration in __getitem__,
-            # but we can check here to avoid unnecessary writes.
-            if not obj.has_expired():
-                file_path = self._path_for_hash(key_hash)
-                with open(str(file_path), self._write_mode) as f:
-                    obj.dump(f)
+        for key_hash, obj in list(six.iteritems(self._pending)):
+            with self._key_locks.lock_for(key_hash):
+                # Another thread may have synced or replaced this object.
+                if self._pending.get(key_hash) is not obj:
+                    continue
+                # Objects are checked for expiration in __getitem__,
+                # but we can check here to avoid unnecessary writes.
+                if not obj.has_expired():
+                    self._write_obj_with_hash(key_hash, obj)
+                del self._pending[key_hash]
+
+
+def _no_throttle():
+    return True
+
+
+def _obj_sizeof(obj):
+    """Estimate memory used by a backend object that hasn't been written to
+    file yet.
+    """
+    return sys.getsizeof(obj.value)
 
 
 @contextmanager
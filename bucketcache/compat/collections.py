@@ -0,0 +1,7 @@
+"""collections.abc functionality from Python 3"""
+from __future__ import absolute_import
+
+try:
+    from collections.abc import Container, MutableMapping
+except ImportError:
+    from collections import Container, MutableMapping
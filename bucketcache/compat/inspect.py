@@ -0,0 +1,12 @@
+"""inspect functionality from Python 3"""
+from __future__ import absolute_import
+
+try:
+    from inspect import iscoroutinefunction
+except ImportError:
+    def iscoroutinefunction(function):
+        """Return true if the object is a coroutine function.
+
+        Coroutine functions can't be defined before Python 3.5.
+        """
+        return False
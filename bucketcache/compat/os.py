@@ -0,0 +1,31 @@
+"""os functionality from Python 3"""
+from __future__ import absolute_import
+
+import os
+import sys
+
+try:
+    from os import replace
+except ImportError:
+    if sys.platform == 'win32':
+        import ctypes
+
+        _MOVEFILE_REPLACE_EXISTING = 0x1
+        _MOVEFILE_WRITE_THROUGH = 0x8
+
+        def replace(src, dst):
+            """Rename the file or directory src to dst. If dst is a file, it
+            will be replaced silently if the user has permission.
+            """
+            flags = _MOVEFILE_REPLACE_EXISTING | _MOVEFILE_WRITE_THROUGH
+            if not ctypes.windll.kernel32.MoveFileExW(
+                    unicode(src), unicode(dst), flags):
+                raise ctypes.WinError()
+    else:
+        # rename() replaces dst atomically on POSIX.
+        replace = os.rename
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
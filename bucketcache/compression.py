@@ -0,0 +1,221 @@
+from __future__ import absolute_import, division, print_function
+
+import bz2
+import io
+import locale
+import zlib
+from collections import namedtuple
+
+import six
+from represent import autorepr
+
+from .exceptions import BackendLoadError
+from .utilities import NamedBytesIO
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    # Python 3.14+
+    from compression import zstd
+except ImportError:
+    zstd = None
+
+__all__ = ('Compression', 'compressed_backend')
+
+# Compressed files start with MAGIC and a codec ID. No provided backend's
+# files start with a null byte, so files can be stored uncompressed
+# alongside compressed ones.
+MAGIC = b'\x00BCZ'
+
+_Codec = namedtuple('_Codec', ['id', 'compress', 'decompressor'])
+
+
+def _zlib_compress(data, level):
+    return zlib.compress(data, 6 if level is None else level)
+
+
+def _bz2_compress(data, level):
+    return bz2.compress(data, 9 if level is None else level)
+
+
+def _lzma_compress(data, level):
+    return lzma.compress(data, preset=level)
+
+
+def _zstd_compress(data, level):
+    return zstd.compress(data, level=level)
+
+
+_codecs = {
+    'zlib': _Codec(b'\x01', _zlib_compress, zlib.decompressobj),
+    'bz2': _Codec(b'\x02', _bz2_compress, bz2.BZ2Decompressor),
+}
+
+if lzma is not None:
+    _codecs['lzma'] = _Codec(b'\x03', _lzma_compress, lzma.LZMADecompressor)
+
+if zstd is not None:
+    _codecs['zstd'] = _Codec(b'\x04', _zstd_compress, zstd.ZstdDecompressor)
+
+_codecs_by_id = {codec.id: codec for codec in _codecs.values()}
+
+
+@autorepr
+class Compression(object):
+    """Compression settings for :py:func:`compressed_backend`.
+
+    Parameters:
+        codec: Name of codec: ``'zlib'``, ``'bz2'``, ``'lzma'`` (if the
+               :py:mod:`lzma` module is available) or ``'zstd'`` (Python
+               3.14+).
+        level: Compression level, or `None` for the codec's default.
+        threshold: Size in bytes below which serialized objects are stored
+                   uncompressed.
+
+    Objects are also stored uncompressed if compression doesn't make them
+    smaller.
+    """
+    def __init__(self, codec='zlib', level=None, threshold=1024):
+        if codec not in _codecs:
+            raise ValueError(
+                'Unknown or unavailable codec: {!r}'.format(codec))
+        if threshold < 0:
+            raise ValueError('threshold cannot be negative.')
+
+        self.codec = codec
+        self.level = level
+        self.threshold = threshold
+
+
+def compressed_backend(backend, compression='zlib'):
+    """Return subclass of `backend` that compresses files.
+
+    Parameters:
+        backend: :py:class:`~bucketcache.backends.Backend` subclass.
+        compression: :py:class:`Compression` instance, or codec name.
+
+    The subclass has the same name and file extension as `backend`, so keys
+    are stored in the same files whether or not compression is used, and
+    either can read files written by the other as long as they are
+    uncompressed. Files are read correctly whichever codec wrote them.
+    """
+    if isinstance(compression, six.string_types):
+        compression = Compression(compression)
+
+    codec = _codecs[compression.codec]
+    inner_binary = backend.binary_format
+
+    class CompressedBackend(backend):
+        binary_format = True
+
+        @classmethod
+        def from_file(cls, fp, config=None):
+            stream = _decompressed_stream(fp, inner_binary, read_all=True)
+            return super(CompressedBackend, cls).from_file(
+                stream, config=config)
+
+        @classmethod
+        def metadata_from_file(cls, fp, config=None):
+            stream = _decompressed_stream(fp, inner_binary, read_all=False)
+            return super(CompressedBackend, cls).metadata_from_file(
+                stream, config=config)
+
+        def dump(self, fp):
+            if inner_binary:
+                buffer = io.BytesIO()
+            else:
+                buffer = six.StringIO()
+            super(CompressedBackend, self).dump(buffer)
+            data = buffer.getvalue()
+            if isinstance(data, six.text_type):
+                data = data.encode(_text_encoding())
+
+            if len(data) >= compression.threshold:
+                compressed = codec.compress(data, compression.level)
+                if len(MAGIC) + 1 + len(compressed) < len(data):
+                    fp.write(MAGIC + codec.id)
+                    fp.write(compressed)
+                    return
+            fp.write(data)
+
+    CompressedBackend.compression = compression
+    CompressedBackend.__name__ = backend.__name__
+    return CompressedBackend
+
+
+def _text_encoding():
+    # Uncompressed files must be readable by the text mode files used for
+    # backends that aren't binary, which use the preferred encoding.
+    return locale.getpreferredencoding(False)
+
+
+def _decompressed_stream(fp, binary, read_all):
+    """Return stream of the data in `fp`, decompressing it if it starts with
+    :py:data:`MAGIC`. `read_all` decompresses all of it at once, otherwise
+    it is decompressed as it is read.
+    """
+    name = getattr(fp, 'name', None)
+    compressed = fp.read(len(MAGIC)) == MAGIC
+    if compressed:
+        codec = _codecs_by_id.get(fp.read(1))
+        if codec is None:
+            raise BackendLoadError(
+                '{!r} was compressed with an unknown codec.'.format(name))
+
+        raw = _DecompressingReader(fp, codec.decompressor(), name)
+        if read_all:
+            stream = NamedBytesIO(_read_all(raw), name)
+        else:
+            stream = io.BufferedReader(raw)
+    else:
+        fp.seek(0)
+        if binary:
+            return fp
+        stream = NamedBytesIO(fp.read(), name)
+
+    if binary:
+        return stream
+    return io.TextIOWrapper(stream, encoding=_text_encoding())
+
+
+def _read_all(raw):
+    chunks = []
+    while True:
+        chunk = raw.read(65536)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
+class _DecompressingReader(io.RawIOBase):
+    """Read-only raw stream of the data decompressed from `fp`."""
+    def __init__(self, fp, decompressor, name):
+        super(_DecompressingReader, self).__init__()
+        self.name = name
+        self._fp = fp
+        self._decompressor = decompressor
+        self._buffer = b''
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._position == len(self._buffer):
+            chunk = self._fp.read(65536)
+            if not chunk:
+                return 0
+            try:
+                self._buffer = self._decompressor.decompress(chunk)
+            except (IOError, OSError, ValueError, EOFError, zlib.error):
+                raise BackendLoadError(
+                    '{!r} could not be decompressed.'.format(self.name))
+            self._position = 0
+
+        n = min(len(b), len(self._buffer) - self._position)
+        b[:n] = self._buffer[self._position:self._position + n]
+        self._position += n
+        return n
@@ -24,7 +24,12 @@ class PickleConfig(BackendConfig):
     """Configuration class for :py:class:`~bucketcache.backends.PickleBackend`
 
     Parameters reflect those given to :py:func:`pickle.dump` and
-    :py:func:`pickle.load`.
+    :py:func:`pickle.load`, except for `buffer_threshold`.
+
+    With `buffer_threshold`, buffers of at least that many bytes (e.g. large
+    NumPy arrays) are written out-of-band after the pickle stream, aligned to
+    page boundaries. When loaded, they are memory-mapped read-only instead of
+    copied. This requires protocol 5 (Python 3.8+).
 
     .. note::
 
@@ -35,12 +40,17 @@ class PickleConfig(BackendConfig):
         - `errors`
     """
     def __init__(self, protocol=2, fix_imports=True,
-                 encoding='ASCII', errors='strict'):
+                 encoding='ASCII', errors='strict', buffer_threshold=None):
+
+        if buffer_threshold is not None and protocol < 5:
+            raise ValueError('buffer_threshold requires protocol 5 or '
+                             'higher.')
 
         self.protocol = protocol
         self.fix_imports = fix_imports
         self.encoding = encoding
         self.errors = errors
+        self.buffer_threshold = buffer_threshold
 
         super(PickleConfig, self).__init__()
 
@@ -4,6 +4,7 @@ __all__ = (
     'KeyInvalidError',
     'KeyFileNotFoundError',
     'KeyExpirationError',
+    'KeyStaleError',
     'BackendLoadError',
 )
 
@@ -20,6 +21,17 @@ class KeyExpirationError(KeyInvalidError):
     """Raised when key has expired."""
 
 
+class KeyStaleError(KeyExpirationError):
+    """Raised when key has expired, but is within the grace period in which
+    it can be used while being revalidated.
+
+    The expired object is available as the `obj` attribute.
+    """
+    def __init__(self, message, obj):
+        super(KeyStaleError, self).__init__(message)
+        self.obj = obj
+
+
 class BackendLoadError(Exception):
     """Raised when :py:meth:`bucketcache.backends.Backend.from_file` cannot
     load an object.
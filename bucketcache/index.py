@@ -0,0 +1,358 @@
+from __future__ import absolute_import, division, print_function
+
+import errno
+import os
+import random
+import threading
+import time
+from collections import namedtuple
+
+from .log import logger
+from .utilities import atomic_open
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+__all__ = ()
+
+# Formatted with the backend's file extension, so buckets with different
+# backends in the same directory have separate indexes.
+INDEX_NAME = '.{}.index'
+
+IndexEntry = namedtuple(
+    'IndexEntry', ['size', 'expiration', 'last_access', 'hits'])
+
+
+class IndexCorruptError(Exception):
+    pass
+
+
+class ManifestIndex(object):
+    """Append-only log of the files in a bucket, with their size, expiration
+    date and last access.
+
+    Parameters:
+        path: Path of index file.
+        scan: Function returning an iterable of
+              ``(key_hash, size, expiration, last_access)`` for every file,
+              used to rebuild the index if the file is missing or corrupt.
+              Times are POSIX timestamps, and `expiration` is `None` if the
+              file never expires.
+
+    Each change is appended to the file as a line of text, so that processes
+    sharing a bucket see each other's changes. Accesses are buffered and
+    written in batches. When the log is much longer than the number of
+    entries, it is rewritten with one line per entry.
+
+    On platforms with :py:mod:`fcntl`, appends hold a shared lock on the file
+    and rewrites hold an exclusive lock, so that no changes are lost.
+    """
+    _header = b'bucketcache-index 1\n'
+
+    # Number of buffered accesses that triggers a write.
+    _flush_threshold = 64
+
+    # Minimum number of records before the log is rewritten.
+    _compact_min_records = 1024
+
+    def __init__(self, path, scan):
+        self.path = str(path)
+        self._scan = scan
+        self._lock = threading.RLock()
+        self._entries = None
+        self._keys = None
+        self._positions = None
+        self._size = 0
+        self._buffer = []
+        self._offset = 0
+        self._file_id = None
+        self._records = 0
+
+    def get(self, key_hash):
+        """Return :py:class:`IndexEntry` for `key_hash`, or `None`."""
+        with self._lock:
+            self._ensure_loaded()
+            return self._entries.get(key_hash)
+
+    def items(self):
+        """Return list of (key hash, :py:class:`IndexEntry`) pairs, including
+        changes made by other processes.
+        """
+        with self._lock:
+            self.flush()
+            return list(self._entries.items())
+
+    def usage(self):
+        """Return total size and number of files, including changes made by
+        other processes.
+        """
+        with self._lock:
+            self.flush()
+            return self._size, len(self._entries)
+
+    @property
+    def size(self):
+        """Total size of files, as of the last read of the index."""
+        with self._lock:
+            self._ensure_loaded()
+            return self._size
+
+    def __len__(self):
+        with self._lock:
+            self._ensure_loaded()
+            return len(self._entries)
+
+    @property
+    def redundant_records(self):
+        """Number of records in the log superseded by later records, as of
+        the last read of the index.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            return self._records - len(self._entries)
+
+    def sample(self, k):
+        """Return list of up to `k` random (key hash,
+        :py:class:`IndexEntry`) pairs.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            keys = random.sample(self._keys, min(k, len(self._keys)))
+            return [(key_hash, self._entries[key_hash]) for key_hash in keys]
+
+    def set(self, key_hash, size, expiration):
+        """Record file for `key_hash` being written."""
+        entry = IndexEntry(size, expiration, time.time(), 0)
+        self._write(_entry_line(key_hash, entry))
+
+    def discard(self, key_hash):
+        """Record file for `key_hash` being deleted."""
+        self._write('D {}\n'.format(key_hash))
+
+    def touch(self, key_hash):
+        """Record access to file for `key_hash`. Accesses are written in
+        batches.
+        """
+        with self._lock:
+            self._buffer.append('A {} {:.3f}\n'.format(key_hash, time.time()))
+            if len(self._buffer) >= self._flush_threshold:
+                self.flush()
+
+    def flush(self):
+        """Write buffered accesses, and read changes made by other
+        processes.
+        """
+        self._write('')
+
+    def rebuild(self):
+        """Replace index with one made from a directory scan."""
+        with self._lock:
+            logger.info('Rebuilding index: {}', self.path)
+            entries = dict()
+            for key_hash, size, expiration, last_access in self._scan():
+                entries[key_hash] = IndexEntry(
+                    size, expiration, last_access, 0)
+            self._replace(entries)
+
+    def compact(self):
+        """Rewrite the log with one line per entry."""
+        with self._lock:
+            fd = self._open()
+            try:
+                self._flock(fd, exclusive=True)
+                if self._file_id != _file_id(os.fstat(fd)):
+                    # Replaced by another process.
+                    return
+                self._read(fd)
+                self._replace(self._entries)
+            except IndexCorruptError:
+                self.rebuild()
+            finally:
+                os.close(fd)
+
+    def _replace(self, entries):
+        with atomic_open(self.path) as f:
+            f.write(self._header)
+            for key_hash, entry in entries.items():
+                f.write(_entry_line(key_hash, entry).encode('ascii'))
+            f.flush()
+            file_id = _file_id(os.fstat(f.fileno()))
+            offset = f.tell()
+        self._reset(entries.items())
+        self._file_id = file_id
+        self._offset = offset
+        self._records = len(entries)
+
+    def _ensure_loaded(self):
+        if self._entries is not None:
+            return
+        try:
+            fd = self._open()
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.rebuild()
+            return
+        try:
+            self._read(fd)
+        except IndexCorruptError:
+            logger.warning('Index is corrupt: {}', self.path)
+            self.rebuild()
+        finally:
+            os.close(fd)
+
+    def _write(self, line):
+        with self._lock:
+            self._ensure_loaded()
+            data = ''.join(self._buffer) + line
+            while True:
+                try:
+                    fd = self._open(append=True)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    self.rebuild()
+                    continue
+                try:
+                    self._flock(fd, exclusive=False)
+                    if not self._is_current(fd):
+                        # Replaced by compaction or a rebuild. Start again
+                        # with the new file.
+                        continue
+                    if data:
+                        os.write(fd, data.encode('ascii'))
+                        data = ''
+                    self._read(fd)
+                except IndexCorruptError:
+                    logger.warning('Index is corrupt: {}', self.path)
+                    self.rebuild()
+                    continue
+                finally:
+                    os.close(fd)
+                break
+
+            del self._buffer[:]
+            if self._records > max(self._compact_min_records,
+                                   2 * len(self._entries)):
+                self.compact()
+
+    def _open(self, append=False):
+        if append:
+            return os.open(self.path, os.O_RDWR | os.O_APPEND)
+        return os.open(self.path, os.O_RDONLY)
+
+    @staticmethod
+    def _flock(fd, exclusive):
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+    def _is_current(self, fd):
+        try:
+            stat = os.stat(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return _file_id(stat) == _file_id(os.fstat(fd))
+
+    def _read(self, fd):
+        """Apply records in `fd` that haven't been read yet."""
+        file_id = _file_id(os.fstat(fd))
+        if file_id != self._file_id:
+            self._reset()
+            self._offset = 0
+            self._records = 0
+            self._file_id = file_id
+
+        chunks = []
+        os.lseek(fd, self._offset, os.SEEK_SET)
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        data = b''.join(chunks)
+
+        start = 0
+        if self._offset == 0:
+            if not data.startswith(self._header):
+                raise IndexCorruptError
+            start = len(self._header)
+
+        # A final line without a newline is being written by another process,
+        # or was cut short by a crash. Leave it until it's complete.
+        end = data.rfind(b'\n') + 1
+        if end <= start:
+            self._offset += start
+            return
+
+        try:
+            for line in data[start:end].decode('ascii').splitlines():
+                self._apply(line.split(' '))
+        except (ValueError, IndexError, UnicodeDecodeError):
+            raise IndexCorruptError
+        self._offset += end
+
+    def _apply(self, fields):
+        kind, key_hash = fields[0], fields[1]
+        if kind == 'S':
+            expiration = None if fields[3] == '-' else float(fields[3])
+            self._put(key_hash, IndexEntry(
+                int(fields[2]), expiration, float(fields[4]), int(fields[5])))
+        elif kind == 'A':
+            entry = self._entries.get(key_hash)
+            if entry is not None:
+                self._entries[key_hash] = entry._replace(
+                    last_access=float(fields[2]), hits=entry.hits + 1)
+        elif kind == 'D':
+            self._remove(key_hash)
+        else:
+            raise ValueError(kind)
+        self._records += 1
+
+    def _reset(self, entries=()):
+        self._entries = dict()
+        # Keys are also kept in a list, so they can be sampled quickly.
+        self._keys = []
+        self._positions = dict()
+        self._size = 0
+        for key_hash, entry in entries:
+            self._put(key_hash, entry)
+
+    def _put(self, key_hash, entry):
+        old_entry = self._entries.get(key_hash)
+        if old_entry is None:
+            self._positions[key_hash] = len(self._keys)
+            self._keys.append(key_hash)
+        else:
+            self._size -= old_entry.size
+        self._entries[key_hash] = entry
+        self._size += entry.size
+
+    def _remove(self, key_hash):
+        entry = self._entries.pop(key_hash, None)
+        if entry is None:
+            return
+        self._size -= entry.size
+
+        # Move the last key into the removed key's place.
+        position = self._positions.pop(key_hash)
+        last_key = self._keys.pop()
+        if last_key != key_hash:
+            self._keys[position] = last_key
+            self._positions[last_key] = position
+
+
+def _entry_line(key_hash, entry):
+    if entry.expiration is None:
+        expiration = '-'
+    else:
+        expiration = '{:.6f}'.format(entry.expiration)
+    return 'S {} {} {} {:.3f} {}\n'.format(
+        key_hash, entry.size, expiration, entry.last_access, entry.hits)
+
+
+def _file_id(stat):
+    return stat.st_dev, stat.st_ino
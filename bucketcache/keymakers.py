@@ -1,8 +1,10 @@
 from __future__ import absolute_import, division, print_function
 
 import json
+import types
 from abc import ABCMeta, abstractmethod
 from functools import partial
+from operator import itemgetter
 from tempfile import TemporaryFile
 
 import six
@@ -13,6 +15,7 @@ from .compat.contextlib import suppress
 __all__ = (
     'DefaultKeyMaker',
     'StreamingDefaultKeyMaker',
+    'StructuralKeyMaker',
 )
 
 
@@ -31,6 +34,29 @@ class KeyMaker(object):
         """
         raise NotImplementedError
 
+    def write_key(self, obj, write):
+        """Make key from passed object, passing each batch of bytes to
+        `write`, such as the ``update`` method of a hash object.
+
+        Buckets hash keys with this method. By default, it writes the bytes
+        yielded by :py:meth:`make_key`.
+        """
+        for batch in self.make_key(obj):
+            write(batch)
+
+    def split_tuple_key(self, prefix, size):
+        """Split the keys of tuples of `size` items that start with the
+        items in `prefix`, so that the bytes for `prefix` can be hashed once
+        and reused.
+
+        Returns:
+            `None` if keys can't be split, which is the default. Otherwise, a
+            tuple of the bytes that the key of every such tuple starts with,
+            and a function ``write_rest(items, write)`` that writes the rest
+            of the key, like :py:meth:`write_key`, for the remaining items.
+        """
+        return None
+
 
 @autorepr
 class DefaultKeyMaker(KeyMaker):
@@ -46,23 +72,383 @@ class DefaultKeyMaker(KeyMaker):
     def __init__(self, sort_keys=True):
         self.sort_keys = sort_keys
 
+    @property
+    def sort_keys(self):
+        return self._encoder.sort_keys
+
+    @sort_keys.setter
+    def sort_keys(self, value):
+        # json.dumps creates an encoder for every call. Encoders don't keep
+        # state between calls, so one is reused for every key instead.
+        self._encoder = _AnyObjectJSONEncoder(sort_keys=value)
+
     def make_key(self, obj):
-        keystr = json.dumps(
-            obj, sort_keys=self.sort_keys, cls=_AnyObjectJSONEncoder)
-        yield keystr.encode('utf-8')
+        yield self._encoder.encode(obj).encode('utf-8')
+
+    def split_tuple_key(self, prefix, size):
+        make_key = getattr(type(self).make_key, '__func__',
+                           type(self).make_key)
+        if make_key not in _json_make_keys:
+            # Subclasses may not make JSON keys.
+            return None
+
+        # A tuple is encoded as a JSON array, the items of which are encoded
+        # the same way as they would be alone.
+        prefix = [b''.join(self.make_key(item)) for item in prefix]
+        head = b'[' + b', '.join(prefix)
+
+        def write_rest(items, write):
+            # The key of the remaining items, without its opening bracket.
+            batches = self.make_key(list(items))
+            first = next(batches)[1:]
+            if prefix and items:
+                first = b', ' + first
+            write(first)
+            for batch in batches:
+                write(batch)
+
+        return head, write_rest
 
 
 class StreamingDefaultKeyMaker(DefaultKeyMaker):
     """Subclass of DefaultKeyMaker that uses a temporary file to save memory."""
     def make_key(self, obj):
         with TemporaryFile(mode='w+') as f:
-            json.dump(
-                obj, f, sort_keys=self.sort_keys, cls=_AnyObjectJSONEncoder)
+            for chunk in self._encoder.iterencode(obj):
+                f.write(chunk)
             f.seek(0)
             for data in iter(partial(f.read, 65536), ''):
                 yield data.encode('utf-8')
 
 
+_json_make_keys = frozenset(
+    getattr(cls.make_key, '__func__', cls.make_key)
+    for cls in (DefaultKeyMaker, StreamingDefaultKeyMaker))
+
+
+@autorepr
+class StructuralKeyMaker(KeyMaker):
+    """KeyMaker that walks the object, writing type-tagged bytes for each
+    part of it straight to the hash, instead of building a JSON string.
+
+    Parameters:
+        chunk_size: Number of bytes to buffer before passing them to the
+                    hash.
+
+    Built-in types (:py:data:`None`, :py:class:`bool`, :py:class:`int`,
+    :py:class:`float`, :py:class:`str`, :py:class:`bytes`,
+    :py:class:`tuple`, :py:class:`list`, :py:class:`dict`,
+    :py:class:`set` and :py:class:`frozenset`) are encoded directly. Every
+    value is tagged with its type, so different values never make the same
+    key: ``1``, ``1.0``, ``True``, ``'1'``, ``b'1'``, ``(1,)`` and ``[1]``
+    are all different keys. Dictionary items and set elements are sorted, so
+    keys don't depend on insertion order or hash randomization.
+
+    Subclasses of the built-in types are encoded like their base type,
+    tagged with their class name. Classes and functions are encoded by
+    name. Other objects are encoded by their class name and the state
+    :py:mod:`pickle` would save (see :py:meth:`object.__reduce_ex__`), or
+    by ``repr(o)`` if they can't be pickled.
+
+    Memory use grows with `chunk_size` and the largest string or set in the
+    key, rather than the size of the whole key. Circular references raise
+    :py:exc:`ValueError`. Keys differ from those of
+    :py:class:`DefaultKeyMaker`, and on Python 2, :py:class:`str` objects
+    are encoded as bytes.
+
+    It is written in Python, so it is several times slower than
+    :py:class:`DefaultKeyMaker`, whose JSON encoder is written in C, for
+    keys made of built-in types. Use it when different keys must not
+    collide, not for speed.
+    """
+    def __init__(self, chunk_size=65536):
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be positive.')
+        self.chunk_size = chunk_size
+
+    def make_key(self, obj):
+        chunks = []
+        self.write_key(obj, chunks.append)
+        return iter(chunks)
+
+    def write_key(self, obj, write):
+        _StructuralEncoder(write, self.chunk_size).encode(obj)
+
+    def split_tuple_key(self, prefix, size):
+        prefix = tuple(prefix)
+        if len(prefix) > size:
+            raise ValueError('prefix has more than size items.')
+        chunks = []
+        _StructuralEncoder(chunks.append, self.chunk_size).encode(*prefix)
+        head = b'(' + _ascii(size) + b':' + b''.join(chunks)
+
+        def write_rest(items, write):
+            if len(prefix) + len(items) != size:
+                raise ValueError('Expected {} items, got {}.'.format(
+                    size - len(prefix), len(items)))
+            _StructuralEncoder(write, self.chunk_size).encode(*items)
+
+        return head, write_rest
+
+
+# Errors for encoding text, so that lone surrogates can be encoded on
+# Python 3. Python 2 encodes them without complaint.
+_text_errors = 'surrogatepass' if six.PY3 else 'strict'
+
+try:
+    _RecursionError = RecursionError
+except NameError:
+    # Python 2
+    _RecursionError = RuntimeError
+
+
+_text_type_set = frozenset([six.text_type])
+
+
+def _ascii(number):
+    # bytes can't be formatted with % on Python 3.3 and 3.4.
+    return str(number).encode('ascii')
+
+
+def _copy_str(obj, base):
+    return base.__getitem__(obj, slice(None))
+
+
+# Subclasses of built-in types are encoded as an instance of their base
+# type, which these functions convert them to. bool can't be subclassed.
+_base_converters = {
+    float: float,
+    six.text_type: partial(_copy_str, base=six.text_type),
+    bytes: partial(_copy_str, base=bytes),
+    tuple: tuple,
+    list: list,
+    dict: dict,
+    set: set,
+    frozenset: frozenset,
+}
+for _int_type in six.integer_types:
+    _base_converters[_int_type] = _int_type
+
+
+def _qualified_name(obj):
+    name = getattr(obj, '__qualname__', None) or obj.__name__
+    return '{}.{}'.format(getattr(obj, '__module__', None), name)
+
+
+class _StructuralEncoder(object):
+    """Encode objects for :py:class:`StructuralKeyMaker`.
+
+    Each value starts with a one byte type tag. Numbers are terminated by
+    ``;``, and strings and containers are prefixed by their length, so the
+    encoding of a value is never the start of another value's encoding.
+
+    Values are encoded into a buffer, which is passed to `write` when it
+    reaches `chunk_size` between the items of a container.
+    """
+    def __init__(self, write, chunk_size):
+        self._write = write
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        # Encodings of text dictionary keys, which are usually repeated.
+        self._key_cache = {}
+        # Encoded names of classes whose instances are pickled as their
+        # __dict__ (or None for other classes).
+        self._plain_classes = {}
+
+    def encode(self, *objs):
+        buf = self._buffer
+        try:
+            for obj in objs:
+                self._encode(obj, buf)
+                if len(buf) >= self._chunk_size:
+                    self.flush()
+        except _RecursionError:
+            # Like json, but without the cost of tracking which containers
+            # are being encoded.
+            raise ValueError(
+                'Circular reference detected, or object nested too deeply')
+        self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._write(bytes(self._buffer))
+            del self._buffer[:]
+
+    def _encode(self, obj, buf):
+        # Checked in order of how common they are.
+        t = type(obj)
+        if t is six.text_type:
+            data = obj.encode('utf-8', _text_errors)
+            buf += b's' + _ascii(len(data)) + b':'
+            buf += data
+        elif t is int:
+            buf += b'i' + _ascii(obj) + b';'
+        elif t is tuple:
+            self._encode_items(b'(', obj, buf)
+        elif t is list:
+            self._encode_items(b'[', obj, buf)
+        elif t is dict:
+            self._encode_dict(obj, buf)
+        elif t is float:
+            buf += b'f' + repr(obj).encode('ascii') + b';'
+        elif t is bytes:
+            buf += b'b' + _ascii(len(obj)) + b':'
+            buf += obj
+        elif obj is None:
+            buf += b'N'
+        elif t is bool:
+            buf += b'T' if obj else b'F'
+        elif t is set:
+            self._encode_set(b'<', obj, buf)
+        elif t is frozenset:
+            self._encode_set(b'>', obj, buf)
+        elif six.PY2 and t is long:  # noqa: F821
+            buf += b'i' + _ascii(obj) + b';'
+        else:
+            self._encode_other(obj, buf)
+
+    def _encoded(self, obj):
+        """Return encoding of `obj`, without writing it."""
+        buf = bytearray()
+        self._encode(obj, buf)
+        return bytes(buf)
+
+    def _encode_items(self, tag, obj, buf):
+        buf += tag + _ascii(len(obj)) + b':'
+        encode = self._encode
+        chunk_size = self._chunk_size if buf is self._buffer else None
+        for item in obj:
+            # Strings and ints are encoded here to save a call.
+            t = type(item)
+            if t is six.text_type:
+                data = item.encode('utf-8', _text_errors)
+                buf += b's' + _ascii(len(data)) + b':'
+                buf += data
+            elif t is int:
+                buf += b'i' + _ascii(item) + b';'
+            else:
+                encode(item, buf)
+            if chunk_size is not None and len(buf) >= chunk_size:
+                self.flush()
+
+    def _encode_dict(self, obj, buf):
+        buf += b'{' + _ascii(len(obj)) + b':'
+        encode = self._encode
+        chunk_size = self._chunk_size if buf is self._buffer else None
+        if _text_type_set.issuperset(map(type, obj)):
+            # Text keys are sorted as text, which is faster than sorting
+            # their encodings, and their encodings are reused.
+            key_cache = self._key_cache
+            items = ((key, obj[key]) for key in sorted(obj))
+        else:
+            # Sorting other keys by their encodings works for any types.
+            key_cache = None
+            items = sorted([(self._encoded(key), value)
+                            for key, value in obj.items()], key=itemgetter(0))
+
+        for key, value in items:
+            if key_cache is not None:
+                try:
+                    encoded = key_cache[key]
+                except KeyError:
+                    encoded = key_cache[key] = self._encoded(key)
+                key = encoded
+            buf += key
+            t = type(value)
+            if t is six.text_type:
+                data = value.encode('utf-8', _text_errors)
+                buf += b's' + _ascii(len(data)) + b':'
+                buf += data
+            elif t is int:
+                buf += b'i' + _ascii(value) + b';'
+            else:
+                encode(value, buf)
+            if chunk_size is not None and len(buf) >= chunk_size:
+                self.flush()
+
+    def _encode_set(self, tag, obj, buf):
+        items = sorted([self._encoded(item) for item in obj])
+        buf += tag + _ascii(len(items)) + b':'
+        for item in items:
+            buf += item
+
+    def _encode_text(self, text, buf):
+        self._encode(six.text_type(text), buf)
+
+    def _plain_class_name(self, cls):
+        """Return encoded name of `cls` if its instances are pickled as
+        their ``__dict__``, otherwise `None`.
+        """
+        hooks = ('__reduce_ex__', '__reduce__', '__getstate__',
+                 '__getnewargs__', '__getnewargs_ex__')
+        for hook in hooks:
+            if getattr(cls, hook, None) is not getattr(object, hook, None):
+                return None
+        if any(getattr(c, '__slots__', None) for c in cls.__mro__):
+            return None
+        buf = bytearray(b'o')
+        self._encode_text(_qualified_name(cls), buf)
+        return bytes(buf)
+
+    def _encode_other(self, obj, buf):
+        cls = type(obj)
+        for base in cls.__mro__:
+            convert = _base_converters.get(base)
+            if convert is not None:
+                buf += b'B'
+                self._encode_text(_qualified_name(cls), buf)
+                self._encode(convert(obj), buf)
+                return
+
+        if isinstance(obj, six.class_types):
+            buf += b'c'
+            self._encode_text(_qualified_name(obj), buf)
+            return
+
+        if isinstance(obj, (types.FunctionType, types.BuiltinFunctionType)):
+            name = _qualified_name(obj)
+            # Lambdas and nested functions don't have unique names.
+            if '<' not in name:
+                buf += b'g'
+                self._encode_text(name, buf)
+                return
+
+        try:
+            name = self._plain_classes[cls]
+        except KeyError:
+            name = self._plain_classes[cls] = self._plain_class_name(cls)
+        state = getattr(obj, '__dict__', None) if name is not None else None
+        if state is not None:
+            # Saves calling __reduce_ex__ for the most common objects.
+            buf += name
+            self._encode_dict(state, buf)
+            return
+
+        try:
+            reduced = obj.__reduce_ex__(2)
+        except Exception:
+            reduced = None
+
+        if isinstance(reduced, six.string_types):
+            # A global, like a function.
+            buf += b'g'
+            self._encode_text('{}.{}'.format(
+                getattr(obj, '__module__', None), reduced), buf)
+        elif isinstance(reduced, tuple) and len(reduced) >= 2:
+            buf += b'O'
+            self._encode_text(_qualified_name(cls), buf)
+            # Arguments, state, list items and dictionary items.
+            parts = list(reduced[1:5])
+            parts += [None] * (4 - len(parts))
+            for i in (2, 3):
+                if parts[i] is not None:
+                    parts[i] = list(parts[i])
+            self._encode(tuple(parts), buf)
+        else:
+            buf += b'r'
+            self._encode_text(repr(obj), buf)
+
+
 class _AnyObjectJSONEncoder(json.JSONEncoder):
     """Serialize objects that can't normally be serialized by json.
 
@@ -95,6 +481,7 @@ class _AnyObjectJSONEncoder(json.JSONEncoder):
 
         return repr(o)
 
+
 def normalise_slots(obj):
     """__slots__ can be a string for single attribute. Return inside tuple."""
     if isinstance(obj, six.string_types):
@@ -0,0 +1,253 @@
+from __future__ import absolute_import, division, print_function
+
+import errno
+import os
+import sys
+import threading
+import time
+
+import six
+from represent import autorepr
+
+from .compat.contextlib import suppress
+from .log import logger
+from .utilities import unlink_if_exists
+
+try:
+    import fcntl
+    fcntl_available = True
+except ImportError:
+    fcntl_available = False
+
+__all__ = ()
+
+LOCK_SUFFIX = '.lock'
+
+# Suffix of lock that is held while breaking a stale lock.
+_BREAK_SUFFIX = '.break' + LOCK_SUFFIX
+
+
+@autorepr
+class FileLock(object):
+    """Exclusive advisory lock shared between processes, held using
+    :py:func:`fcntl.flock` on a lock file.
+
+    Parameters:
+        path: Path of lock file. It is created when the lock is acquired, and
+              removed when the lock is released.
+        timeout: Seconds to wait for the lock. Wait indefinitely if `None`.
+        stale_timeout: Seconds after which a held lock is assumed to belong to
+                       a hung process, and is broken. Never broken if `None`.
+        poll_interval: Seconds between attempts to acquire the lock.
+
+    Locks held by processes that exit are released by the operating system,
+    so `stale_timeout` is only needed to recover from processes that hang
+    while holding the lock. It must be longer than the lock is legitimately
+    held for.
+
+    Used as a context manager, the lock is acquired on entry and the result
+    of :py:meth:`acquire` is returned.
+    """
+    def __init__(self, path, timeout=None, stale_timeout=None,
+                 poll_interval=0.05):
+        if not fcntl_available:
+            raise TypeError('FileLock requires the fcntl module, which is '
+                            'not available on this platform.')
+        self.path = str(path)
+        self.timeout = timeout
+        self.stale_timeout = stale_timeout
+        self.poll_interval = poll_interval
+        self._fd = None
+
+    @property
+    def locked(self):
+        return self._fd is not None
+
+    def acquire(self):
+        """Acquire lock, waiting up to `timeout` seconds.
+
+        Returns:
+            `True` if the lock was acquired, or `False` on timeout.
+        """
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        else:
+            deadline = None
+
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                os.close(fd)
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            else:
+                if self._is_current(fd):
+                    os.ftruncate(fd, 0)
+                    os.write(fd, str(os.getpid()).encode('ascii'))
+                    self._fd = fd
+                    return True
+
+                # The lock file was removed by the previous holder, or broken
+                # by another process. Try again with the new file.
+                os.close(fd)
+                continue
+
+            if self._is_stale():
+                self._break_stale(deadline)
+                continue
+
+            if deadline is not None and time.time() >= deadline:
+                return False
+
+            time.sleep(self.poll_interval)
+
+    def release(self):
+        if self._fd is None:
+            return
+
+        # Remove the file while it's still locked. Processes waiting on it
+        # will notice that it's no longer current and start again. If the
+        # lock was broken, the file now belongs to another process.
+        if self._is_current(self._fd):
+            unlink_if_exists(self.path)
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+    def _is_current(self, fd):
+        """Check that `fd` is still the file at `path`."""
+        try:
+            stat = os.stat(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        fstat = os.fstat(fd)
+        return (stat.st_dev, stat.st_ino) == (fstat.st_dev, fstat.st_ino)
+
+    def _is_stale(self):
+        if self.stale_timeout is None:
+            return False
+
+        with suppress(OSError):
+            age = time.time() - os.stat(self.path).st_mtime
+            return age > self.stale_timeout
+
+        return False
+
+    def _break_stale(self, deadline):
+        """Remove the lock file if it's stale, holding another lock while
+        checking, so that processes which found the same stale lock can't
+        remove the file that the first of them to break it then locked.
+        """
+        if deadline is not None:
+            timeout = max(0, deadline - time.time())
+        else:
+            timeout = None
+        guard = FileLock(self.path + _BREAK_SUFFIX, timeout=timeout,
+                         poll_interval=self.poll_interval)
+        with guard as locked:
+            # New lock files are created with the current time, so they
+            # aren't stale.
+            if locked and self._is_stale():
+                logger.warning('Breaking stale lock: {}', self.path)
+                unlink_if_exists(self.path)
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class _Call(object):
+    def __init__(self):
+        self.thread = threading.current_thread()
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls for the same key into a single call.
+
+    The first thread to call :py:meth:`do` for a key runs the function.
+    Threads that call :py:meth:`do` for the same key before it finishes wait
+    for it, and receive its result or exception.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = dict()
+
+    def do(self, key, function):
+        """Call `function`, or wait for the call already in progress for
+        `key`.
+
+        Returns:
+            Tuple of the function's return value, and whether it was shared
+            with (i.e. not called by) the calling thread.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if call.thread is threading.current_thread():
+                # Waiting on ourselves would deadlock.
+                return function(), False
+
+            call.done.wait()
+            if call.exc_info is not None:
+                six.reraise(*call.exc_info)
+            return call.result, True
+
+        try:
+            call.result = function()
+        except BaseException:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result, False
+
+
+class StripedLock(object):
+    """Fixed number of reentrant locks, shared between keys by hash.
+
+    Threads working on different keys rarely contend, without needing a lock
+    per key.
+    """
+    def __init__(self, stripes=64):
+        self._locks = [threading.RLock() for _ in range(stripes)]
+
+    def lock_for(self, key):
+        return self._locks[hash(key) % len(self._locks)]
+
+
+class _NullLock(object):
+    def acquire(self, blocking=True):
+        return True
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class NullStripedLock(object):
+    """Drop-in replacement for :py:class:`StripedLock` that doesn't lock."""
+    _lock = _NullLock()
+
+    def lock_for(self, key):
+        return self._lock
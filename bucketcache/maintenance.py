@@ -0,0 +1,96 @@
+from __future__ import absolute_import, division, print_function
+
+import threading
+import time
+import weakref
+
+from .log import logger
+
+__all__ = ()
+
+
+class MaintenanceWorker(object):
+    """Daemon thread that does housekeeping for a bucket.
+
+    Parameters:
+        bucket: :py:class:`~bucketcache.buckets.Bucket` to maintain. Only a
+                weak reference is kept, so the worker stops if the bucket is
+                garbage collected.
+        interval: Seconds between full maintenance runs.
+        io_rate: Maximum number of files examined or deleted per second, or
+                 `None` for no limit.
+
+    Every `interval` seconds, the bucket's ``_run_maintenance`` method is
+    called with ``full=True``. :py:meth:`wake` runs it sooner with
+    ``full=False``, e.g. when a write exceeds a disk limit.
+    """
+    def __init__(self, bucket, interval, io_rate=None):
+        self.interval = interval
+        self.io_rate = io_rate
+        self._bucket = weakref.ref(bucket)
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._next_io = 0
+        self._thread = threading.Thread(
+            target=self._run, name='bucketcache-maintenance')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def wake(self):
+        """Run maintenance as soon as possible, without waiting for the
+        interval.
+        """
+        self._wake.set()
+
+    def stop(self, timeout=None):
+        """Stop the worker and wait for it to finish its current operation.
+        """
+        self._stop.set()
+        self._wake.set()
+        if (self._thread.is_alive() and
+                self._thread is not threading.current_thread()):
+            self._thread.join(timeout)
+
+    @property
+    def stopped(self):
+        return self._stop.is_set()
+
+    def throttle(self):
+        """Wait until another file operation is allowed by `io_rate`.
+
+        Returns:
+            `False` if the worker is stopping, in which case the operation
+            should be abandoned.
+        """
+        if self.io_rate is not None:
+            now = time.time()
+            delay = self._next_io - now
+            if delay > 0:
+                self._stop.wait(delay)
+            self._next_io = max(now, self._next_io) + 1 / self.io_rate
+        return not self._stop.is_set()
+
+    def _run(self):
+        next_full = time.time() + self.interval
+        while True:
+            self._wake.wait(max(0, next_full - time.time()))
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+
+            full = time.time() >= next_full
+            if full:
+                next_full = time.time() + self.interval
+
+            bucket = self._bucket()
+            if bucket is None:
+                return
+            try:
+                bucket._run_maintenance(self.throttle, full=full)
+            except Exception:
+                logger.exception('Maintenance failed for bucket: {}',
+                                 bucket.path)
+            # Don't keep the bucket alive while waiting.
+            del bucket
@@ -0,0 +1,562 @@
+from __future__ import absolute_import, division, print_function
+
+import sys
+import threading
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from copy import deepcopy
+
+import six
+from represent import autorepr
+
+from .compat.collections import MutableMapping
+
+__all__ = (
+    'MemoryCache',
+    'StripedMemoryCache',
+    'LRUPolicy',
+    'LFUPolicy',
+    'ARCPolicy',
+    'TinyLFUPolicy',
+)
+
+
+@six.add_metaclass(ABCMeta)
+class EvictionPolicy(object):
+    """Abstract base class for :py:class:`MemoryCache` eviction policies.
+
+    A policy only tracks keys; :py:class:`MemoryCache` owns the values and
+    asks the policy which key to evict whenever a limit is exceeded.
+
+    Classes must implement abstract methods:
+
+    - :py:meth:`insert`
+    - :py:meth:`access`
+    - :py:meth:`remove`
+    - :py:meth:`evict`
+    """
+    #: Maximum number of entries, set by :py:class:`MemoryCache` if it has an
+    #: entry limit. Policies that need a capacity estimate should fall back to
+    #: the number of resident keys.
+    capacity = None
+
+    def admit(self, key, size):
+        """Return `False` to keep a new key out of memory entirely.
+
+        Default implementation admits every key.
+        """
+        return True
+
+    @abstractmethod
+    def insert(self, key):
+        """Called when `key` is added to the cache."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def access(self, key):
+        """Called when resident `key` is read or overwritten."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove(self, key):
+        """Called when resident `key` is removed explicitly (not evicted)."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def evict(self):
+        """Stop tracking a resident key and return it so it can be evicted."""
+        raise NotImplementedError
+
+
+def _touch(ordered, key):
+    """Move `key` to the most recently used end of an OrderedDict."""
+    ordered[key] = ordered.pop(key, None)
+
+
+@autorepr
+class LRUPolicy(EvictionPolicy):
+    """Evict the least recently used key."""
+    def __init__(self):
+        self._order = OrderedDict()
+
+    def insert(self, key):
+        self._order[key] = None
+
+    def access(self, key):
+        _touch(self._order, key)
+
+    def remove(self, key):
+        self._order.pop(key, None)
+
+    def evict(self):
+        key, _ = self._order.popitem(last=False)
+        return key
+
+
+@autorepr
+class LFUPolicy(EvictionPolicy):
+    """Evict the least frequently used key. Ties are broken by recency."""
+    def __init__(self):
+        self._freq = dict()
+        self._buckets = dict()
+        self._min_freq = 0
+
+    def insert(self, key):
+        self._freq[key] = 1
+        self._buckets.setdefault(1, OrderedDict())[key] = None
+        self._min_freq = 1
+
+    def access(self, key):
+        freq = self._freq[key]
+        self._unlink(key, freq)
+        self._freq[key] = freq + 1
+        self._buckets.setdefault(freq + 1, OrderedDict())[key] = None
+        if not self._min_freq or self._min_freq > freq + 1:
+            self._min_freq = freq + 1
+
+    def remove(self, key):
+        freq = self._freq.pop(key, None)
+        if freq is not None:
+            self._unlink(key, freq)
+
+    def evict(self):
+        if self._min_freq not in self._buckets:
+            self._min_freq = min(self._buckets)
+        key, _ = self._buckets[self._min_freq].popitem(last=False)
+        if not self._buckets[self._min_freq]:
+            del self._buckets[self._min_freq]
+            self._min_freq = min(self._buckets) if self._buckets else 0
+        del self._freq[key]
+        return key
+
+    def _unlink(self, key, freq):
+        bucket = self._buckets[freq]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[freq]
+            if freq == self._min_freq:
+                self._min_freq = min(self._buckets) if self._buckets else 0
+
+
+@autorepr
+class ARCPolicy(EvictionPolicy):
+    """Adaptive Replacement Cache.
+
+    Balances recency (keys seen once) against frequency (keys seen at least
+    twice) using ghost lists of recently evicted keys to adapt the target
+    size of each list.
+    """
+    def __init__(self):
+        self._t1 = OrderedDict()
+        self._t2 = OrderedDict()
+        self._b1 = OrderedDict()
+        self._b2 = OrderedDict()
+        self._p = 0
+
+    def _capacity(self):
+        return self.capacity or max(len(self._t1) + len(self._t2), 1)
+
+    def insert(self, key):
+        c = self._capacity()
+        if key in self._b1:
+            delta = max(1, len(self._b2) // len(self._b1))
+            self._p = min(c, self._p + delta)
+            del self._b1[key]
+            self._t2[key] = None
+        elif key in self._b2:
+            delta = max(1, len(self._b1) // len(self._b2))
+            self._p = max(0, self._p - delta)
+            del self._b2[key]
+            self._t2[key] = None
+        else:
+            self._t1[key] = None
+
+        # Bound the ghost lists, as described in the ARC paper.
+        while self._b1 and len(self._t1) + len(self._b1) > c:
+            self._b1.popitem(last=False)
+        total = len(self._t1) + len(self._t2) + len(self._b1) + len(self._b2)
+        while self._b2 and total > 2 * c:
+            self._b2.popitem(last=False)
+            total -= 1
+
+    def access(self, key):
+        if key in self._t1:
+            del self._t1[key]
+            self._t2[key] = None
+        else:
+            _touch(self._t2, key)
+
+    def remove(self, key):
+        self._t1.pop(key, None)
+        self._t2.pop(key, None)
+
+    def evict(self):
+        if self._t1 and (len(self._t1) > self._p or not self._t2):
+            key, _ = self._t1.popitem(last=False)
+            self._b1[key] = None
+        else:
+            key, _ = self._t2.popitem(last=False)
+            self._b2[key] = None
+        return key
+
+
+class _CountMinSketch(object):
+    """Approximate frequency counter with periodic aging, used by
+    :py:class:`TinyLFUPolicy`.
+    """
+    depth = 4
+    max_count = 15
+
+    def __init__(self, width=1024):
+        self.width = width
+        self._rows = [bytearray(width) for _ in range(self.depth)]
+        self._additions = 0
+        self.sample_size = 10 * width
+
+    def _indexes(self, key):
+        for seed in range(self.depth):
+            yield hash((seed, key)) % self.width
+
+    def increment(self, key):
+        for row, index in zip(self._rows, self._indexes(key)):
+            if row[index] < self.max_count:
+                row[index] += 1
+        self._additions += 1
+        if self._additions >= self.sample_size:
+            self._reset()
+
+    def frequency(self, key):
+        return min(row[index]
+                   for row, index in zip(self._rows, self._indexes(key)))
+
+    def _reset(self):
+        for row in self._rows:
+            for index in range(self.width):
+                row[index] >>= 1
+        self._additions //= 2
+
+
+@autorepr
+class TinyLFUPolicy(EvictionPolicy):
+    """Window TinyLFU (W-TinyLFU).
+
+    New keys enter a small LRU window. When the window overflows, its oldest
+    key is only admitted into the main segmented LRU if its estimated access
+    frequency beats that of the main segment's eviction candidate.
+
+    Parameters:
+        window_ratio: Fraction of the cache reserved for the admission window.
+        protected_ratio: Fraction of the main segment reserved for keys that
+                         have been accessed more than once.
+        sketch_width: Number of counters per row of the frequency sketch.
+    """
+    def __init__(self, window_ratio=0.01, protected_ratio=0.8,
+                 sketch_width=1024):
+        self.window_ratio = window_ratio
+        self.protected_ratio = protected_ratio
+        self.sketch_width = sketch_width
+        self._sketch = _CountMinSketch(sketch_width)
+        self._window = OrderedDict()
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+
+    def _capacity(self):
+        return self.capacity or max(
+            len(self._window) + len(self._probation) + len(self._protected), 1)
+
+    def _window_capacity(self):
+        return max(1, int(self._capacity() * self.window_ratio))
+
+    def insert(self, key):
+        self._sketch.increment(key)
+        self._window[key] = None
+
+        # Keys leave the window for the main segment while it has room.
+        # Once it is full, they have to win the contest in evict.
+        window_capacity = self._window_capacity()
+        main_capacity = self._capacity() - window_capacity
+        while (len(self._window) > window_capacity and
+               len(self._probation) + len(self._protected) < main_capacity):
+            moved, _ = self._window.popitem(last=False)
+            self._probation[moved] = None
+
+    def access(self, key):
+        self._sketch.increment(key)
+        if key in self._window:
+            _touch(self._window, key)
+        elif key in self._probation:
+            del self._probation[key]
+            self._protected[key] = None
+            main_capacity = self._capacity() - self._window_capacity()
+            max_protected = max(1, int(main_capacity * self.protected_ratio))
+            while len(self._protected) > max_protected:
+                demoted, _ = self._protected.popitem(last=False)
+                self._probation[demoted] = None
+        else:
+            _touch(self._protected, key)
+
+    def remove(self, key):
+        self._window.pop(key, None)
+        self._probation.pop(key, None)
+        self._protected.pop(key, None)
+
+    def evict(self):
+        main = self._probation or self._protected
+        if not main:
+            key, _ = self._window.popitem(last=False)
+            return key
+
+        victim = next(iter(main))
+        if len(self._window) > self._window_capacity():
+            # The main segment is full, so the window's oldest key is only
+            # admitted if it is used more often than the main segment's
+            # victim.
+            candidate, _ = self._window.popitem(last=False)
+            if (self._sketch.frequency(candidate) >
+                    self._sketch.frequency(victim)):
+                del main[victim]
+                self._probation[candidate] = None
+                return victim
+            else:
+                return candidate
+
+        del main[victim]
+        return victim
+
+
+class MemoryCache(MutableMapping):
+    """Dictionary that evicts entries when it grows beyond its limits.
+
+    Parameters:
+        max_entries: Maximum number of entries held. Unbounded if `None`.
+        max_bytes: Maximum total size of entries held. Unbounded if `None`.
+        policy: :py:class:`EvictionPolicy` instance. Default:
+                :py:class:`LRUPolicy`
+        sizeof: Function used to size values when :py:meth:`set` is not
+                given an explicit size. Default: :py:func:`sys.getsizeof`
+        on_evict: Called with `key` and `value` for every evicted entry.
+
+    An entry larger than `max_bytes` is never held.
+    """
+    def __init__(self, max_entries=None, max_bytes=None, policy=None,
+                 sizeof=None, on_evict=None):
+        for name, limit in (('max_entries', max_entries),
+                            ('max_bytes', max_bytes)):
+            if limit is not None and limit < 1:
+                raise ValueError('{} must be positive.'.format(name))
+
+        if policy is None:
+            policy = LRUPolicy()
+        elif not isinstance(policy, EvictionPolicy):
+            raise TypeError("'policy' must inherit from "
+                            "bucketcache.memory.EvictionPolicy")
+
+        if sizeof is None:
+            sizeof = sys.getsizeof
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.sizeof = sizeof
+        self.on_evict = on_evict
+
+        if max_entries is not None and policy.capacity is None:
+            policy.capacity = max_entries
+
+        self._data = dict()
+        self._sizes = dict()
+        self.total_bytes = 0
+
+    @property
+    def bounded(self):
+        return self.max_entries is not None or self.max_bytes is not None
+
+    def __getitem__(self, key):
+        value = self._data[key]
+        if self.bounded:
+            self.policy.access(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, size=None):
+        """Store `value` for `key`, evicting other entries if required.
+
+        Returns:
+            `True` if the entry is held in memory.
+        """
+        if not self.bounded:
+            self._data[key] = value
+            return True
+
+        if size is None:
+            size = self.sizeof(value)
+
+        resident = key in self._data
+        if self.max_bytes is not None and size > self.max_bytes:
+            if resident:
+                del self[key]
+            return False
+
+        if resident:
+            self.total_bytes -= self._sizes[key]
+            self.policy.access(key)
+        elif self.policy.admit(key, size):
+            # Make room first, so that the new key can't be chosen as the
+            # victim of its own insertion.
+            self._enforce_limits(extra_entries=1, extra_bytes=size)
+            self.policy.insert(key)
+        else:
+            return False
+
+        self._data[key] = value
+        self._sizes[key] = size
+        self.total_bytes += size
+        self._enforce_limits()
+        return key in self._data
+
+    def setdefault(self, key, default=None, size=None):
+        """Return value for `key` if held, otherwise store and return
+        `default`.
+        """
+        try:
+            return self[key]
+        except KeyError:
+            self.set(key, default, size=size)
+            return default
+
+    def __delitem__(self, key):
+        del self._data[key]
+        if self.bounded:
+            self.total_bytes -= self._sizes.pop(key)
+            self.policy.remove(key)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def _over_limit(self, extra_entries=0, extra_bytes=0):
+        if self.max_entries is not None:
+            if len(self._data) + extra_entries > self.max_entries:
+                return True
+        if self.max_bytes is not None:
+            if self.total_bytes + extra_bytes > self.max_bytes:
+                return True
+        return False
+
+    def _enforce_limits(self, extra_entries=0, extra_bytes=0):
+        while self._data and self._over_limit(extra_entries, extra_bytes):
+            key = self.policy.evict()
+            value = self._data.pop(key)
+            self.total_bytes -= self._sizes.pop(key)
+            if self.on_evict is not None:
+                self.on_evict(key, value)
+
+    def __repr__(self):
+        return ('{}(max_entries={!r}, max_bytes={!r}, policy={!r})'
+                .format(self.__class__.__name__, self.max_entries,
+                        self.max_bytes, self.policy))
+
+
+class StripedMemoryCache(MutableMapping):
+    """Thread-safe :py:class:`MemoryCache`, split into segments that are
+    locked independently so that threads using different keys rarely
+    contend.
+
+    Parameters are the same as :py:class:`MemoryCache`, plus:
+
+        stripes: Number of segments.
+
+    Each segment has its own copy of `policy`, and an equal share of
+    `max_entries` and `max_bytes` (rounded up). Limits are therefore
+    approximate, and an entry larger than one segment's share of `max_bytes`
+    is never held.
+    """
+    def __init__(self, max_entries=None, max_bytes=None, policy=None,
+                 sizeof=None, on_evict=None, stripes=16):
+        def share(limit):
+            if limit is None:
+                return None
+            return -(-limit // stripes)
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stripes = stripes
+        self._segments = [
+            MemoryCache(max_entries=share(max_entries),
+                        max_bytes=share(max_bytes),
+                        policy=deepcopy(policy), sizeof=sizeof,
+                        on_evict=on_evict)
+            for _ in range(stripes)]
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    def _segment(self, key):
+        index = hash(key) % self.stripes
+        return self._segments[index], self._locks[index]
+
+    @property
+    def policy(self):
+        return self._segments[0].policy
+
+    @property
+    def bounded(self):
+        return self._segments[0].bounded
+
+    @property
+    def total_bytes(self):
+        return sum(segment.total_bytes for segment in self._segments)
+
+    def __getitem__(self, key):
+        segment, lock = self._segment(key)
+        with lock:
+            return segment[key]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, size=None):
+        segment, lock = self._segment(key)
+        with lock:
+            return segment.set(key, value, size=size)
+
+    def setdefault(self, key, default=None, size=None):
+        segment, lock = self._segment(key)
+        with lock:
+            return segment.setdefault(key, default, size=size)
+
+    def __delitem__(self, key):
+        segment, lock = self._segment(key)
+        with lock:
+            del segment[key]
+
+    def pop(self, key, *default):
+        segment, lock = self._segment(key)
+        with lock:
+            return segment.pop(key, *default)
+
+    def __contains__(self, key):
+        segment, lock = self._segment(key)
+        with lock:
+            return key in segment
+
+    def __iter__(self):
+        for segment, lock in zip(self._segments, self._locks):
+            with lock:
+                keys = list(segment)
+            for key in keys:
+                yield key
+
+    def __len__(self):
+        return sum(len(segment) for segment in self._segments)
+
+    def __repr__(self):
+        return ('{}(max_entries={!r}, max_bytes={!r}, policy={!r}, '
+                'stripes={!r})'.format(self.__class__.__name__,
+                                       self.max_entries, self.max_bytes,
+                                       self.policy, self.stripes))
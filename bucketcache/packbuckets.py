@@ -0,0 +1,492 @@
+from __future__ import absolute_import, division, print_function
+
+import io
+import math
+import os
+import re
+import struct
+import threading
+import zlib
+from collections import namedtuple
+
+from .buckets import Bucket, _no_throttle
+from .exceptions import (
+    KeyExpirationError, KeyFileNotFoundError, KeyInvalidError)
+from .locks import FileLock, fcntl_available
+from .log import logger
+from .utilities import (
+    DiskUsage, PruneProgress, to_timestamp, unlink_if_exists)
+
+__all__ = ('PackBucket',)
+
+# Formatted with the segment number and the backend's file extension.
+SEGMENT_NAME = '{:08d}.{}.pack'
+
+# Formatted with the backend's file extension.
+PACK_LOCK_NAME = '.{}.pack.lock'
+
+# Each record is a CRC32 of the rest of the record, then the fields below,
+# then the key hash and the serialized object.
+_crc = struct.Struct('<I')
+_fields = struct.Struct('<BHId')  # flags, key length, value length, expiration
+_header_size = _crc.size + _fields.size
+
+# Record flags.
+_DELETED = 1
+
+_PackEntry = namedtuple(
+    '_PackEntry', ['segment', 'offset', 'length', 'expiration'])
+
+_Record = namedtuple(
+    '_Record', ['flags', 'key_hash', 'value', 'expiration', 'length'])
+
+
+class PackBucket(Bucket):
+    """Bucket that appends objects to a few large segment files, instead of
+    saving each object in its own file.
+
+    Parameters:
+        segment_size: Size in bytes at which a new segment file is started.
+        compaction_ratio: Fraction of a segment that must be overwritten,
+                          deleted or expired before it is compacted.
+
+    Other parameters are the same as :py:class:`~bucketcache.Bucket`, except
+    that `maintenance_interval` defaults to 60 seconds, and `index`, the disk
+    limits, fan-out layout and :py:func:`~bucketcache.deferred_write` aren't
+    supported.
+
+    Buckets with millions of small objects use much less disk space and far
+    fewer system calls this way. Objects are serialized by the backend, as
+    usual. The location of each object is kept in memory, and is rebuilt by
+    reading the segments when the bucket is created.
+
+    Overwritten, deleted and expired objects leave garbage in the segments.
+    Segments with enough garbage are compacted by copying the objects still
+    in use to the newest segment, by the maintenance thread and by
+    :py:meth:`prune_directory` and :py:meth:`compact`.
+
+    Only one process can use a directory as a pack bucket at a time. Call
+    :py:meth:`close` (or use the bucket as a context manager) to release it.
+    """
+    _file_per_object = False
+
+    def __init__(self, path, segment_size=64 * 2 ** 20, compaction_ratio=0.5,
+                 maintenance_interval=60, **kwargs):
+        for name in ('index', 'max_disk_bytes', 'max_disk_entries',
+                     'fanout_depth'):
+            if kwargs.get(name):
+                raise ValueError(
+                    'PackBucket does not support {}.'.format(name))
+        if segment_size <= 0:
+            raise ValueError('segment_size must be positive.')
+        if not 0 < compaction_ratio < 1:
+            raise ValueError('compaction_ratio must be between 0 and 1.')
+
+        self._segment_size = segment_size
+        self._compaction_ratio = compaction_ratio
+        self._entries = dict()
+        self._segments = dict()
+        self._active = None
+        self._process_lock = None
+        self._write_lock = threading.RLock()
+
+        super(PackBucket, self).__init__(
+            path, maintenance_interval=maintenance_interval, **kwargs)
+
+    @property
+    def segment_size(self):
+        return self._segment_size
+
+    @property
+    def compaction_ratio(self):
+        return self._compaction_ratio
+
+    def _open_storage(self):
+        if fcntl_available:
+            lock_name = PACK_LOCK_NAME.format(self.backend.file_extension)
+            lock = FileLock(self._path / lock_name, timeout=0)
+            if not lock.acquire():
+                raise RuntimeError('Pack bucket is in use by another '
+                                   'process: {}'.format(self.path))
+            self._process_lock = lock
+
+        pattern = re.compile(r'(\d{{8}})\.{}\.pack$'.format(
+            re.escape(self.backend.file_extension)))
+        numbers = sorted(
+            int(match.group(1)) for match in
+            (pattern.match(name) for name in os.listdir(str(self._path)))
+            if match)
+
+        for number in numbers:
+            segment = _Segment(self._segment_path(number), number)
+            self._segments[number] = segment
+            self._replay(segment, last=number == numbers[-1])
+
+        if numbers:
+            self._active = self._segments[numbers[-1]]
+        else:
+            self._start_segment()
+
+        logger.info('Loaded {} objects from {} segments in {}',
+                    len(self._entries), len(self._segments), self.path)
+
+    def close(self):
+        """Stop background work, and release the directory for other
+        processes. The bucket can't be used afterwards.
+        """
+        super(PackBucket, self).close()
+        with self._write_lock:
+            for segment in self._segments.values():
+                segment.close()
+            self._segments.clear()
+            self._entries.clear()
+            self._active = None
+            if self._process_lock is not None:
+                self._process_lock.release()
+                self._process_lock = None
+
+    def compact(self):
+        """Compact segments in which at least :py:attr:`compaction_ratio` of
+        the space is garbage.
+
+        Returns:
+            Number of bytes reclaimed.
+        """
+        return self._compact(_no_throttle)
+
+    def disk_usage(self):
+        """Return total size of segment files and number of objects.
+
+        :rtype: :py:class:`~bucketcache.utilities.DiskUsage`
+        """
+        with self._write_lock:
+            size = sum(segment.size for segment in self._segments.values())
+            return DiskUsage(size=size, num=len(self._entries))
+
+    def migrate_layout(self):
+        """Pack buckets have no layout to migrate, so this does nothing.
+
+        Returns:
+            0
+        """
+        return 0
+
+    def _repr_helper_(self, r):
+        super(PackBucket, self)._repr_helper_(r)
+        r.keyword_from_attr('segment_size')
+        r.keyword_from_attr('compaction_ratio')
+
+    def _segment_path(self, number):
+        return self._path / SEGMENT_NAME.format(
+            number, self.backend.file_extension)
+
+    def _start_segment(self):
+        number = max(self._segments) + 1 if self._segments else 1
+        segment = _Segment(self._segment_path(number), number)
+        self._segments[number] = segment
+        self._active = segment
+        logger.debug('Started segment: {}', segment.path)
+
+    def _replay(self, segment, last):
+        """Read `segment` to rebuild the locations of objects."""
+        data = segment.read(0, segment.size)
+        offset = 0
+        while offset < len(data):
+            record = _parse_record(data, offset)
+            if record is None:
+                if last:
+                    # Cut short by a crash while appending.
+                    logger.warning('Truncating incomplete record in {}',
+                                   segment.path)
+                    segment.truncate(offset)
+                else:
+                    logger.warning('Ignoring corrupt records in {}',
+                                   segment.path)
+                break
+            self._apply(record, segment, offset)
+            offset += record.length
+
+    def _apply(self, record, segment, offset):
+        """Record the location of `record`, and account for the space it
+        makes garbage.
+        """
+        old = self._entries.pop(record.key_hash, None)
+        if old is not None:
+            self._segments[old.segment].live -= old.length
+        if not record.flags & _DELETED:
+            self._entries[record.key_hash] = _PackEntry(
+                segment.number, offset, record.length, record.expiration)
+            segment.live += record.length
+
+    def _append(self, data, record):
+        """Append `data` (the serialized `record`) to the active segment."""
+        with self._write_lock:
+            if self._active is None:
+                raise ValueError('PackBucket is closed.')
+            if (self._active.size and
+                    self._active.size + len(data) > self._segment_size):
+                self._start_segment()
+            offset = self._active.append(data)
+            self._apply(record, self._active, offset)
+
+    def _write_obj_with_hash(self, key_hash, obj):
+        value = self._serialize_obj(obj)
+        expiration = to_timestamp(obj.expiration_date)
+        data, record = _make_record(key_hash, value, expiration)
+        self._append(data, record)
+        return len(value)
+
+    def _read_record(self, key_hash):
+        """Return :py:class:`_PackEntry` and :py:class:`_Record` for
+        `key_hash`.
+        """
+        entry, segment = self._locate(key_hash)
+        if entry is not None and segment is None:
+            # Moved by compaction, which moves entries before deleting their
+            # segment while holding the lock.
+            with self._write_lock:
+                entry, segment = self._locate(key_hash)
+        if entry is None:
+            raise KeyFileNotFoundError(
+                'Key hash not found in pack: {}'.format(key_hash))
+        if segment is None:
+            msg = 'Missing segment {} for key hash {}'.format(
+                self._segment_path(entry.segment), key_hash)
+            logger.error(msg)
+            raise KeyInvalidError(msg)
+
+        data = segment.read(entry.offset, entry.length)
+        record = _parse_record(data, 0)
+        if record is None or record.key_hash != key_hash:
+            msg = 'Corrupt record for key hash {} in {}'.format(
+                key_hash, segment.path)
+            logger.error(msg)
+            raise KeyInvalidError(msg)
+        return entry, record
+
+    def _locate(self, key_hash):
+        """Return :py:class:`_PackEntry` for `key_hash` and its segment, or
+        `None` for either if it's missing.
+        """
+        entry = self._entries.get(key_hash)
+        if entry is None:
+            return None, None
+        return entry, self._segments.get(entry.segment)
+
+    def _load_obj_with_hash(self, key_hash, skip_expired=False):
+        entry = self._entries.get(key_hash)
+        if (skip_expired and entry is not None and
+                self._timestamp_has_expired(entry.expiration)):
+            raise KeyExpirationError(
+                'Key hash has expired: {}'.format(key_hash))
+
+        entry, record = self._read_record(key_hash)
+        name = '{}:{}'.format(self._segment_path(entry.segment), entry.offset)
+        obj = self._deserialize_obj(record.value, name)
+        return obj, len(record.value)
+
+    def _hash_has_expired(self, key_hash):
+        entry = self._entries.get(key_hash)
+        if entry is None:
+            raise KeyFileNotFoundError(
+                'Key hash not found in pack: {}'.format(key_hash))
+        return self._timestamp_has_expired(entry.expiration)
+
+    def _unlink_hash(self, key_hash):
+        with self._write_lock:
+            if key_hash not in self._entries:
+                return False
+            self._append(*_make_record(key_hash, b'', None, _DELETED))
+            return True
+
+    def _adopt_legacy_hash(self, legacy_hash, key_hash):
+        with self._write_lock:
+            if (key_hash in self._entries or
+                    legacy_hash not in self._entries):
+                return
+            try:
+                _, record = self._read_record(legacy_hash)
+            except KeyInvalidError:
+                return
+            self._append(*_make_record(key_hash, record.value,
+                                       record.expiration))
+            self._append(*_make_record(legacy_hash, b'', None, _DELETED))
+
+    def _iter_prune(self, throttle, resume_from=None):
+        """Delete expired objects, then compact segments. Everything is one
+        partition, so nothing is pruned when resuming from any checkpoint.
+        """
+        if resume_from is not None:
+            yield PruneProgress(size=0, num=0, checked=0,
+                                checkpoint=resume_from)
+            return
+
+        totalsize = 0
+        totalnum = 0
+        checked = 0
+        for key_hash, entry in list(self._entries.items()):
+            if not self._timestamp_has_expired(entry.expiration):
+                continue
+            if not throttle():
+                return
+            checked += 1
+            with self._key_locks.lock_for(key_hash):
+                with self._write_lock:
+                    if self._entries.get(key_hash) != entry:
+                        continue
+                    self._unlink_hash(key_hash)
+                self._cache.pop(key_hash, None)
+            totalsize += entry.length
+            totalnum += 1
+
+        self._compact(throttle)
+        yield PruneProgress(size=totalsize, num=totalnum, checked=checked,
+                            checkpoint='')
+
+    def _compact(self, throttle):
+        with self._write_lock:
+            candidates = [
+                segment for _, segment in sorted(self._segments.items())
+                if segment is not self._active and
+                segment.live <= (1 - self._compaction_ratio) * segment.size]
+
+        reclaimed = 0
+        for segment in candidates:
+            if not throttle():
+                break
+            reclaimed += self._compact_segment(segment)
+        return reclaimed
+
+    def _compact_segment(self, segment):
+        """Copy objects still in use from `segment` to the active segment,
+        then delete it, unless it has records that can't be parsed.
+        """
+        logger.info('Compacting segment: {}', segment.path)
+        # Only the active segment is appended to, so this can be read
+        # without holding the lock.
+        data = segment.read(0, segment.size)
+        offset = 0
+        while offset < len(data):
+            record = _parse_record(data, offset)
+            if record is None:
+                # Objects after the corrupt record may still be in use.
+                logger.warning('Not deleting segment with corrupt records: '
+                               '{}', segment.path)
+                return 0
+            with self._write_lock:
+                self._copy_record(record, data, segment, offset)
+            offset += record.length
+
+        with self._write_lock:
+            del self._segments[segment.number]
+            unlink_if_exists(segment.path)
+        # Readers may still be using the file, so it is closed when it's
+        # garbage collected.
+        return segment.size
+
+    def _copy_record(self, record, data, segment, offset):
+        """Copy `record` at `offset` in `segment` to the active segment if
+        it's still needed.
+        """
+        key_hash = record.key_hash
+        older_segments = min(self._segments) < segment.number
+        chunk = data[offset:offset + record.length]
+
+        if record.flags & _DELETED:
+            # Still needed if an older segment has an object for the key.
+            if key_hash not in self._entries and older_segments:
+                self._append(chunk, record)
+            return
+
+        entry = self._entries.get(key_hash)
+        if entry is None or entry[:2] != (segment.number, offset):
+            # Overwritten or deleted.
+            return
+
+        if not self._timestamp_has_expired(record.expiration):
+            self._append(chunk, record)
+        elif older_segments:
+            # Don't let an older object for the key come back.
+            self._append(*_make_record(key_hash, b'', None, _DELETED))
+        else:
+            self._entries.pop(key_hash)
+            segment.live -= record.length
+
+
+class _Segment(object):
+    """Segment file, which is only appended to."""
+    def __init__(self, path, number):
+        self.path = path
+        self.number = number
+        # Unbuffered, and closed when garbage collected.
+        self._file = io.FileIO(str(path), 'a+')
+        self._lock = threading.Lock()
+        self.size = os.fstat(self._file.fileno()).st_size
+        # Bytes used by objects that haven't been overwritten or deleted.
+        self.live = 0
+
+    def append(self, data):
+        """Append `data`, returning its offset."""
+        offset = self.size
+        view = memoryview(data)
+        while view:
+            written = self._file.write(view)
+            view = view[written:]
+        self.size += len(data)
+        return offset
+
+    def read(self, offset, length):
+        if hasattr(os, 'pread'):
+            return os.pread(self._file.fileno(), length, offset)
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(length)
+
+    def truncate(self, size):
+        self._file.truncate(size)
+        self.size = size
+
+    def close(self):
+        self._file.close()
+
+
+def _make_record(key_hash, value, expiration, flags=0):
+    """Return serialized record and :py:class:`_Record`."""
+    key = key_hash.encode('ascii')
+    if expiration is None:
+        expiration_field = float('nan')
+    else:
+        expiration_field = expiration
+    body = (_fields.pack(flags, len(key), len(value), expiration_field) +
+            key + value)
+    data = _crc.pack(zlib.crc32(body) & 0xffffffff) + body
+    return data, _Record(flags, key_hash, value, expiration, len(data))
+
+
+def _parse_record(data, offset):
+    """Return :py:class:`_Record` at `offset` in `data`, or `None` if it is
+    incomplete or corrupt.
+    """
+    if len(data) - offset < _header_size:
+        return None
+    crc, = _crc.unpack_from(data, offset)
+    flags, key_length, value_length, expiration = _fields.unpack_from(
+        data, offset + _crc.size)
+    length = _header_size + key_length + value_length
+    if len(data) - offset < length:
+        return None
+
+    body = data[offset + _crc.size:offset + length]
+    if zlib.crc32(body) & 0xffffffff != crc:
+        return None
+
+    key_start = offset + _header_size
+    value_start = key_start + key_length
+    try:
+        key_hash = data[key_start:value_start].decode('ascii')
+    except UnicodeDecodeError:
+        return None
+    if math.isnan(expiration):
+        expiration = None
+    return _Record(flags, key_hash, data[value_start:offset + length],
+                   expiration, length)
@@ -0,0 +1,249 @@
+from __future__ import absolute_import, division, print_function
+
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+
+from .buckets import Bucket
+from .exceptions import KeyExpirationError, KeyFileNotFoundError
+from .log import logger
+from .utilities import DiskUsage, PruneProgress, to_timestamp
+
+__all__ = ('SQLiteBucket',)
+
+# Formatted with the backend's file extension, so buckets with different
+# backends in the same directory have separate databases.
+DATABASE_NAME = '{}.sqlite'
+
+_schema = (
+    """CREATE TABLE IF NOT EXISTS objects (
+        key_hash TEXT PRIMARY KEY NOT NULL,
+        expiration REAL,
+        size INTEGER NOT NULL,
+        value BLOB NOT NULL
+    )""",
+    'CREATE INDEX IF NOT EXISTS objects_expiration ON objects (expiration)',
+)
+
+
+class SQLiteBucket(Bucket):
+    """Bucket that stores objects in an SQLite database, instead of saving
+    each object in its own file.
+
+    Parameters:
+        busy_timeout: Seconds to wait for other processes to finish writing
+                      before raising :py:exc:`sqlite3.OperationalError`.
+
+    Other parameters are the same as :py:class:`~bucketcache.Bucket`, except
+    that `index`, the disk limits, fan-out layout and
+    :py:func:`~bucketcache.deferred_write` aren't supported.
+
+    Objects are serialized by the backend, as usual, and stored with their
+    key hash, expiration date and size. The database uses write-ahead
+    logging, so many processes can read while another writes, and each write
+    is a transaction. Expired objects are pruned with one ``DELETE``
+    statement, using an index on the expiration date.
+
+    Each thread using the bucket at the same time has its own connection.
+    Call :py:meth:`close` (or use the bucket as a context manager) to close
+    them.
+    """
+    _file_per_object = False
+
+    def __init__(self, path, busy_timeout=30, **kwargs):
+        for name in ('index', 'max_disk_bytes', 'max_disk_entries',
+                     'fanout_depth'):
+            if kwargs.get(name):
+                raise ValueError(
+                    'SQLiteBucket does not support {}.'.format(name))
+        if busy_timeout < 0:
+            raise ValueError('busy_timeout cannot be negative.')
+
+        self._busy_timeout = busy_timeout
+        # Idle connections. Connections are shared between threads, but only
+        # used by one at a time.
+        self._connections = []
+        self._closed = False
+
+        super(SQLiteBucket, self).__init__(path, **kwargs)
+
+    @property
+    def busy_timeout(self):
+        return self._busy_timeout
+
+    @property
+    def database_path(self):
+        return self._path / DATABASE_NAME.format(self.backend.file_extension)
+
+    def _open_storage(self):
+        # Processes opening a new database at the same time take turns to
+        # create the schema, instead of changing it under each other.
+        with self._transaction() as connection:
+            for statement in _schema:
+                connection.execute(statement)
+        # The journal mode is stored in the database, but the schema may need
+        # creating first.
+        with self._connection() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+        logger.info('Opened database: {}', self.database_path)
+
+    def _new_connection(self):
+        connection = sqlite3.connect(
+            str(self.database_path), timeout=self._busy_timeout,
+            isolation_level=None, check_same_thread=False)
+        # Transactions are still durable against application crashes.
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    @contextmanager
+    def _connection(self):
+        """Use an idle connection, or a new one if there are none."""
+        if self._closed:
+            raise ValueError('SQLiteBucket is closed.')
+        try:
+            connection = self._connections.pop()
+        except IndexError:
+            connection = self._new_connection()
+        try:
+            yield connection
+        finally:
+            if self._closed:
+                connection.close()
+            else:
+                self._connections.append(connection)
+
+    @contextmanager
+    def _transaction(self):
+        """Use a connection in a write transaction, which is committed unless
+        an exception is raised.
+        """
+        with self._connection() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+
+    def close(self):
+        """Stop background work, and close database connections. The bucket
+        can't be used afterwards.
+        """
+        super(SQLiteBucket, self).close()
+        self._closed = True
+        while self._connections:
+            self._connections.pop().close()
+
+    def disk_usage(self):
+        """Return total size and number of serialized objects.
+
+        The database file is larger, as it also contains the key hashes and
+        the expiration index.
+
+        :rtype: :py:class:`~bucketcache.utilities.DiskUsage`
+        """
+        with self._connection() as connection:
+            num, size = connection.execute(
+                'SELECT COUNT(*), TOTAL(size) FROM objects').fetchone()
+        return DiskUsage(size=int(size), num=num)
+
+    def migrate_layout(self):
+        """SQLite buckets have no layout to migrate, so this does nothing.
+
+        Returns:
+            0
+        """
+        return 0
+
+    def _write_obj_with_hash(self, key_hash, obj):
+        value = self._serialize_obj(obj)
+        with self._connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO objects '
+                '(key_hash, expiration, size, value) VALUES (?, ?, ?, ?)',
+                (key_hash, to_timestamp(obj.expiration_date), len(value),
+                 sqlite3.Binary(value)))
+        return len(value)
+
+    def _load_obj_with_hash(self, key_hash, skip_expired=False):
+        logger.info('Attempt load from database: {}', key_hash)
+        with self._connection() as connection:
+            row = connection.execute(
+                'SELECT expiration, value FROM objects WHERE key_hash = ?',
+                (key_hash,)).fetchone()
+
+        if row is None:
+            raise KeyFileNotFoundError(
+                'Key hash not found in database: {}'.format(key_hash))
+        expiration, value = row
+        if skip_expired and self._timestamp_has_expired(expiration):
+            raise KeyExpirationError(
+                'Key hash has expired: {}'.format(key_hash))
+
+        value = bytes(value)
+        name = '{}:{}'.format(self.database_path, key_hash)
+        return self._deserialize_obj(value, name), len(value)
+
+    def _hash_has_expired(self, key_hash):
+        with self._connection() as connection:
+            row = connection.execute(
+                'SELECT expiration FROM objects WHERE key_hash = ?',
+                (key_hash,)).fetchone()
+        if row is None:
+            raise KeyFileNotFoundError(
+                'Key hash not found in database: {}'.format(key_hash))
+        return self._timestamp_has_expired(row[0])
+
+    def _unlink_hash(self, key_hash):
+        with self._connection() as connection:
+            cursor = connection.execute(
+                'DELETE FROM objects WHERE key_hash = ?', (key_hash,))
+        return cursor.rowcount > 0
+
+    def _adopt_legacy_hash(self, legacy_hash, key_hash):
+        # Ignored if there's already a row for key_hash.
+        with self._connection() as connection:
+            connection.execute(
+                'UPDATE OR IGNORE objects SET key_hash = ? WHERE key_hash = ?',
+                (key_hash, legacy_hash))
+
+    def _iter_prune(self, throttle, resume_from=None):
+        """Delete expired objects in one transaction. Everything is one
+        partition, so nothing is pruned when resuming from any checkpoint.
+        """
+        if resume_from is not None:
+            yield PruneProgress(size=0, num=0, checked=0,
+                                checkpoint=resume_from)
+            return
+
+        if not throttle():
+            return
+
+        # Equivalent to _timestamp_has_expired for every row.
+        condition = 'expiration < ?'
+        parameters = [to_timestamp(datetime.utcnow())]
+        if self.lifetime:
+            condition += ' OR expiration IS NULL OR expiration > ?'
+            parameters.append(to_timestamp(self._object_expiration_date()))
+        parameters = tuple(parameters)
+
+        with self._transaction() as connection:
+            checked, = connection.execute(
+                'SELECT COUNT(*) FROM objects').fetchone()
+            totalsize, = connection.execute(
+                'SELECT TOTAL(size) FROM objects WHERE ' + condition,
+                parameters).fetchone()
+            for key_hash, in connection.execute(
+                    'SELECT key_hash FROM objects WHERE ' + condition,
+                    parameters):
+                self._cache.pop(key_hash, None)
+            totalnum = connection.execute(
+                'DELETE FROM objects WHERE ' + condition, parameters).rowcount
+
+        yield PruneProgress(size=int(totalsize), num=totalnum,
+                            checked=checked, checkpoint='')
+
+    def _repr_helper_(self, r):
+        super(SQLiteBucket, self)._repr_helper_(r)
+        r.keyword_from_attr('busy_timeout')
@@ -0,0 +1,319 @@
+from __future__ import absolute_import, division, print_function
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .buckets import Bucket
+from .exceptions import (
+    KeyExpirationError, KeyFileNotFoundError, KeyInvalidError)
+from .log import logger
+from .utilities import DiskUsage, PruneProgress, TierStats
+
+__all__ = ('TieredBucket',)
+
+
+class TieredBucket(Bucket):
+    """Bucket that stores objects in a list of other buckets, from fastest
+    to slowest, such as a bucket on local disk and a bucket in a shared
+    directory.
+
+    Parameters:
+        tiers: List of :py:class:`~bucketcache.Bucket` instances (or
+               subclasses, e.g. :py:class:`~bucketcache.PackBucket`), fastest
+               first.
+        write_policy: ``'through'`` to write to every tier, ``'behind'`` to
+                      write to the fastest tier and then to the other tiers
+                      in a background thread, or ``'around'`` to write to the
+                      slowest tier only and remove the key from the others.
+
+    Other parameters are the same as :py:class:`~bucketcache.Bucket`, except
+    that `index`, the disk limits and fan-out layout should be configured on
+    the tiers. The backend and config default to those of the fastest tier,
+    and the path is that of the slowest tier, where lock files for
+    ``lock=True`` are kept.
+
+    Reads check memory, then each tier in turn. An object found in a slower
+    tier is copied to the faster tiers, so later reads are faster. Each tier
+    uses its own backend, and its own lifetime to decide whether objects have
+    expired, so the tiers should have the same lifetime as the tiered
+    bucket, or none.
+
+    Keys are hashed by the tiered bucket, so they map to the same files in
+    every tier. They map to the files of the tiers' own keys if the tiers use
+    the same key maker, and a backend with the same name.
+    :py:meth:`close` also closes the tiers.
+    """
+    _write_policies = ('through', 'behind', 'around')
+
+    def __init__(self, tiers, write_policy='through', backend=None,
+                 config=None, **kwargs):
+        tiers = list(tiers)
+        if not tiers:
+            raise ValueError('At least one tier is required.')
+        for name in ('index', 'max_disk_bytes', 'max_disk_entries',
+                     'fanout_depth'):
+            if kwargs.get(name):
+                raise ValueError(
+                    'TieredBucket does not support {}. Configure the tiers '
+                    'instead.'.format(name))
+        if write_policy not in self._write_policies:
+            raise ValueError('write_policy must be one of {}.'.format(
+                ', '.join(repr(p) for p in self._write_policies)))
+
+        if backend is None:
+            backend = tiers[0].backend
+            if config is None:
+                config = tiers[0].config
+
+        self._tiers = tiers
+        self._write_policy = write_policy
+        self._write_behind = None
+        # Hits and misses for memory, then each tier.
+        self._stats_lock = threading.Lock()
+        self._hits = [0] * (len(tiers) + 1)
+        self._misses = [0] * (len(tiers) + 1)
+
+        super(TieredBucket, self).__init__(
+            tiers[-1].path, backend=backend, config=config, **kwargs)
+
+    @property
+    def tiers(self):
+        return tuple(self._tiers)
+
+    @property
+    def write_policy(self):
+        return self._write_policy
+
+    @property
+    def tier_stats(self):
+        """List of :py:class:`~bucketcache.utilities.TierStats` for memory,
+        then each tier.
+
+        Memory hits are reads of keys already in memory, and misses are
+        reads that had to check the tiers. Objects :py:meth:`get_many`
+        finds in memory aren't counted. A tier's misses include expired
+        objects.
+        """
+        names = ['memory'] + [str(tier.path) for tier in self._tiers]
+        with self._stats_lock:
+            return [TierStats(name, hits, misses) for name, hits, misses
+                    in zip(names, self._hits, self._misses)]
+
+    def reset_tier_stats(self):
+        """Set all hit and miss counters to zero."""
+        with self._stats_lock:
+            self._hits = [0] * len(self._hits)
+            self._misses = [0] * len(self._misses)
+
+    def _count(self, level, hit):
+        with self._stats_lock:
+            if hit:
+                self._hits[level] += 1
+            else:
+                self._misses[level] += 1
+
+    def close(self):
+        """Stop background work, finish writing to slower tiers, and close
+        the tiers.
+        """
+        super(TieredBucket, self).close()
+        with self._background_lock:
+            executor, self._write_behind = self._write_behind, None
+        if executor is not None:
+            executor.shutdown()
+        for tier in self._tiers:
+            tier.close()
+
+    def disk_usage(self):
+        """Return total size and number of cached files in all tiers.
+
+        :rtype: :py:class:`~bucketcache.utilities.DiskUsage`
+        """
+        usages = [tier.disk_usage() for tier in self._tiers]
+        return DiskUsage(size=sum(usage.size for usage in usages),
+                         num=sum(usage.num for usage in usages))
+
+    def migrate_layout(self):
+        """Migrate the layout of each tier.
+
+        Returns:
+            Total number of files moved.
+        """
+        return sum(tier.migrate_layout() for tier in self._tiers)
+
+    def _get_obj_from_hash(self, key_hash, load_file=True, stale_grace=None):
+        if load_file and key_hash in self._cache:
+            self._count(0, hit=True)
+        return super(TieredBucket, self)._get_obj_from_hash(
+            key_hash, load_file=load_file, stale_grace=stale_grace)
+
+    def _write_obj_with_hash(self, key_hash, obj):
+        tiers = self._tiers
+        if self._write_policy == 'around':
+            for tier in tiers[:-1]:
+                self._unlink_from_tier(tier, key_hash)
+            return self._write_to_tier(tiers[-1], key_hash, obj)
+
+        size = self._write_to_tier(tiers[0], key_hash, obj)
+        if self._write_policy == 'behind':
+            for tier in tiers[1:]:
+                self._submit_write_behind(
+                    self._write_to_tier, tier, key_hash, obj)
+        else:
+            for tier in tiers[1:]:
+                self._write_to_tier(tier, key_hash, obj)
+        return size
+
+    @staticmethod
+    def _write_to_tier(tier, key_hash, obj):
+        # The tier may use a different backend.
+        tier_obj = tier.backend(obj.value, expiration_date=obj.expiration_date,
+                                config=tier.config)
+        with tier._key_locks.lock_for(key_hash):
+            # Drop the tier's own copy so direct reads from the tier don't
+            # return a stale object.
+            tier._cache.pop(key_hash, None)
+            return tier._write_obj_with_hash(key_hash, tier_obj)
+
+    @staticmethod
+    def _unlink_from_tier(tier, key_hash):
+        with tier._key_locks.lock_for(key_hash):
+            tier._cache.pop(key_hash, None)
+            return tier._unlink_hash(key_hash)
+
+    def _submit_write_behind(self, function, *args):
+        """Call `function` in the write-behind thread. Calls are made in the
+        order they were submitted.
+        """
+        with self._background_lock:
+            if self._write_behind is None:
+                self._write_behind = ThreadPoolExecutor(max_workers=1)
+            return self._write_behind.submit(
+                self._run_write_behind, function, *args)
+
+    @staticmethod
+    def _run_write_behind(function, *args):
+        try:
+            return function(*args)
+        except Exception:
+            logger.exception('Failed to write to slower tier.')
+            raise
+
+    def _load_obj_with_hash(self, key_hash, skip_expired=False):
+        self._count(0, hit=False)
+        expired = False
+        for level, tier in enumerate(self._tiers, start=1):
+            try:
+                obj, size = tier._load_obj_with_hash(
+                    key_hash, skip_expired=skip_expired)
+            except KeyExpirationError:
+                expired = True
+            except KeyInvalidError:
+                pass
+            else:
+                if not tier._has_expired(obj):
+                    self._count(level, hit=True)
+                    self._promote(key_hash, obj, level - 1)
+                    return obj, size
+                if not skip_expired:
+                    # Stale objects can be used, but aren't promoted.
+                    self._count(level, hit=True)
+                    return obj, size
+                expired = True
+            self._count(level, hit=False)
+
+        if expired:
+            raise KeyExpirationError(
+                'Key hash has expired in every tier: {}'.format(key_hash))
+        raise KeyFileNotFoundError(
+            'Key hash not found in any tier: {}'.format(key_hash))
+
+    def _promote(self, key_hash, obj, level):
+        """Copy `obj`, found in tier `level`, to the faster tiers."""
+        for tier in self._tiers[:level]:
+            self._write_to_tier(tier, key_hash, obj)
+
+    def _hash_has_expired(self, key_hash):
+        found = False
+        for tier in self._tiers:
+            try:
+                if not tier._hash_has_expired(key_hash):
+                    return False
+            except KeyInvalidError:
+                continue
+            found = True
+
+        if not found:
+            raise KeyFileNotFoundError(
+                'Key hash not found in any tier: {}'.format(key_hash))
+        return True
+
+    def _unlink_hash(self, key_hash):
+        unlinked = [self._unlink_from_tier(self._tiers[0], key_hash)]
+        for tier in self._tiers[1:]:
+            if self._write_policy == 'behind':
+                # Wait for earlier writes to the tier, so they don't
+                # overwrite the deletion.
+                future = self._submit_write_behind(
+                    self._unlink_from_tier, tier, key_hash)
+                unlinked.append(future.result())
+            else:
+                unlinked.append(self._unlink_from_tier(tier, key_hash))
+        return any(unlinked)
+
+    def _adopt_legacy_hash(self, legacy_hash, key_hash):
+        for tier in self._tiers:
+            tier._adopt_legacy_hash(legacy_hash, key_hash)
+
+    def _iter_prune(self, throttle, resume_from=None):
+        """Prune each tier. The partitions of each tier are partitions of the
+        tiered bucket, with checkpoints like ``'<position>:<checkpoint>'``,
+        where `position` is the tier's position in :py:attr:`tiers`. Once a
+        tier is finished, the checkpoint is just its position.
+        """
+        first = 0
+        first_resume_from = None
+        if resume_from is not None:
+            position, separator, first_resume_from = resume_from.partition(':')
+            first = int(position)
+            if not separator:
+                first += 1
+                first_resume_from = None
+
+        totalsize = 0
+        totalnum = 0
+        checked = 0
+        checkpoint = resume_from
+        pruned_any = False
+        for position, tier in enumerate(self._tiers):
+            if position < first:
+                continue
+            tier_resume_from = first_resume_from if position == first else None
+            progress = None
+            for progress in tier._iter_prune(throttle, tier_resume_from):
+                if progress.checkpoint is not None:
+                    checkpoint = '{}:{}'.format(position, progress.checkpoint)
+                yield PruneProgress(size=totalsize + progress.size,
+                                    num=totalnum + progress.num,
+                                    checked=checked + progress.checked,
+                                    checkpoint=checkpoint)
+            if not throttle():
+                return
+            if progress is not None:
+                totalsize += progress.size
+                totalnum += progress.num
+                checked += progress.checked
+            checkpoint = str(position)
+            pruned_any = True
+            yield PruneProgress(size=totalsize, num=totalnum,
+                                checked=checked, checkpoint=checkpoint)
+
+        if not pruned_any:
+            # Every tier was pruned before.
+            yield PruneProgress(size=0, num=0, checked=0,
+                                checkpoint=resume_from)
+
+    def _repr_helper_(self, r):
+        super(TieredBucket, self)._repr_helper_(r)
+        r.keyword_from_attr('tiers')
+        r.keyword_from_attr('write_policy')
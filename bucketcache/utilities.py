@@ -1,18 +1,32 @@
 from __future__ import absolute_import, division, print_function
 
+import base64
+import binascii
+import errno
+import hashlib
 import inspect
+import io
 import json
+import math
+import os
 import sys
+import time
 import weakref
 from collections import namedtuple
+from contextlib import contextmanager
 from copy import copy
+from datetime import datetime, timedelta
 from functools import partial, wraps
 
+import six
 from decorator import decorator as decorator
+from represent import autorepr
 
 from .compat.contextlib import suppress
-from .exceptions import KeyInvalidError
-from .log import logger
+from .compat.inspect import iscoroutinefunction
+from .compat.os import replace
+from .exceptions import KeyInvalidError, KeyStaleError
+from .log import log_handled_exception, logger
 
 __all__ = ()
 
@@ -30,8 +44,117 @@ CachedCallInfo = namedtuple(
     'CachedCallInfo',
     ['varargs', 'callargs', 'return_value', 'expiration_date'])
 
+# Cached in place of the return value of a function that raised exception.
+CachedException = namedtuple('CachedException', ['exception'])
+
 PrunedFilesInfo = namedtuple('PrunedFilesInfo', ['size', 'num'])
 
+PruneProgress = namedtuple(
+    'PruneProgress', ['size', 'num', 'checked', 'checkpoint'])
+
+GetManyResult = namedtuple('GetManyResult', ['found', 'missing'])
+
+DiskUsage = namedtuple('DiskUsage', ['size', 'num'])
+
+# Hash state for the start of keys. See Bucket._key_prefix.
+KeyPrefix = namedtuple(
+    'KeyPrefix',
+    ['items', 'backend', 'keymaker', 'write_rest', 'hash_obj',
+     'legacy_hash_obj'])
+
+
+class TierStats(namedtuple('TierStats', ['name', 'hits', 'misses'])):
+    __slots__ = ()
+
+    @property
+    def hit_rate(self):
+        """Fraction of lookups that were hits, or 0 if there were none."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class NamedBytesIO(io.BytesIO):
+    """:py:class:`io.BytesIO` with a name, which backends use in error
+    messages.
+    """
+    def __init__(self, data, name):
+        super(NamedBytesIO, self).__init__(data)
+        self.name = name
+
+
+@autorepr
+class KeyHasher(object):
+    """Hash function for key hashes, which name the files keys are stored
+    in.
+
+    Parameters:
+        algorithm: Name of algorithm in :py:mod:`hashlib`, or constructor
+                   such as :py:func:`hashlib.sha256`.
+        digest_size: Number of bytes of the digest to use, or `None` for
+                     all of it. BLAKE2 digests are computed with this size,
+                     other digests are truncated.
+        encoding: ``'hex'``, or ``'base32'`` for shorter file names
+                  (lower case and without padding).
+
+    Hashes are created with ``usedforsecurity=False`` where possible
+    (Python 3.9+), so md5 can be used on FIPS mode systems.
+    """
+    _encodings = ('hex', 'base32')
+
+    def __init__(self, algorithm='md5', digest_size=None, encoding='hex'):
+        if encoding not in self._encodings:
+            raise ValueError('encoding must be one of {}.'.format(
+                ', '.join(repr(e) for e in self._encodings)))
+
+        if isinstance(algorithm, six.string_types):
+            constructor = partial(hashlib.new, algorithm.lower())
+        else:
+            constructor = algorithm
+
+        # Key hashes aren't used for security, which allows md5 on FIPS mode
+        # systems. Every call, including this one, must say so.
+        kwargs = dict(usedforsecurity=False)
+        try:
+            hash_obj = constructor(**kwargs)
+        except TypeError:
+            # Python < 3.9
+            kwargs = dict()
+            hash_obj = constructor()
+        # Python 2 names OpenSSL's algorithms in upper case.
+        name = hash_obj.name.lower()
+
+        # Number of bytes to truncate digests to.
+        truncate = None
+        full_size = hash_obj.digest_size
+        if digest_size is not None:
+            if not 0 < digest_size <= full_size:
+                raise ValueError('digest_size must be between 1 and {} for '
+                                 '{}.'.format(full_size, name))
+            if name in ('blake2b', 'blake2s'):
+                kwargs['digest_size'] = digest_size
+            else:
+                truncate = digest_size
+
+        self.algorithm = name
+        self.digest_size = digest_size
+        self.encoding = encoding
+        self._truncate = truncate
+        self._constructor = partial(constructor, **kwargs)
+
+    def new(self, data=b''):
+        """Return new :py:mod:`hashlib` hash object, updated with `data`.
+        """
+        return self._constructor(data)
+
+    def encode(self, hash_obj):
+        """Return key hash for the data `hash_obj` was updated with."""
+        if self._truncate is None and self.encoding == 'hex':
+            return hash_obj.hexdigest()
+        digest = hash_obj.digest()[:self._truncate]
+        if self.encoding == 'hex':
+            return binascii.hexlify(digest).decode('ascii')
+        return base64.b32encode(digest).decode('ascii').rstrip('=').lower()
+
 
 def fullargspec_from_argspec(argspec):
     return FullArgSpec(
@@ -45,7 +168,9 @@ class DecoratorFactory(object):
     help(instance). See http://stackoverflow.com/a/25973438/2093785
     """
     def __init__(self, bucket, method=False, nocache=None, callback=None,
-                 ignore=None):
+                 ignore=None, lock=False, lock_timeout=None,
+                 stale_lock_timeout=None, stale_while_revalidate=None,
+                 cache_exceptions=None, exception_lifetime=None):
         self.bucket = bucket
         self.method = method
         self.nocache = nocache
@@ -57,6 +182,44 @@ class DecoratorFactory(object):
             ignore = ()
         self.ignore = ignore
 
+        self.lock = lock
+        self.lock_timeout = to_seconds(lock_timeout)
+        self.stale_lock_timeout = to_seconds(stale_lock_timeout)
+        self.stale_while_revalidate = to_timedelta(stale_while_revalidate)
+
+        if cache_exceptions is None:
+            cache_exceptions = ()
+        elif isinstance(cache_exceptions, type):
+            cache_exceptions = (cache_exceptions,)
+        self.cache_exceptions = tuple(cache_exceptions)
+
+        exception_lifetime = to_timedelta(exception_lifetime)
+        if exception_lifetime is not None:
+            if not self.cache_exceptions:
+                raise TypeError('exception_lifetime requires '
+                                'cache_exceptions.')
+            if exception_lifetime <= timedelta(0):
+                raise ValueError('exception_lifetime must be positive.')
+            if bucket.lifetime and exception_lifetime > bucket.lifetime:
+                # It would be expired as if saved with a longer lifetime.
+                raise ValueError('exception_lifetime cannot be longer than '
+                                 'the bucket lifetime.')
+        self.exception_lifetime = exception_lifetime
+
+    def cache_exception(self, key_hash, exception):
+        """Cache `exception`, raised by the function for `key_hash`, for
+        `exception_lifetime`. Backends that can't serialize it are ignored.
+        """
+        value = CachedException(exception)
+        try:
+            self.bucket._set_value_with_hash(
+                key_hash, value, lifetime=self.exception_lifetime)
+        except Exception:
+            logger.warning('Exception {!r} could not be cached by {}',
+                           exception, self.bucket.backend)
+            log_handled_exception('Failed to cache exception')
+            self.bucket._forget_hash(key_hash)
+
     def decorate(self, f):
 
         if isinstance(f, property):
@@ -98,6 +261,87 @@ class DecoratorFactory(object):
 
         fsig = (f.__name__, argspec._asdict())
 
+        exclude = set(self.ignore)
+        if self.nocache:
+            exclude.add(self.nocache)
+        if self.method and argspec.args:
+            # The instance is part of the signature separately.
+            exclude.add(argspec.args[0])
+        binder = ArgumentBinder(f, argspec, exclude=exclude)
+
+        # Signatures start with fsig, unless the instance comes first, so
+        # fsig is hashed once and the hash state is copied for each call.
+        if self.method:
+            key_prefix = self.bucket._key_prefix((), size=4)
+        else:
+            key_prefix = self.bucket._key_prefix((fsig,), size=3)
+
+        def hash_signature(signature):
+            return self.bucket._hash_for_key(
+                signature[len(key_prefix.items):], prefix=key_prefix)
+
+        def make_key(args, kwargs):
+            """Return signature and key hash for call, and the arguments used
+            to call callback.
+            """
+            sig_varargs, sig_normargs, callargs = binder.bind(args, kwargs)
+            if argspec.varargs:
+                varargs = callargs[argspec.varargs]
+            else:
+                varargs = ()
+
+            if self.method:
+                sig_instance = get_instance_signature(args[0])
+                signature = (sig_instance, fsig, sig_varargs, sig_normargs)
+            else:
+                signature = (fsig, sig_varargs, sig_normargs)
+
+            key_hash = hash_signature(signature)
+            return signature, key_hash, varargs, callargs
+
+        def check_key(signature, key_hash):
+            """Raise error if state changed (hash is different) during the
+            function call.
+            """
+            post_key_hash = hash_signature(signature)
+            if key_hash != post_key_hash:
+                optional = ''
+                if self.method:
+                    optional = ' or instance state'
+                raise ValueError(
+                    "modification of input parameters{} by function"
+                    " '{}' cannot be cached.".format(optional, f.__name__))
+
+        def skip_cache(callargs):
+            return bool(self.nocache) and callargs[self.nocache]
+
+        def fire_callback(obj, varargs, callargs):
+            logger.info('Function call loaded from cache: {}', f)
+            if self.callback:
+                callinfo = CachedCallInfo(varargs, callargs, obj.value,
+                                          obj.expiration_date)
+                if self.method:
+                    instance = callargs[argspec.args[0]]
+                    self.callback(instance, callinfo)
+                else:
+                    self.callback(callinfo)
+
+        def raise_if_exception(obj):
+            """Raise exception if `obj` holds one cached by
+            :py:meth:`cache_exception`.
+            """
+            if isinstance(obj.value, CachedException):
+                logger.info('Function exception loaded from cache: {}', f)
+                exception = obj.value.exception
+                try:
+                    # Raise a copy, so that the cached exception doesn't
+                    # collect tracebacks.
+                    exception = copy(exception)
+                except Exception:
+                    # Some exceptions can't be made again from their args.
+                    exception.__traceback__ = None
+                raise exception
+
         def load_or_call(f, key_hash, args, kwargs, varargs, callargs):
             """Load function result from cache, or call function and cache
             result.
@@ -106,88 +350,87 @@ class DecoratorFactory(object):
 
             varargs and callargs are used to call callback.
             """
-            skip_cache = False
-            if self.nocache:
-                skip_cache = callargs[self.nocache]
-
             def call_and_cache():
                 logger.info('Calling function {}', f)
-                res = f(*args, **kwargs)
-                obj = self.bucket._update_or_make_obj_with_hash(key_hash, res)
-                self.bucket._set_obj_with_hash(key_hash, obj)
+                try:
+                    res = f(*args, **kwargs)
+                except self.cache_exceptions as e:
+                    self.cache_exception(key_hash, e)
+                    raise
+                self.bucket._set_value_with_hash(key_hash, res)
                 return res
 
+            def load(stale_grace=None):
+                try:
+                    obj = self.bucket._get_obj_from_hash(
+                        key_hash, stale_grace=stale_grace)
+                except KeyStaleError as e:
+                    # Use the stale result now, and replace it in the
+                    # background.
+                    obj = e.obj
+                    self.bucket._revalidate(key_hash, call_and_cache)
+                raise_if_exception(obj)
+                fire_callback(obj, varargs, callargs)
+                return obj.value
+
+            def load_or_call_once():
+                # Another thread or process may have cached the result since
+                # we last checked.
+                with suppress(KeyInvalidError):
+                    return load(), False
+                return call_and_cache(), True
+
+            def lock_and_call():
+                """Call function while holding the key's lock, so that
+                other processes wait for the result instead of calling the
+                function too.
+                """
+                lock = self.bucket._lock_for_hash(
+                    key_hash, timeout=self.lock_timeout,
+                    stale_timeout=self.stale_lock_timeout)
+                with lock as acquired:
+                    if not acquired:
+                        logger.warning('Timed out waiting for lock: {}',
+                                       lock.path)
+                    return load_or_call_once()
+
             called = False
-            if skip_cache:
+            if skip_cache(callargs):
                 result = call_and_cache()
                 called = True
             else:
                 try:
-                    obj = self.bucket._get_obj_from_hash(key_hash)
-                    result = obj.value
+                    result = load(stale_grace=self.stale_while_revalidate)
                 except KeyInvalidError:
-                    result = call_and_cache()
-                    called = True
-                else:
-                    logger.info('Function call loaded from cache: {}', f)
-                    if self.callback:
-                        callinfo = CachedCallInfo(varargs, callargs, result,
-                                                  obj.expiration_date)
-                        if self.method:
-                            instance = callargs[argspec.args[0]]
-                            self.callback(instance, callinfo)
-                        else:
-                            self.callback(callinfo)
+                    # Threads that miss the same key while the function is
+                    # being called wait for its result.
+                    call = lock_and_call if self.lock else load_or_call_once
+                    (result, called), shared = self.bucket._call_flight.do(
+                        key_hash, call)
+                    if shared:
+                        called = False
 
             return result, called
 
         def wrapper(f, *args, **kwargs):
-            normalized_args = normalize_args(f, *args, **kwargs)
-            varargs, normargs, callargs = normalized_args
-            sig_normargs = normargs.copy()
-            sig_varargs = copy(varargs)
-
-            # Delete nocache parameter from call arg used for signature.
-            if self.nocache:
-                del sig_normargs[self.nocache]
-
-            for arg in self.ignore:
-                if arg == argspec.varargs:
-                    sig_varargs = ()
-                elif arg == argspec.varkw:
-                    for kwarg in callargs[argspec.varkw]:
-                        del sig_normargs[kwarg]
-                else:
-                    del sig_normargs[arg]
-
-            if self.method:
-                instance = args[0]
-                # Delete instance parameter from call arg used for signature.
-                del sig_normargs[argspec.args[0]]
-
-                sig_instance = get_instance_signature(instance)
-
-                signature = (sig_instance, fsig, sig_varargs, sig_normargs)
-            else:
-                signature = (fsig, sig_varargs, sig_normargs)
-
             # Make key_hash before function call, and raise error
             # if state changes (hash is different) afterwards.
-            key_hash = self.bucket._hash_for_key(signature)
+            signature, key_hash, varargs, callargs = make_key(args, kwargs)
             ret, called = load_or_call(f, key_hash, args, kwargs, varargs, callargs)
 
             if called:
-                post_key_hash = self.bucket._hash_for_key(signature)
-                if key_hash != post_key_hash:
-                    optional = ''
-                    if self.method:
-                        optional = ' or instance state'
-                    raise ValueError(
-                        "modification of input parameters{} by function"
-                        " '{}' cannot be cached.".format(optional, f.__name__))
+                check_key(signature, key_hash)
 
             return ret
 
+        if iscoroutinefunction(f):
+            # Avoid syntax errors on Python 2 by importing this lazily.
+            from .asyncbuckets import make_coroutine_wrapper
+            wrapper = make_coroutine_wrapper(
+                self, make_key=make_key, check_key=check_key,
+                skip_cache=skip_cache, fire_callback=fire_callback,
+                raise_if_exception=raise_if_exception)
+
         new_function = decorator(wrapper, f)
         new_function.callback = self.add_callback
         if self.property:
@@ -261,6 +504,269 @@ def normalize_args(f, *args, **kwargs):
                           callargs=original_callargs)
 
 
+class ArgumentBinder(object):
+    """Bind call arguments to the parameters of `f`, like
+    :py:func:`normalize_args`, but with the argument specification analysed
+    once, rather than on every call.
+
+    Parameters:
+        f: Function.
+        argspec: :py:class:`FullArgSpec` of `f`.
+        exclude: Names of parameters to leave out of the signature
+                 arguments. If they include ``argspec.varargs`` or
+                 ``argspec.varkw``, variable arguments are left out.
+    """
+    def __init__(self, f, argspec, exclude=()):
+        self.f = f
+        self.args = tuple(argspec.args)
+        self.varargs = argspec.varargs
+        self.varkw = argspec.varkw
+        self.kwonlyargs = tuple(argspec.kwonlyargs)
+        self.named = frozenset(self.args + self.kwonlyargs)
+
+        defaults = argspec.defaults or ()
+        self.num_required = len(self.args) - len(defaults)
+        self.defaults = dict(zip(self.args[self.num_required:], defaults))
+        self.kwonlydefaults = argspec.kwonlydefaults or {}
+
+        exclude = frozenset(exclude)
+        self.exclude_varargs = bool(self.varargs) and self.varargs in exclude
+        self.exclude_varkw = bool(self.varkw) and self.varkw in exclude
+        # Removed from the arguments when making the signature arguments.
+        self.remove = exclude | frozenset(
+            name for name in (self.varargs, self.varkw) if name)
+
+        # inspect.getcallargs handles bound methods and (on Python 2)
+        # parameters that unpack tuples, which are rare enough to leave to
+        # it.
+        self.fast = inspect.isfunction(f) and all(
+            isinstance(arg, str) for arg in self.args)
+
+    def callargs(self, args, kwargs):
+        """Return dictionary of parameter names to arguments, in the same
+        order as :py:func:`inspect.getcallargs`, which is used to raise
+        :py:exc:`TypeError` for invalid calls.
+        """
+        if not self.fast:
+            return inspect.getcallargs(self.f, *args, **kwargs)
+
+        params = self.args
+        num_args = len(params)
+        if len(args) > num_args and not self.varargs:
+            return inspect.getcallargs(self.f, *args, **kwargs)
+
+        callargs = dict(zip(params, args))
+        if self.varargs:
+            callargs[self.varargs] = tuple(args[num_args:])
+        if self.varkw:
+            extra = callargs[self.varkw] = {}
+        for name, value in kwargs.items():
+            if name not in self.named:
+                if not self.varkw:
+                    return inspect.getcallargs(self.f, *args, **kwargs)
+                extra[name] = value
+            elif name in callargs:
+                return inspect.getcallargs(self.f, *args, **kwargs)
+            else:
+                callargs[name] = value
+
+        if len(args) < num_args:
+            for name in params[len(args):self.num_required]:
+                if name not in callargs:
+                    return inspect.getcallargs(self.f, *args, **kwargs)
+            for name in params[max(len(args), self.num_required):]:
+                if name not in callargs:
+                    callargs[name] = self.defaults[name]
+        for name in self.kwonlyargs:
+            if name not in callargs:
+                if name not in self.kwonlydefaults:
+                    return inspect.getcallargs(self.f, *args, **kwargs)
+                callargs[name] = self.kwonlydefaults[name]
+        return callargs
+
+    def bind(self, args, kwargs):
+        """Return :py:class:`NormalizedArgs` for a call. Unlike
+        :py:func:`normalize_args`, `varargs` and `normargs` leave out the
+        excluded parameters.
+        """
+        callargs = self.callargs(args, kwargs)
+        remove = self.remove
+        normargs = {name: value for name, value in callargs.items()
+                    if name not in remove}
+        if self.varkw and not self.exclude_varkw:
+            normargs.update(callargs[self.varkw])
+        if self.varargs and not self.exclude_varargs:
+            varargs = callargs[self.varargs]
+        else:
+            varargs = ()
+        return NormalizedArgs(varargs=varargs, normargs=normargs,
+                              callargs=callargs)
+
+
+TEMPORARY_SUFFIX = '.tmp'
+
+# On Windows, file descriptors are opened in text mode unless O_BINARY is
+# given, and then newlines written through them are translated, which
+# corrupts binary files. tempfile passes it too.
+_TEMPORARY_FLAGS = (os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                    getattr(os, 'O_BINARY', 0))
+
+
+@contextmanager
+def atomic_open(path, mode='wb', mtime_ns=None):
+    """Open a temporary file in the same directory as `path`, which replaces
+    `path` if the block completes without an exception.
+
+    Readers of `path` see either the previous file or the complete new file,
+    never a partially written one.
+
+    If `mtime_ns` is given, the file's modification time is set to it before
+    it replaces `path`.
+    """
+    path = str(path)
+    directory, name = os.path.split(path)
+    token = binascii.hexlify(os.urandom(6)).decode('ascii')
+    temp_name = '.{}.{}{}'.format(name, token, TEMPORARY_SUFFIX)
+    temp_path = os.path.join(directory, temp_name)
+
+    # Unlike tempfile.mkstemp, this respects the umask like open() does.
+    fd = os.open(temp_path, _TEMPORARY_FLAGS, 0o666)
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        if mtime_ns is not None:
+            set_mtime_ns(temp_path, mtime_ns)
+        replace(temp_path, path)
+    except BaseException:
+        with suppress(OSError):
+            os.unlink(temp_path)
+        raise
+
+
+def unlink_if_exists(path):
+    """Remove file at `path`, which may already have been removed by another
+    thread or process.
+
+    Returns:
+        `True` if the file was removed by this call.
+    """
+    try:
+        os.unlink(str(path))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+    else:
+        return True
+
+
+def link_or_rename(src, dst):
+    """Move file from `src` to `dst`, unless `dst` already exists.
+
+    Returns:
+        `True` if the file was moved, or `False` if `dst` exists or `src`
+        doesn't.
+    """
+    try:
+        if hasattr(os, 'link'):
+            # Unlike rename, fails if dst exists.
+            os.link(str(src), str(dst))
+            unlink_if_exists(src)
+        else:
+            # Windows, where rename fails if dst exists.
+            os.rename(str(src), str(dst))
+    except OSError as e:
+        if e.errno not in (errno.EEXIST, errno.ENOENT):
+            raise
+        return False
+    return True
+
+
+def set_mtime_ns(path, mtime_ns):
+    """Set modification time of file at `path` in nanoseconds, and its
+    access time to now.
+    """
+    atime = time.time()
+    try:
+        os.utime(path, ns=(int(atime * _NS), mtime_ns))
+    except TypeError:
+        # Python < 3.3
+        os.utime(path, (atime, mtime_ns / _NS))
+
+
+# Cached files' modification times are set to encode their expiration date,
+# so that it can be checked without loading them. The fractional part of the
+# modification time marks how to read it. Files without a mark (saved by
+# older versions, or on filesystems without sub-second timestamps) must be
+# loaded to check their expiration date.
+_NS = 10 ** 9
+_EXPIRES_MARK = 271828000  # Whole seconds are the expiration date, rounded up.
+_NEVER_EXPIRES_MARK = 314159000  # Whole seconds are the write time.
+
+# Timestamps may be stored with microsecond precision, or set from floats.
+_MARK_TOLERANCE = 2000
+
+
+def expiration_mtime_ns(expiration):
+    """Return modification time in nanoseconds which encodes `expiration`,
+    a POSIX timestamp or `None` if the file never expires.
+    """
+    if expiration is None:
+        return int(time.time()) * _NS + _NEVER_EXPIRES_MARK
+    return int(math.ceil(expiration)) * _NS + _EXPIRES_MARK
+
+
+def expiration_from_stat(stat):
+    """Read expiration date encoded by :py:func:`expiration_mtime_ns`.
+
+    Returns:
+        Tuple of whether the expiration date is known, and the expiration
+        date as a POSIX timestamp, or `None` if the file never expires.
+
+    The expiration date is rounded up to the next second, so a file is never
+    wrongly found to have expired.
+    """
+    mtime_ns = getattr(stat, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(round(stat.st_mtime * _NS))
+    seconds, fraction = divmod(mtime_ns, _NS)
+    if abs(fraction - _EXPIRES_MARK) <= _MARK_TOLERANCE:
+        return True, float(seconds)
+    if abs(fraction - _NEVER_EXPIRES_MARK) <= _MARK_TOLERANCE:
+        return True, None
+    return False, None
+
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def to_timestamp(date):
+    """Convert naive UTC :py:class:`~datetime.datetime` to POSIX timestamp.
+    `None` is returned unchanged.
+    """
+    if date is None:
+        return None
+    return (date - _EPOCH).total_seconds()
+
+
+def to_timedelta(value):
+    """Convert seconds to :py:class:`~datetime.timedelta`.
+    :py:class:`~datetime.timedelta` and `None` are returned unchanged.
+    """
+    if value is None or isinstance(value, timedelta):
+        return value
+    return timedelta(seconds=value)
+
+
+def to_seconds(value):
+    """Convert :py:class:`~datetime.timedelta` to seconds. Numbers and
+    `None` are returned unchanged.
+    """
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return value
+
+
 def raise_invalid_keys(valid_keys, passed_keys, message=None):
     if message is None:
         message = 'Invalid keyword argument{s}: {keys}'
@@ -1,5 +1,13 @@
+import sys
+
 import pytest
 
+collect_ignore = []
+
+if sys.version_info < (3, 5):
+    # async def is a syntax error.
+    collect_ignore.append('tests/test_async.py')
+
 
 def pytest_addoption(parser):
     parser.addoption('--run-slow', action='store_true',
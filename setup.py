@@ -19,7 +19,7 @@ AUTHOR, EMAIL = re.match(r'(.*) <(.*)>', AUTHOR_EMAIL).groups()
 
 requires = [
     'boltons',
-    'decorator>=4.0.2',
+    'decorator>=4.1',
     'logbook>=0.12.5',
     'python-dateutil',
     'represent>=1.5.1',
@@ -29,7 +29,9 @@ requires = [
 
 extras_require = dict()
 
+extras_require[':python_version<"3.2"'] = ['futures']
 extras_require[':python_version<"3.4"'] = ['pathlib']
+extras_require[':python_version<"3.5"'] = ['scandir']
 
 extras_require['test'] = [
     'msgpack-python',
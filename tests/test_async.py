@@ -0,0 +1,207 @@
+from __future__ import absolute_import, division
+
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from bucketcache import AsyncBucket, Bucket
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+@pytest.yield_fixture
+def async_bucket(tmpdir):
+    yield AsyncBucket(str(tmpdir))
+
+
+def test_get_set_delete(async_bucket):
+    async def main():
+        await async_bucket.set('key', 'value')
+        assert await async_bucket.get('key') == 'value'
+        assert await async_bucket.contains('key')
+
+        await async_bucket.delete('key')
+        assert not await async_bucket.contains('key')
+        with pytest.raises(KeyError):
+            await async_bucket.get('key')
+        with pytest.raises(KeyError):
+            await async_bucket.delete('key')
+
+    run(main())
+
+    # Values are on disk as usual.
+    async_bucket['sync'] = 1
+    assert Bucket(async_bucket.path)['sync'] == 1
+
+
+def test_io_in_executor(async_bucket):
+    """File I/O doesn't run on the event loop's thread."""
+    calls = []
+
+    class Executor(object):
+        def submit(self, function, *args, **kwargs):
+            calls.append(function)
+            return executor.submit(function, *args, **kwargs)
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        bucket = AsyncBucket(async_bucket.path, executor=Executor())
+
+        async def main():
+            await bucket.set('key', 'value')
+            return await bucket.get('key')
+
+        assert run(main()) == 'value'
+    assert len(calls) == 2
+
+
+@pytest.mark.parametrize('bucket_class', [Bucket, AsyncBucket])
+def test_coroutine_function(tmpdir, bucket_class):
+    bucket = bucket_class(str(tmpdir))
+    calls = []
+
+    @bucket
+    async def add1(a):
+        calls.append(a)
+        await asyncio.sleep(0.01)
+        return a + 1
+
+    assert asyncio.iscoroutinefunction(add1)
+
+    async def main():
+        # Concurrent calls for the same key await one call.
+        results = await asyncio.gather(*[add1(1) for _ in range(10)])
+        assert results == [2] * 10
+        assert await add1(2) == 3
+        assert await add1(1) == 2
+
+    run(main())
+    assert calls == [1, 2]
+
+    # The result is cached, not the coroutine object.
+    @bucket_class(str(tmpdir))
+    async def add1(a):
+        raise AssertionError('Result should be loaded from file.')
+
+    assert run(add1(1)) == 2
+
+
+def test_coroutine_callback_and_nocache(async_bucket):
+    calls = []
+    callbacks = []
+
+    @async_bucket(nocache='refresh')
+    async def double(a, refresh=False):
+        calls.append(a)
+        return a * 2
+
+    @double.callback
+    def double(callinfo):
+        callbacks.append(callinfo.return_value)
+
+    async def main():
+        assert await double(2) == 4
+        assert await double(2) == 4
+        assert await double(2, refresh=True) == 4
+
+    run(main())
+    assert calls == [2, 2]
+    assert callbacks == [4]
+
+
+def test_coroutine_exception(async_bucket):
+    calls = []
+
+    @async_bucket
+    async def fail():
+        calls.append(None)
+        await asyncio.sleep(0.01)
+        raise ValueError
+
+    async def main():
+        results = await asyncio.gather(fail(), fail(), return_exceptions=True)
+        assert all(isinstance(r, ValueError) for r in results)
+
+    run(main())
+    assert len(calls) == 1
+    assert not async_bucket._cache
+
+
+def test_coroutine_cache_exceptions(async_bucket):
+    calls = []
+
+    @async_bucket(cache_exceptions=LookupError)
+    async def fail():
+        calls.append(None)
+        raise KeyError('missing')
+
+    async def main():
+        for _ in range(2):
+            with pytest.raises(KeyError):
+                await fail()
+
+    run(main())
+    assert len(calls) == 1
+
+
+def test_get_or_set_stale(tmpdir):
+    bucket = AsyncBucket(str(tmpdir), hours=1)
+    values = iter(range(10))
+
+    async def function():
+        return next(values)
+
+    async def main():
+        assert await bucket.get_or_set('key', function) == 0
+        assert await bucket.get_or_set('key', function) == 0
+
+        for obj in bucket._cache.values():
+            obj.expiration_date = datetime.utcnow() - timedelta(seconds=1)
+
+        assert await bucket.get_or_set('key', function,
+                                       stale_while_revalidate=60) == 0
+        # Let the revalidation task finish.
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if await bucket.contains('key'):
+                break
+        assert await bucket.get('key') == 1
+
+    run(main())
+
+
+def test_coroutine_miss_during_revalidation(tmpdir):
+    """A miss for a key being revalidated awaits the new result."""
+    bucket = AsyncBucket(str(tmpdir), hours=1)
+    calls = []
+
+    @bucket(stale_while_revalidate=timedelta(minutes=5))
+    async def pair(name):
+        calls.append(name)
+        if len(calls) > 1:
+            await asyncio.sleep(0.1)
+        # A 2-tuple, which mustn't be mistaken for (result, called).
+        return name, len(calls)
+
+    def expire(**kwargs):
+        for obj in bucket._cache.values():
+            obj.expiration_date = datetime.utcnow() - timedelta(**kwargs)
+
+    async def main():
+        assert await pair('spam') == ('spam', 1)
+        expire(seconds=1)
+        assert await pair('spam') == ('spam', 1)
+
+        # Outside the grace period, the call awaits the revalidation task.
+        expire(minutes=10)
+        assert await pair('spam') == ('spam', 2)
+
+    run(main())
+    assert calls == ['spam', 'spam']
@@ -1,10 +1,16 @@
 from __future__ import absolute_import, division
 
+import pickle
 import random
+import threading
 
 import pytest
 
-from bucketcache import deferred_write
+from bucketcache import (
+    Bucket, PackBucket, PickleConfig, SQLiteBucket, deferred_write)
+from bucketcache.compression import _codecs
+from bucketcache.keymakers import (
+    DefaultKeyMaker, StreamingDefaultKeyMaker, StructuralKeyMaker)
 
 from . import *
 
@@ -26,6 +32,45 @@ def test_cache_overhead(cache_all, benchmark):
         square(4, skip_cache=True)
 
 
+@slow
+@pytest.mark.benchmark(group='call overhead')
+def test_cache_hit_overhead(cache_all, benchmark):
+    """Check overhead of loading the result of a cheap function from
+    memory.
+    """
+    cache = cache_all
+
+    @cache
+    def square(a, b=2, *args, **kwargs):
+        return a ** 2
+
+    square(4, c=1)
+
+    @benchmark
+    def square_four():
+        square(4, c=1)
+
+
+@slow
+@pytest.mark.benchmark(group='call overhead')
+def test_cache_hit_long_signature(cache_all, benchmark):
+    """Check overhead of loading the result of a function with many
+    parameters, most of which are left at their defaults.
+    """
+    cache = cache_all
+
+    @cache
+    def function(a, b=1, c=2, d=3, e=4, f=5, g=6, h=7, i=8, j=9, k=10,
+                 l=11, m='x' * 50, n=None, o=(1, 2, 3)):
+        return a
+
+    function(4)
+
+    @benchmark
+    def function_four():
+        function(4)
+
+
 @slow
 @pytest.mark.benchmark(group='call overhead')
 def test_cache_no_overhead(cache_all, benchmark):
@@ -68,5 +113,176 @@ def test_standard_performance(cache_all, benchmark):
             for i in range(10):
                 cache[i] = random.random()
 
+
+@slow
+@pytest.mark.benchmark(group='thread contention')
+@pytest.mark.parametrize('threads', [1, 2, 4, 8])
+def test_thread_contention(tmpdir, benchmark, threads):
+    """Read hot keys from a thread-safe bucket with a fixed total amount of
+    work split between threads. On interpreters without a GIL, time should
+    fall as threads are added.
+    """
+    cache = Bucket(str(tmpdir), thread_safe=True)
+    keys = list(range(100))
+    for key in keys:
+        cache[key] = key
+
+    def read_keys():
+        for _ in range(80 // threads):
+            for key in keys:
+                cache[key]
+
+    @benchmark
+    def contended_reads():
+        workers = [threading.Thread(target=read_keys)
+                   for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+
+@slow
+@pytest.mark.benchmark(group='bulk reads')
+@pytest.mark.parametrize('bulk', [False, True], ids=['getitem', 'get_many'])
+def test_bulk_reads(tmpdir, benchmark, bulk):
+    """Read keys that aren't in memory one at a time, or with get_many."""
+    cache = Bucket(str(tmpdir))
+    keys = list(range(500))
+    cache.set_many((key, key) for key in keys)
+
+    def unload():
+        cache._cache.clear()
+
+    def read_keys():
+        if bulk:
+            cache.get_many(keys)
+        else:
+            for key in keys:
+                cache[key]
+
+    benchmark.pedantic(read_keys, setup=unload, rounds=10)
+
+
+@slow
+@pytest.mark.benchmark(group='prune')
+def test_prune_directory(tmpdir, benchmark):
+    """Prune a fan-out bucket where no file has expired, so every file is
+    checked and none are deleted.
+    """
+    cache = Bucket(str(tmpdir), days=1, fanout_depth=1)
+    cache.set_many((key, key) for key in range(2000))
+
+    benchmark(cache.prune_directory)
+
+
+@slow
+@requires_python_version(3, 8)
+@pytest.mark.benchmark(group='large buffer loads')
+@pytest.mark.parametrize('threshold', [None, 2 ** 16],
+                         ids=['in-band', 'out-of-band'])
+def test_large_buffer_load(tmpdir, benchmark, threshold):
+    """Load a 64 MiB buffer, which is copied when pickled in-band and
+    memory-mapped when pickled out-of-band.
+    """
+    config = PickleConfig(protocol=5, buffer_threshold=threshold)
+    cache = Bucket(str(tmpdir), config=config)
+    cache['key'] = pickle.PickleBuffer(bytearray(64 * 2 ** 20))
+
+    def unload():
+        cache._cache.clear()
+
+    benchmark.pedantic(lambda: cache['key'], setup=unload, rounds=10)
+
+
+@slow
+@pytest.mark.benchmark(group='compression')
+@pytest.mark.parametrize('codec', [None] + sorted(_codecs))
+def test_compression_codecs(tmpdir, benchmark, codec):
+    """Write and read a compressible value. The compression ratio is saved
+    in the benchmark's extra info, to compare with its throughput.
+    """
+    cache = Bucket(str(tmpdir), compression=codec)
+    value = [{'id': i, 'name': 'item {}'.format(i), 'tags': ['a', 'b']}
+             for i in range(10000)]
+
+    def write_and_read():
+        cache['key'] = value
+        cache._cache.clear()
+        cache['key']
+
+    benchmark(write_and_read)
+
+    plain_size = len(pickle.dumps(value, protocol=2)) + 50
+    size = cache._path_for_key('key').stat().st_size
+    benchmark.extra_info['ratio'] = plain_size / size
+
+
+@slow
+@pytest.mark.benchmark(group='key hashing')
+@pytest.mark.parametrize('algorithm', ['md5', 'sha256', 'blake2b'])
+def test_key_hashing(tmpdir, benchmark, algorithm):
+    """Hash a large key."""
+    bucket = Bucket(str(tmpdir), hash_algorithm=algorithm,
+                    hash_digest_size=16)
+    key = 'x' * 2 ** 20
+    benchmark(bucket._hash_for_key, key)
+
+
+@slow
+@pytest.mark.benchmark(group='storage engines')
+@pytest.mark.parametrize('engine', [Bucket, PackBucket, SQLiteBucket])
+def test_storage_engines(tmpdir, benchmark, engine):
+    """Write and read many small objects."""
+    bucket = engine(str(tmpdir))
+
+    def write_and_read():
+        for i in range(1000):
+            bucket[i] = 'small value {}'.format(i)
+        bucket._cache.clear()
+        for i in range(1000):
+            bucket[i]
+
+    benchmark(write_and_read)
+    bucket.close()
+
+
+class _Point(object):
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+@slow
+@pytest.mark.benchmark(group='key makers')
+@pytest.mark.parametrize('keymaker', [
+    DefaultKeyMaker, StreamingDefaultKeyMaker, StructuralKeyMaker])
+@pytest.mark.parametrize('objects', [False, True],
+                         ids=['builtins', 'objects'])
+def test_keymakers(tmpdir, benchmark, keymaker, objects):
+    """Hash a large structure of arguments, made of built-in types or of
+    other objects.
+    """
+    bucket = Bucket(str(tmpdir), keymaker=keymaker())
+    if objects:
+        items = [_Point(i, i * 0.5) for i in range(10000)]
+    else:
+        items = [{'id': i, 'name': 'item {}'.format(i), 'tags': ['a', 'b'],
+                  'values': (i * 0.5, None, True)} for i in range(10000)]
+    benchmark(bucket._hash_for_key, ('function', items))
+
+
+@slow
+@pytest.mark.benchmark(group='key makers')
+@pytest.mark.parametrize('keymaker', [
+    DefaultKeyMaker, StreamingDefaultKeyMaker, StructuralKeyMaker])
+def test_keymakers_small_key(tmpdir, benchmark, keymaker):
+    """Hash a key like those of decorated functions."""
+    bucket = Bucket(str(tmpdir), keymaker=keymaker())
+    key = (('function', {'args': ['a', 'b'], 'defaults': [1]}),
+           (), {'a': 1, 'b': 'two'})
+    benchmark(bucket._hash_for_key, key)
+
+
 if __name__ == '__main__':
     pytest.main()
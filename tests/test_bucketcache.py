@@ -1,13 +1,24 @@
 from __future__ import absolute_import, division
 
+import hashlib
+import json
+import pickle
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from time import sleep
 
 import pytest
+import six
 
 from bucketcache import Bucket, deferred_write, DeferredWriteBucket
-from bucketcache.backends import Backend, MessagePackBackend, PickleBackend
+from bucketcache.backends import (
+    Backend, JSONBackend, MessagePackBackend, PickleBackend)
 from bucketcache.config import PickleConfig
+from bucketcache.keymakers import (
+    DefaultKeyMaker, StreamingDefaultKeyMaker, StructuralKeyMaker)
+from bucketcache.utilities import (
+    KeyHasher, expiration_from_stat, expiration_mtime_ns, set_mtime_ns,
+    to_timestamp)
 
 from . import *
 
@@ -16,6 +27,11 @@ try:
 except ImportError:
     from mock import patch
 
+try:
+    import msgpack
+except ImportError:
+    pass
+
 
 class CustomObject(object):
     def __init__(self, here, be, parameters):
@@ -147,6 +163,72 @@ def test_default_keymaker(keymakers_all):
     assert b''.join(keymaker.make_key(c)) == b'{"a": 1, "b": 2}'
     assert b''.join(keymaker.make_key(d)) == b'"getstate"'
 
+    keymaker.sort_keys = False
+    unsorted = OrderedDict([('b', 1), ('a', 2)])
+    assert b''.join(keymaker.make_key(unsorted)) == b'{"b": 1, "a": 2}'
+    assert repr(keymaker).endswith('(sort_keys=False)')
+
+
+def test_structural_keymaker(tmpdir):
+    keymaker = StructuralKeyMaker()
+
+    def key(obj):
+        return b''.join(keymaker.make_key(obj))
+
+    class A(object):
+        def __init__(self, a, b):
+            self.a = a
+            self.b = b
+
+    class B(A):
+        pass
+
+    class Tuple(tuple):
+        pass
+
+    # Values of different types never make the same key. On Python 2, '1'
+    # would be bytes.
+    values = [None, True, 1, 1.0, u'1', b'1', (1,), [1], {1}, frozenset([1]),
+              {1: None}, Tuple((1,)), ('1',), (1, 2), ((1, 2),), [[1], 2],
+              [1, [2]], A(1, 2), B(1, 2), A, B, len, -0.0, 0.0]
+    keys = [key(value) for value in values]
+    assert len(set(keys)) == len(values)
+    assert key(1) == b'i1;'
+    assert key(2 ** 70) == b'i' + str(2 ** 70).encode('ascii') + b';'
+    assert key((u'ab', [b'c'])) == b'(2:s2:ab[1:b1:c'
+
+    # Keys don't depend on insertion order.
+    assert key({'a': 1, 2: 'b', (3,): None}) == key(
+        {(3,): None, 2: 'b', 'a': 1})
+    assert key({'b', 'a', 3}) == key({3, 'a', 'b'})
+    assert key(A([1, 2], {'x': 3})) == key(A([1, 2], {'x': 3}))
+
+    circular = []
+    circular.append(circular)
+    with pytest.raises(ValueError):
+        key(circular)
+
+    # Bytes are written in chunks of about chunk_size.
+    chunks = []
+    StructuralKeyMaker(chunk_size=100).write_key(list(range(1000)),
+                                                 chunks.append)
+    assert len(chunks) > 10
+    assert max(len(chunk) for chunk in chunks) < 200
+    assert b''.join(chunks) == key(list(range(1000)))
+
+    bucket = Bucket(str(tmpdir), keymaker=keymaker)
+    bucket[('a', [1, 2], {'b': A(1, 2)})] = 'value'
+    bucket.unload_key(('a', [1, 2], {'b': A(1, 2)}))
+    assert bucket[('a', [1, 2], {'b': A(1, 2)})] == 'value'
+    assert ('a', [1, 2], {'b': B(1, 2)}) not in bucket
+
+    # These keys are the same with DefaultKeyMaker.
+    for colliding in [[(1, 2), [1, 2]], [A(1, 2), B(1, 2), {'a': 1, 'b': 2}]]:
+        for i, k in enumerate(colliding):
+            bucket[k] = i
+        for i, k in enumerate(colliding):
+            assert bucket[k] == i
+
 
 def test_unknown_load_error(tmpdir):
     # Ensure that unknown error in backend load from file bubbles up.
@@ -344,6 +426,23 @@ def test_deferred_context(cache_all):
     assert path.exists()
 
 
+def test_deferred_context_shared_state(tmpdir):
+    """The deferred bucket uses the original bucket's memory cache, key
+    locks and index instead of creating its own.
+    """
+    cache = Bucket(str(tmpdir), thread_safe=True, max_disk_entries=10)
+    with patch('bucketcache.buckets.ManifestIndex') as manifest_index:
+        with deferred_write(cache) as deferred_cache:
+            assert deferred_cache._cache is cache._cache
+            assert deferred_cache._key_locks is cache._key_locks
+            assert deferred_cache._index is cache._index
+            assert deferred_cache.thread_safe
+            assert deferred_cache.max_disk_entries == 10
+            deferred_cache['a'] = 'a'
+    assert not manifest_index.called
+    assert cache._index.get(cache._hash_for_key('a')) is not None
+
+
 def test_deferred_unload(deferred_cache_all):
     """Test unload_key for DeferredWriteBucket"""
     cache = deferred_cache_all
@@ -401,5 +500,513 @@ def test_msgpack(tmpdir):
     bucketcache.backends.msgpack_available = msgpack_available
 
 
+@pytest.mark.parametrize('make_value', [
+    lambda: 'x' * 2 ** 21,
+    lambda: list(range(2 ** 18)),
+    lambda: dict.fromkeys(range(2 ** 16), 1),
+    pytest.param(lambda: 'x' * (101 * 2 ** 20), marks=slow),
+], ids=['str', 'array', 'map', '101MiB'])
+def test_msgpack_large_values(tmpdir, make_value):
+    """Values larger than msgpack's default unpacking limits are loaded."""
+    cache = Bucket(str(tmpdir), backend=MessagePackBackend)
+    value = make_value()
+    cache['a'] = value
+    cache.unload_key('a')
+    assert cache['a'] == value
+
+
+def test_fanout(tmpdir):
+    """Test that fan-out layout stores files in nested directories, and that
+    migrate_layout moves files between layouts.
+    """
+    flat = Bucket(str(tmpdir))
+    for i in range(10):
+        flat[i] = i
+
+    bucket = Bucket(str(tmpdir), fanout_depth=2, fanout_width=2)
+    assert 0 not in bucket
+
+    assert bucket.migrate_layout() == 10
+    for i in range(10):
+        assert bucket[i] == i
+        path = bucket._path_for_key(i)
+        key_hash = path.stem
+        assert path.parent.name == key_hash[2:4]
+        assert path.parent.parent.name == key_hash[:2]
+        assert path.parent.parent.parent == bucket.path
+
+    bucket[10] = 10
+    assert bucket._path_for_key(10).exists()
+    assert bucket.migrate_layout() == 0
+    assert bucket.prune_directory().num == 0
+
+    # Migrating back removes the empty directories.
+    flat.migrate_layout()
+    assert len(list(flat.path.iterdir())) == 11
+    for i in range(11):
+        assert flat[i] == i
+
+    with pytest.raises(ValueError):
+        Bucket(str(tmpdir), fanout_depth=-1)
+
+    with pytest.raises(ValueError):
+        Bucket(str(tmpdir), fanout_width=0)
+
+
+def test_atomic_write(cache_all):
+    """A failed write leaves the previous file intact, and no temporary
+    files behind.
+    """
+    cache = cache_all
+
+    cache['my key'] = 'this'
+    path = cache._path_for_key('my key')
+
+    with patch.object(cache.backend, 'dump', side_effect=RuntimeError):
+        with pytest.raises(RuntimeError):
+            cache['my key'] = 'that'
+
+    assert list(cache.path.iterdir()) == [path]
+    cache.unload_key('my key')
+    assert cache['my key'] == 'this'
+
+
+def test_prune_temporary_files(tmpdir):
+    cache = Bucket(str(tmpdir))
+    cache['my key'] = 'this'
+
+    stale = tmpdir.join('.stale.pickle.0123456789ab.tmp')
+    stale.write('partial')
+    stale.setmtime(stale.mtime() - 2 * cache._temporary_file_lifetime)
+    recent = tmpdir.join('.recent.pickle.0123456789ab.tmp')
+    recent.write('partial')
+
+    assert cache.prune_directory().num == 1
+    assert not stale.exists()
+    assert recent.exists()
+    assert cache['my key'] == 'this'
+
+
+@pytest.mark.parametrize('index', [False, True])
+def test_iter_prune_directory(tmpdir, index):
+    cache = Bucket(str(tmpdir), seconds=10, fanout_depth=1, index=index)
+    cache.set_many((i, i) for i in range(30))
+    cache.unload_key(0)
+    partitions = sorted(set(path.parent.name for path in
+                            (cache._path_for_key(i) for i in range(30))))
+
+    later = datetime.utcnow() + timedelta(seconds=20)
+    with patch('bucketcache.buckets.datetime') as mock_datetime:
+        mock_datetime.utcnow.return_value = later
+
+        # Interrupt after the first partition, then resume.
+        progress = cache.iter_prune_directory()
+        first = next(progress)
+        progress.close()
+        assert first.checkpoint == partitions[0]
+        assert first.num == first.checked > 0
+
+        results = list(cache.iter_prune_directory(
+            resume_from=first.checkpoint))
+
+    checkpoints = [result.checkpoint for result in results]
+    assert checkpoints[:-1] == partitions[1:]
+    assert results[-1].checkpoint == partitions[-1]
+    assert first.num + results[-1].num == 30
+    assert not any(cache._path_for_key(i).exists() for i in range(30))
+
+    # Pruned objects are removed from memory, and nothing is loaded.
+    assert not any(cache._hash_for_key(i) in cache._cache for i in range(30))
+
+
+@requires_python_version(3, 8)
+def test_pickle_out_of_band_buffers(tmpdir):
+    config = PickleConfig(protocol=5, buffer_threshold=1024)
+    cache = Bucket(str(tmpdir), config=config)
+    large = bytearray(b'x' * 5000)
+    small = bytearray(b'y' * 10)
+    cache['a'] = [pickle.PickleBuffer(large), pickle.PickleBuffer(small), 1]
+    cache['b'] = 'no buffers'
+
+    cache.unload_key('a')
+    cache.unload_key('b')
+    value = cache['a']
+
+    # The large buffer is mapped from the file, at an aligned offset.
+    assert isinstance(value[0], memoryview)
+    assert value[0].readonly
+    assert value[0] == large
+    assert value[1] == small
+    assert value[2] == 1
+    assert cache['b'] == 'no buffers'
+
+    size = cache._path_for_key('a').stat().st_size
+    assert size == PickleBackend.buffer_alignment + len(large)
+
+    # Metadata is read without mapping the buffers.
+    with cache._path_for_key('a').open('rb') as f:
+        metadata = PickleBackend.metadata_from_file(f, config=config)
+    assert metadata.expiration_date is None
+
+    with pytest.raises(ValueError):
+        PickleConfig(buffer_threshold=1024)
+
+
+def test_many(cache_all):
+    cache = cache_all
+
+    cache.set_many({'a': 1, 'b': 2})
+    cache.set_many([('c', 3), ('d', 4)])
+    cache.unload_key('a')
+    cache.unload_key('c')
+
+    result = cache.get_many(['a', 'b', 'c', 'x'])
+    assert result.found == {'a': 1, 'b': 2, 'c': 3}
+    assert result.missing == ['x']
+
+    # Files are written.
+    newcache = Bucket(cache.path, backend=cache.backend)
+    assert newcache.get_many(['a', 'd']).found == {'a': 1, 'd': 4}
+
+    assert cache.delete_many(['a', 'b', 'x']) == ['x']
+    assert cache.get_many(['a', 'b', 'c', 'd']).missing == ['a', 'b']
+    assert not cache._path_for_key('a').exists()
+
+
+def test_many_expired(tmpdir):
+    cache = Bucket(str(tmpdir), seconds=10)
+    cache.set_many({'a': 1, 'b': 2})
+    cache.unload_key('b')
+
+    with patch('bucketcache.backends.datetime') as mock_datetime:
+        mock_datetime.utcnow.return_value = (
+            datetime.utcnow() + timedelta(seconds=20))
+        result = cache.get_many(['a', 'b'])
+
+    assert result.found == {}
+    assert result.missing == ['a', 'b']
+    assert not cache._path_for_key('b').exists()
+
+
+def test_delete_many_expired(tmpdir):
+    """Expired objects count as missing, like with __delitem__."""
+    cache = Bucket(str(tmpdir), milliseconds=50)
+    cache.set_many({'a': 1, 'b': 2, 'c': 3, 'd': 4})
+    cache.unload_key('b')
+    cache.unload_key('d')
+    sleep(0.1)
+
+    for key in ['a', 'b']:
+        with pytest.raises(KeyError):
+            del cache[key]
+    assert cache.delete_many(['c', 'd']) == ['c', 'd']
+    assert not cache._path_for_key('c').exists()
+    assert not cache._path_for_key('d').exists()
+
+
+def test_deferred_many(deferred_cache_all):
+    cache = deferred_cache_all
+
+    cache.set_many({'a': 1, 'b': 2})
+    assert not cache._path_for_key('a').exists()
+    assert cache.get_many(['a', 'b']).found == {'a': 1, 'b': 2}
+
+    assert cache.delete_many(['a']) == []
+    cache.sync()
+    assert not cache._path_for_key('a').exists()
+    assert cache._path_for_key('b').exists()
+    assert 'a' not in cache
+
+
+def test_stat_expiry(tmpdir):
+    cache = Bucket(str(tmpdir), seconds=10)
+    cache['a'] = 'a'
+    cache['b'] = 'b'
+    path_a = cache._path_for_key('a')
+    path_b = cache._path_for_key('b')
+
+    # The expiration date is encoded in the modification time, rounded up.
+    known, expiration = expiration_from_stat(path_a.stat())
+    obj = cache._get_obj('a')
+    assert known
+    assert 0 <= expiration - to_timestamp(obj.expiration_date) <= 1
+
+    # Files that have expired according to their modification time aren't
+    # loaded, and aren't opened to check their expiration.
+    cache['c'] = 'c'
+    path_c = cache._path_for_key('c')
+    past = to_timestamp(datetime.utcnow()) - 60
+    for key, path in [('a', path_a), ('b', path_b), ('c', path_c)]:
+        set_mtime_ns(str(path), expiration_mtime_ns(past))
+        cache.unload_key(key)
+    with patch.object(PickleBackend, 'from_file', side_effect=RuntimeError):
+        with pytest.raises(KeyError):
+            cache['a']
+    assert not path_a.exists()
+    with patch.object(Bucket, '_open_for_read', side_effect=RuntimeError):
+        assert 'b' not in cache
+        assert cache.prune_directory().num == 1
+    assert not path_b.exists()
+    assert not path_c.exists()
+
+    # Files that never expire are marked too.
+    cache = Bucket(str(tmpdir))
+    cache['c'] = 'c'
+    stat = cache._path_for_key('c').stat()
+    assert expiration_from_stat(stat) == (True, None)
+
+
+def test_stat_expiry_rounding(tmpdir):
+    """Within a second of the rounded up expiration date in a modification
+    time, membership reads the exact date like loading does.
+    """
+    cache = Bucket(str(tmpdir))
+    for key in ['a', 'b']:
+        key_hash = cache._hash_for_key(key)
+        cache._set_value_with_hash(key_hash, key,
+                                   lifetime=timedelta(microseconds=1))
+        cache.unload_key(key)
+        now = to_timestamp(datetime.utcnow())
+        set_mtime_ns(str(cache._path_for_key(key)), expiration_mtime_ns(now))
+
+    assert 'a' not in cache
+    with pytest.raises(KeyError):
+        cache['b']
+
+
+def test_stat_expiry_legacy(tmpdir):
+    """Files without an expiration date in their modification time are
+    loaded to check it.
+    """
+    cache = Bucket(str(tmpdir), seconds=10)
+    cache['a'] = 'a'
+    path = cache._path_for_key('a')
+    path.touch()
+    assert expiration_from_stat(path.stat()) == (False, None)
+
+    cache.unload_key('a')
+    assert cache['a'] == 'a'
+    assert cache.prune_directory().num == 0
+    assert path.exists()
+
+
+def test_metadata(cache_all):
+    """Membership and deletion don't load values."""
+    cache = cache_all
+    cache['a'] = 'a'
+    cache['b'] = 'b'
+    expiration_date = cache._get_obj('a').expiration_date
+    cache.unload_key('a')
+    cache.unload_key('b')
+
+    path = cache._path_for_key('a')
+    with path.open(cache._read_mode) as f:
+        metadata = cache.backend.metadata_from_file(f)
+    assert metadata.expiration_date == expiration_date
+
+    # Remove expiration date from modification times, so metadata is read.
+    path.touch()
+    cache._path_for_key('b').touch()
+
+    with patch.object(cache.backend, 'from_file', side_effect=RuntimeError):
+        assert 'a' in cache
+        assert 'x' not in cache
+        del cache['b']
+        assert 'b' not in cache
+        assert cache.prune_directory().num == 0
+    assert cache['a'] == 'a'
+
+
+def _dump_legacy(backend, path, value, expiration_date):
+    """Write file in the format used before metadata was written
+    separately.
+    """
+    if backend is PickleBackend:
+        with path.open('wb') as f:
+            pickle.dump(
+                {'value': value, 'expiration_date': expiration_date}, f)
+        return
+
+    if expiration_date:
+        expiration_date = expiration_date.isoformat()
+    data = {'value': value, 'expiration_date': expiration_date}
+    if backend is JSONBackend:
+        # Text files need unicode on Python 2, which json.dump doesn't write.
+        with path.open('w') as f:
+            f.write(six.text_type(json.dumps(data, indent=2)))
+    else:
+        with path.open('wb') as f:
+            msgpack.pack(data, f)
+
+
+def test_unknown_format(cache_all):
+    """Files with an unknown format version are treated as missing."""
+    cache = cache_all
+    with patch('bucketcache.backends._FORMAT_VERSION', 2):
+        cache['a'] = 'a'
+    cache.unload_key('a')
+    with pytest.raises(KeyError):
+        cache['a']
+
+    cache['a'] = 'a'
+    cache.unload_key('a')
+    assert cache['a'] == 'a'
+
+
+def test_legacy_format(cache_all):
+    cache = Bucket(cache_all.path, backend=cache_all.backend, seconds=10)
+    expiration_date = datetime.utcnow() + timedelta(seconds=5)
+    path = cache._path_for_key('a')
+    _dump_legacy(cache.backend, path, [1, 2], expiration_date)
+
+    with path.open(cache._read_mode) as f:
+        metadata = cache.backend.metadata_from_file(f)
+    assert metadata.expiration_date == expiration_date
+    assert 'a' in cache
+    assert cache['a'] == [1, 2]
+
+    _dump_legacy(cache.backend, path, [1, 2],
+                 datetime.utcnow() - timedelta(seconds=5))
+    cache.unload_key('a')
+    assert cache.prune_directory().num == 1
+    assert not path.exists()
+
+
+@pytest.mark.parametrize('value', ['short', ['long'] * 1000])
+@pytest.mark.parametrize('sort_keys', [False, True])
+def test_legacy_json_single_line(tmpdir, value, sort_keys):
+    """Single line files in the legacy format are only parsed once."""
+    cache = Bucket(str(tmpdir), backend=JSONBackend, seconds=10)
+    expiration_date = datetime.utcnow() + timedelta(seconds=5)
+    path = cache._path_for_key('a')
+    with path.open('w') as f:
+        f.write(six.text_type(json.dumps(
+            {'value': value, 'expiration_date': expiration_date.isoformat()},
+            sort_keys=sort_keys)))
+
+    loaded = []
+    json_loads = json.loads
+
+    def loads(s, **kwargs):
+        loaded.append(s)
+        return json_loads(s, **kwargs)
+
+    with patch('bucketcache.backends.json.loads', side_effect=loads):
+        assert cache['a'] == value
+    assert len([s for s in loaded if len(s) > 128]) <= 1
+
+
+@pytest.mark.parametrize('algorithm, digest_size, encoding, length', [
+    ('md5', None, 'hex', 32),
+    pytest.param('blake2b', 16, 'hex', 32, marks=pytest.mark.skipif(
+        'blake2b' not in hashlib.algorithms_available,
+        reason='Requires BLAKE2')),
+    ('sha256', None, 'base32', 52),
+    (hashlib.sha256, 10, 'base32', 16),
+])
+def test_hash_algorithm(tmpdir, algorithm, digest_size, encoding, length):
+    bucket = Bucket(str(tmpdir), hash_algorithm=algorithm,
+                    hash_digest_size=digest_size, hash_encoding=encoding,
+                    fanout_depth=1)
+    bucket['a'] = 'a'
+    bucket.unload_key('a')
+    assert bucket['a'] == 'a'
+
+    key_hash = bucket._path_for_key('a').stem
+    assert len(key_hash) == length
+    assert key_hash == key_hash.lower()
+    if algorithm == 'md5':
+        assert bucket._hash_for_key('a') == hashlib.md5(
+            b'PickleBackend' + b''.join(bucket.keymaker.make_key('a'))
+        ).hexdigest()
+
+    with pytest.raises(ValueError):
+        Bucket(str(tmpdir), hash_algorithm=algorithm, hash_digest_size=100)
+    with pytest.raises(ValueError):
+        Bucket(str(tmpdir), hash_encoding='base64')
+
+
+@requires_python_version(3, 9)
+def test_key_hasher_fips():
+    """Hash objects are never created for security, as FIPS mode systems
+    don't allow md5 for security.
+    """
+    def fips_md5(*args, **kwargs):
+        if kwargs.get('usedforsecurity', True):
+            raise ValueError('md5 is disabled for FIPS')
+        return hashlib.md5(*args, **kwargs)
+
+    hasher = KeyHasher(fips_md5, digest_size=8)
+    assert hasher.encode(hasher.new(b'a')) == (
+        hashlib.md5(b'a').hexdigest()[:16])
+
+
+@pytest.mark.parametrize('keymaker', [
+    DefaultKeyMaker, StreamingDefaultKeyMaker, StructuralKeyMaker])
+def test_key_prefix(tmpdir, keymaker):
+    """Keys hashed from a prefix have the same hash as the whole key."""
+    bucket = Bucket(str(tmpdir), keymaker=keymaker())
+    constant = ('f', {'args': ['a', 'b'], 'defaults': None})
+    for items, size in [((), 2), ((constant,), 3), ((constant, 1), 3)]:
+        prefix = bucket._key_prefix(items, size)
+        for rest in [(1, {'b': [2]}, None), ((), {}, 'x'), ('a' * 10**5,) * 3]:
+            rest = rest[:size - len(items)]
+            assert bucket._hash_for_key(rest, prefix=prefix) == (
+                bucket._hash_for_key(items + rest))
+
+    # The prefix isn't used after the key maker changes.
+    prefix = bucket._key_prefix((constant,), 2)
+    bucket.keymaker = StructuralKeyMaker(chunk_size=10)
+    assert bucket._hash_for_key((1,), prefix=prefix) == (
+        bucket._hash_for_key((constant, 1)))
+
+    # Key makers that can't split keys hash the whole key.
+    class ReprKeyMaker(DefaultKeyMaker):
+        def make_key(self, obj):
+            yield repr(obj).encode('utf-8')
+
+    bucket.keymaker = ReprKeyMaker()
+    prefix = bucket._key_prefix((constant,), 2)
+    assert prefix.hash_obj is None
+    assert bucket._hash_for_key((1,), prefix=prefix) == (
+        bucket._hash_for_key((constant, 1)))
+
+
+@pytest.mark.parametrize('index', [False, True])
+def test_md5_compat(tmpdir, index):
+    old = Bucket(str(tmpdir), index=index)
+    old['a'] = 'a'
+    old['b'] = 'b'
+
+    bucket = Bucket(str(tmpdir), hash_algorithm='sha256', index=index,
+                    md5_compat=True)
+    assert bucket['a'] == 'a'
+    assert bucket._path_for_key('a').exists()
+    assert not old._path_for_key('a').exists()
+    assert 'b' in bucket
+    assert 'c' not in bucket
+    assert bucket.disk_usage().num == 2
+
+    # Objects saved with the new key hash aren't replaced.
+    bucket['b'] = 'new b'
+    old['b'] = 'old b'
+    bucket.unload_key('b')
+    assert bucket['b'] == 'new b'
+
+    # Legacy files are only looked for when a key isn't found.
+    with patch.object(Bucket, '_adopt_legacy_hash') as adopt:
+        bucket._hash_for_key('x')
+        bucket['d'] = 'd'
+        assert 'd' in bucket
+        assert not adopt.called
+        assert 'x' not in bucket
+        assert adopt.called
+
+    plain = Bucket(str(tmpdir), hash_algorithm='sha256')
+    assert not plain.md5_compat
+    assert plain['a'] == 'a'
+    assert not Bucket(str(tmpdir), md5_compat=True).md5_compat
+
+
 if __name__ == '__main__':
     pytest.main()
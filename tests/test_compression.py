@@ -0,0 +1,87 @@
+from __future__ import absolute_import, division
+
+import pytest
+
+from bucketcache import (
+    Bucket, Compression, JSONBackend, MessagePackBackend, PickleBackend,
+    compressed_backend)
+from bucketcache.compression import MAGIC, _codecs
+
+from . import *
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+backends = [JSONBackend, PickleBackend]
+if msgpack is not None:
+    backends.append(MessagePackBackend)
+
+value = {'key': ['compressible value {}'.format(i) for i in range(200)]}
+
+
+@pytest.mark.parametrize('backend', backends)
+@pytest.mark.parametrize('codec', sorted(_codecs))
+def test_compression(tmpdir, backend, codec):
+    cache = Bucket(str(tmpdir), backend=backend, compression=codec)
+    plain = Bucket(str(tmpdir), backend=backend)
+    assert cache.backend.__name__ == backend.__name__
+    assert cache.compression.codec == codec
+
+    cache['large'] = value
+    cache['small'] = 'small'
+    path = cache._path_for_key('large')
+    assert path == plain._path_for_key('large')
+    with path.open('rb') as f:
+        assert f.read(len(MAGIC)) == MAGIC
+
+    cache.unload_key('large')
+    assert cache['large'] == value
+    assert 'large' in cache
+    with path.open('rb') as f:
+        metadata = cache.backend.metadata_from_file(f)
+    assert metadata.expiration_date is None
+
+    # Small files are stored uncompressed, so they can be read without
+    # compression.
+    assert plain['small'] == 'small'
+
+    # Uncompressed files are read with compression.
+    plain['plain'] = value
+    assert cache['plain'] == value
+
+
+def test_compression_settings(tmpdir):
+    compression = Compression('zlib', level=1, threshold=10 ** 6)
+    cache = Bucket(str(tmpdir), compression=compression)
+    cache['key'] = value
+    assert cache['key'] == value
+    assert 'compression=' in repr(cache)
+    with cache._path_for_key('key').open('rb') as f:
+        assert f.read(len(MAGIC)) != MAGIC
+
+    # Files are read whichever codec wrote them.
+    backend = compressed_backend(PickleBackend, 'bz2')
+    Bucket(str(tmpdir), backend=backend)['key'] = value
+    cache.unload_key('key')
+    assert cache['key'] == value
+
+    with pytest.raises(ValueError):
+        Compression('unknown')
+
+
+@requires_python_version(3, 8)
+def test_compression_out_of_band_buffers(tmpdir):
+    import pickle
+    from bucketcache import PickleConfig
+
+    config = PickleConfig(protocol=5, buffer_threshold=1024)
+    cache = Bucket(str(tmpdir), config=config, compression='zlib')
+    cache['key'] = pickle.PickleBuffer(bytearray(10000))
+    cache.unload_key('key')
+    assert bytes(cache['key']) == bytes(10000)
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -3,14 +3,24 @@ from __future__ import absolute_import, division
 import inspect
 import sys
 import textwrap
+import threading
+import time
+from datetime import datetime, timedelta
 
 import pytest
 from six import exec_
 
-from bucketcache import DeferredWriteBucket
+from bucketcache import Bucket, DeferredWriteBucket, JSONBackend
+from bucketcache.utilities import (
+    ArgumentBinder, fullargspec_from_argspec, normalize_args)
 
 from . import *
 
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
 
 def test_methods(cache_all):
     """Test caching instance methods."""
@@ -305,6 +315,83 @@ def test_decorator_fullargspec(cache_all):
     exec_(textwrap.dedent(code))
 
 
+def _argspec(f):
+    try:
+        return inspect.getfullargspec(f)
+    except AttributeError:
+        return fullargspec_from_argspec(inspect.getargspec(f))
+
+
+def test_argument_binder():
+    """ArgumentBinder binds arguments the same way as normalize_args."""
+    def positional(a, b, c=3, d=4):
+        pass
+
+    def variable(a, b=2, *args, **kwargs):
+        pass
+
+    calls = {
+        positional: [
+            ((1, 2), {}), ((1, 2, 5), {}), ((1,), {'b': 2, 'd': 6}),
+            ((), {'d': 1, 'c': 2, 'b': 3, 'a': 4}),
+        ],
+        variable: [
+            ((1,), {}), ((1, 2, 3, 4), {}), ((1,), {'x': 1, 'b': 3}),
+            ((1, 2, 3), {'args': 1, 'y': 2}),
+        ],
+    }
+    invalid_calls = [
+        (positional, (), {}), (positional, (1,), {}),
+        (positional, (1, 2, 3, 4, 5), {}), (positional, (1, 2), {'e': 1}),
+        (positional, (1, 2), {'a': 1}), (variable, (1,), {'a': 1}),
+    ]
+
+    for f, f_calls in calls.items():
+        binder = ArgumentBinder(f, _argspec(f))
+        for args, kwargs in f_calls:
+            callargs = binder.callargs(args, kwargs)
+            expected = inspect.getcallargs(f, *args, **kwargs)
+            assert list(callargs.items()) == list(expected.items())
+
+            if 'args' in kwargs:
+                # normalize_args mixes up keyword arguments with the same
+                # name as *args and the variable arguments.
+                continue
+            varargs, normargs, callargs = binder.bind(args, kwargs)
+            expected = normalize_args(f, *args, **kwargs)
+            assert varargs == expected.varargs
+            assert normargs == expected.normargs
+            assert callargs == expected.callargs
+
+    for f, args, kwargs in invalid_calls:
+        binder = ArgumentBinder(f, _argspec(f))
+        with pytest.raises(TypeError):
+            binder.bind(args, kwargs)
+
+    binder = ArgumentBinder(variable, _argspec(variable),
+                            exclude=['b', 'args', 'kwargs'])
+    varargs, normargs, callargs = binder.bind((1, 2, 3), {'x': 4})
+    assert varargs == ()
+    assert normargs == {'a': 1}
+    assert callargs == {'a': 1, 'b': 2, 'args': (3,), 'kwargs': {'x': 4}}
+
+
+@requires_python_version(3)
+def test_argument_binder_keyword_only():
+    namespace = {}
+    exec_(textwrap.dedent("""
+    def f(a, *, b, c=3, **kwargs):
+        pass
+    """), namespace)
+    f = namespace['f']
+    binder = ArgumentBinder(f, _argspec(f))
+    for args, kwargs in [((1,), {'b': 2}), ((), {'x': 1, 'b': 2, 'a': 0})]:
+        assert list(binder.callargs(args, kwargs).items()) == list(
+            inspect.getcallargs(f, *args, **kwargs).items())
+    with pytest.raises(TypeError):
+        binder.bind((1,), {})
+
+
 def test_deferred_decorator(deferred_cache_all):
     """"""
     cache = deferred_cache_all
@@ -434,5 +521,227 @@ def test_introspection(cache_all):
     assert getargspec(foo) == getargspec(wrapped)
 
 
+def _expire_all(cache):
+    for key_hash in cache._cache:
+        obj = cache._cache[key_hash]
+        obj.expiration_date = datetime.utcnow() - timedelta(seconds=1)
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_decorator_stale_while_revalidate(tmpdir):
+    """Expired results within the grace period are returned immediately and
+    replaced in the background.
+    """
+    cache = Bucket(str(tmpdir), hours=1)
+    calls = []
+
+    @cache(stale_while_revalidate=timedelta(minutes=5))
+    def version(name):
+        calls.append(name)
+        return len(calls)
+
+    assert version('spam') == 1
+    _expire_all(cache)
+
+    assert version('spam') == 1
+    assert _wait_for(lambda: version('spam') == 2)
+    assert calls == ['spam', 'spam']
+
+    # Outside the grace period, the function is called synchronously.
+    _expire_all(cache)
+    for key_hash in cache._cache:
+        cache._cache[key_hash].expiration_date -= timedelta(minutes=10)
+    assert version('spam') == 3
+
+
+def test_decorator_miss_during_revalidation(tmpdir):
+    """A miss for a key being revalidated waits for the new result."""
+    cache = Bucket(str(tmpdir), thread_safe=True, hours=1)
+    calls = []
+    revalidating = threading.Event()
+    release = threading.Event()
+
+    @cache(stale_while_revalidate=timedelta(minutes=5))
+    def pair(name):
+        calls.append(name)
+        if len(calls) > 1:
+            revalidating.set()
+            release.wait(5)
+        # A 2-tuple, which mustn't be mistaken for (result, called).
+        return name, len(calls)
+
+    assert pair('spam') == ('spam', 1)
+    _expire_all(cache)
+    assert pair('spam') == ('spam', 1)
+    assert revalidating.wait(5)
+
+    # Outside the grace period, the call waits for the revalidation.
+    for key_hash in cache._cache:
+        cache._cache[key_hash].expiration_date -= timedelta(minutes=10)
+    results = []
+    thread = threading.Thread(target=lambda: results.append(pair('spam')))
+    thread.start()
+    release.set()
+    thread.join(5)
+    assert results == [('spam', 2)]
+    assert calls == ['spam', 'spam']
+
+
+def test_get_or_set(tmpdir):
+    cache = Bucket(str(tmpdir), hours=1)
+    values = iter(range(10))
+
+    def function():
+        return next(values)
+
+    assert cache.get_or_set('key', function) == 0
+    assert cache.get_or_set('key', function) == 0
+
+    _expire_all(cache)
+    assert cache.get_or_set('key', function, stale_while_revalidate=60) == 0
+    assert _wait_for(lambda: not cache._revalidating)
+    assert cache['key'] == 1
+
+    _expire_all(cache)
+    assert cache.get_or_set('key', function) == 2
+    assert cache['key'] == 2
+
+
+def test_get_or_set_stale_during_expired_read(tmpdir):
+    """A read that may use a stale file isn't merged with a concurrent read
+    that skips expired files.
+    """
+    cache = Bucket(str(tmpdir), thread_safe=True, milliseconds=100)
+    values = iter(range(10))
+
+    def function():
+        return next(values)
+
+    assert cache.get_or_set('key', function) == 0
+    cache.unload_key('key')
+    time.sleep(0.2)
+
+    reading = threading.Event()
+    stale_loaded = threading.Event()
+    load_obj_into_cache = cache._load_obj_into_cache
+
+    def load(key_hash, skip_expired=False):
+        if skip_expired:
+            # Hold the flight open until the stale read has loaded the file.
+            reading.set()
+            stale_loaded.wait(5)
+            return load_obj_into_cache(key_hash, skip_expired=True)
+        obj = load_obj_into_cache(key_hash)
+        stale_loaded.set()
+        return obj
+
+    def read():
+        with pytest.raises(KeyError):
+            cache['key']
+
+    with patch.object(cache, '_load_obj_into_cache', load):
+        thread = threading.Thread(target=read)
+        thread.start()
+        assert reading.wait(5)
+        assert cache.get_or_set('key', function,
+                                stale_while_revalidate=60) == 0
+        thread.join(5)
+
+
+class NotFound(LookupError):
+    pass
+
+
+class RateLimited(LookupError):
+    def __init__(self, name, retry_after):
+        super(RateLimited, self).__init__(name)
+        self.retry_after = retry_after
+
+
+def test_decorator_cache_exceptions(cache_serializable):
+    cache = cache_serializable
+    calls = []
+
+    @cache(cache_exceptions=LookupError, exception_lifetime=0.05)
+    def fetch(name):
+        calls.append(name)
+        if name == 'missing':
+            raise NotFound(name)
+        if name == 'invalid':
+            raise ValueError(name)
+        return name
+
+    for _ in range(2):
+        with pytest.raises(NotFound) as excinfo:
+            fetch('missing')
+        assert excinfo.value.args == ('missing',)
+    assert calls == ['missing']
+
+    # Loaded from file too.
+    cache._cache.clear()
+    with pytest.raises(NotFound):
+        fetch('missing')
+    assert calls == ['missing']
+
+    # Other exceptions aren't cached.
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            fetch('invalid')
+    assert calls == ['missing', 'invalid', 'invalid']
+
+    # Cached exceptions have their own lifetime.
+    time.sleep(0.1)
+    with pytest.raises(NotFound):
+        fetch('missing')
+    assert calls == ['missing', 'invalid', 'invalid', 'missing']
+
+
+def test_decorator_cache_exceptions_uncopyable(tmpdir):
+    """Exceptions that can't be copied are raised as they were cached."""
+    cache = Bucket(str(tmpdir))
+    calls = []
+
+    @cache(cache_exceptions=LookupError)
+    def fetch(name):
+        calls.append(name)
+        raise RateLimited(name, retry_after=60)
+
+    for _ in range(2):
+        with pytest.raises(RateLimited) as excinfo:
+            fetch('a')
+        assert excinfo.value.retry_after == 60
+    assert calls == ['a']
+
+
+def test_decorator_cache_exceptions_unserializable(tmpdir):
+    # JSON can't serialize exceptions, so they are raised without being
+    # cached.
+    cache = Bucket(str(tmpdir), backend=JSONBackend)
+    calls = []
+
+    @cache(cache_exceptions=LookupError)
+    def fetch(name):
+        calls.append(name)
+        raise KeyError(name)
+
+    for _ in range(2):
+        with pytest.raises(KeyError):
+            fetch('a')
+    assert len(calls) == 2
+    assert not cache._cache
+
+    with pytest.raises(ValueError):
+        Bucket(str(tmpdir), minutes=1)(cache_exceptions=KeyError,
+                                       exception_lifetime=120)
+    with pytest.raises(TypeError):
+        cache(exception_lifetime=120)
+
+
 if __name__ == '__main__':
     pytest.main()
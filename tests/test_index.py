@@ -0,0 +1,201 @@
+from __future__ import absolute_import, division
+
+import pytest
+
+from bucketcache import Bucket, PickleBackend
+from bucketcache.index import ManifestIndex
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+def no_scan():
+    return iter(())
+
+
+def test_index_log(tmpdir):
+    path = tmpdir.join('index')
+    index = ManifestIndex(path, scan=no_scan)
+    index.set('a', 10, None)
+    index.set('b', 20, 1000.0)
+    index.set('c', 30, None)
+    index.discard('c')
+    index.touch('a')
+    index.touch('a')
+
+    assert index.usage() == (30, 2)
+    entry = index.get('a')
+    assert entry.size == 10
+    assert entry.expiration is None
+    assert entry.hits == 2
+    assert index.get('b').expiration == 1000.0
+    assert index.get('c') is None
+
+    # Another instance (e.g. in another process) reads the same state, and
+    # sees later changes.
+    other = ManifestIndex(path, scan=no_scan)
+    assert sorted(other.items()) == sorted(index.items())
+
+    index.set('d', 40, None)
+    assert other.get('d') is None
+    assert other.usage() == (70, 3)
+
+
+def test_index_rebuild(tmpdir):
+    path = tmpdir.join('index')
+    scans = []
+
+    def scan():
+        scans.append(None)
+        return [('a', 10, None, 0.0), ('b', 20, 5.0, 0.0)]
+
+    index = ManifestIndex(path, scan=scan)
+    assert index.usage() == (30, 2)
+    assert len(scans) == 1
+
+    # A line cut short by a crash is ignored.
+    with path.open('ab') as f:
+        f.write(b'S c 3')
+    assert ManifestIndex(path, scan=scan).usage() == (30, 2)
+    assert len(scans) == 1
+
+    path.write('garbage\n')
+    index = ManifestIndex(path, scan=scan)
+    assert index.usage() == (30, 2)
+    assert len(scans) == 2
+
+    path.remove()
+    index.set('c', 30, None)
+    assert len(scans) == 3
+    assert index.usage() == (60, 3)
+
+
+def test_index_compact(tmpdir):
+    path = tmpdir.join('index')
+    index = ManifestIndex(path, scan=no_scan)
+    index._compact_min_records = 10
+
+    for i in range(100):
+        index.set(str(i % 5), i, None)
+    index.touch('0')
+
+    assert len(path.readlines()) <= 11
+    assert index.usage() == (95 + 96 + 97 + 98 + 99, 5)
+    assert ManifestIndex(path, scan=no_scan).items() == index.items()
+
+
+def test_bucket_index(tmpdir):
+    bucket = Bucket(str(tmpdir), index=True, seconds=10)
+    bucket['a'] = 'a'
+    bucket['b'] = 'b'
+    del bucket['b']
+    bucket.set_many({'c': 'c', 'd': 'd'})
+
+    usage = bucket.disk_usage()
+    assert usage.num == 3
+    assert usage == Bucket(str(tmpdir)).disk_usage()
+
+    # The index rebuilt from files matches.
+    newbucket = Bucket(str(tmpdir), index=True)
+    tmpdir.join('.pickle.index').remove()
+    assert newbucket.disk_usage() == usage
+
+
+def test_bucket_index_prune(tmpdir):
+    bucket = Bucket(str(tmpdir), index=True, seconds=10)
+    bucket['a'] = 'a'
+    bucket['b'] = 'b'
+    # Expire 'a' in the index.
+    bucket._index.set(bucket._hash_for_key('a'),
+                      bucket._path_for_key('a').stat().st_size, 0.0)
+
+    # Files aren't loaded to check their expiration date.
+    with patch.object(PickleBackend, 'from_file', side_effect=RuntimeError):
+        pruned = bucket.prune_directory()
+    assert pruned.num == 1
+    assert not bucket._path_for_key('a').exists()
+    assert bucket.disk_usage().num == 1
+    assert bucket['b'] == 'b'
+
+    # Files saved with a longer lifetime are pruned.
+    bucket = Bucket(str(tmpdir), index=True, seconds=5)
+    assert bucket.prune_directory().num == 1
+    assert bucket.disk_usage().num == 0
+
+
+def test_index_sample(tmpdir):
+    index = ManifestIndex(tmpdir.join('index'), scan=no_scan)
+    for key_hash in 'abcde':
+        index.set(key_hash, 1, None)
+    index.discard('b')
+
+    assert sorted(key_hash for key_hash, _ in index.sample(10)) == list('acde')
+    assert len(index.sample(2)) == 2
+    assert index.size == 4
+    assert len(index) == 4
+
+
+@pytest.fixture
+def clock():
+    """Make each access recorded by the index happen a second later."""
+    times = iter(range(1000000))
+    with patch('bucketcache.index.time.time', lambda: float(next(times))):
+        yield
+
+
+@pytest.mark.parametrize('thread_safe', [False, True])
+def test_disk_limit_lru(tmpdir, clock, thread_safe):
+    bucket = Bucket(str(tmpdir), max_disk_entries=3, thread_safe=thread_safe)
+    assert bucket.index
+
+    bucket['a'] = 'a'
+    bucket['b'] = 'b'
+    bucket['c'] = 'c'
+    bucket['a']
+    bucket['d'] = 'd'
+
+    assert bucket.disk_usage().num == 3
+    assert 'b' not in bucket
+    assert not bucket._path_for_key('b').exists()
+    assert all(key in bucket for key in 'acd')
+
+
+def test_disk_limit_lfu(tmpdir, clock):
+    bucket = Bucket(str(tmpdir), max_disk_entries=3, disk_policy='lfu')
+    bucket['a'] = 'a'
+    bucket['b'] = 'b'
+    bucket['c'] = 'c'
+    for key in 'aabb':
+        bucket[key]
+    bucket['c']
+    bucket['d'] = 'd'
+
+    # 'c' was used most recently, but least often.
+    assert 'c' not in bucket
+    assert all(key in bucket for key in 'abd')
+
+
+def test_disk_limit_bytes(tmpdir):
+    bucket = Bucket(str(tmpdir), max_disk_bytes=1)
+    size = 0
+    for i in range(5):
+        bucket[i] = i
+        size = max(size, bucket.disk_usage().size)
+    # The latest file is kept, even if it's too big on its own.
+    assert bucket.disk_usage().num == 1
+    assert 4 in bucket
+
+    bucket = Bucket(str(tmpdir), max_disk_bytes=3 * size)
+    bucket.set_many((i, i) for i in range(10))
+    assert bucket.disk_usage().size <= 3 * size
+
+    with pytest.raises(ValueError):
+        Bucket(str(tmpdir), max_disk_bytes=0)
+    with pytest.raises(ValueError):
+        Bucket(str(tmpdir), max_disk_entries=1, disk_policy='fifo')
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,215 @@
+from __future__ import absolute_import, division
+
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+
+from bucketcache import Bucket
+from bucketcache.backends import PickleBackend
+from bucketcache.compat.contextlib import suppress
+from bucketcache.locks import FileLock, SingleFlight, fcntl_available
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+requires_fcntl = pytest.mark.skipif(not fcntl_available,
+                                    reason='Requires fcntl')
+
+
+@requires_fcntl
+def test_file_lock(tmpdir):
+    path = tmpdir.join('key.lock')
+    lock = FileLock(path, timeout=0)
+    other = FileLock(path, timeout=0)
+
+    with lock as acquired:
+        assert acquired
+        assert path.exists()
+        assert not other.acquire()
+
+    assert not path.exists()
+    assert other.acquire()
+    other.release()
+
+
+@requires_fcntl
+def test_stale_lock(tmpdir):
+    path = tmpdir.join('key.lock')
+    hung = FileLock(path)
+    assert hung.acquire()
+
+    path.setmtime(time.time() - 10)
+    lock = FileLock(path, timeout=0, stale_timeout=5)
+    assert lock.acquire()
+
+    # Releasing a broken lock mustn't remove the new holder's file.
+    hung.release()
+    assert path.exists()
+    lock.release()
+    assert not path.exists()
+
+
+@requires_fcntl
+def test_stale_lock_broken_once(tmpdir):
+    """A process that found the same stale lock as the one that broke it
+    doesn't remove the new lock file.
+    """
+    path = tmpdir.join('key.lock')
+    hung = FileLock(path)
+    assert hung.acquire()
+    path.setmtime(time.time() - 10)
+
+    lock = FileLock(path, timeout=0, stale_timeout=5)
+    other = FileLock(path, timeout=0, stale_timeout=5)
+    assert other._is_stale()
+    assert lock.acquire()
+
+    other._break_stale(deadline=None)
+    assert lock._is_current(lock._fd)
+    assert not other.acquire()
+    lock.release()
+    hung.release()
+    assert not tmpdir.join('key.lock.break.lock').exists()
+
+
+def _call_locked(path, counter):
+    bucket = Bucket(path)
+
+    @bucket(lock=True)
+    def slow_square(a):
+        with open(counter, 'a') as f:
+            f.write('.')
+        time.sleep(0.5)
+        return a ** 2
+
+    assert slow_square(4) == 16
+
+
+@requires_fcntl
+def test_decorator_process_lock(tmpdir):
+    """Only one process calls the function on a cache miss."""
+    path = str(tmpdir.mkdir('cache'))
+    counter = str(tmpdir.join('counter'))
+
+    processes = [multiprocessing.Process(target=_call_locked,
+                                         args=(path, counter))
+                 for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    with open(counter) as f:
+        assert f.read() == '.'
+    assert not any(name.endswith('.lock') for name in os.listdir(path))
+
+
+def _run_threads(target, n=8):
+    threads = [threading.Thread(target=target) for _ in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_single_flight():
+    flight = SingleFlight()
+    calls = []
+    results = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'result'
+
+    _run_threads(lambda: results.append(flight.do('key', slow)))
+
+    assert len(calls) == 1
+    assert [result for result, shared in results] == ['result'] * 8
+    assert sum(not shared for result, shared in results) == 1
+
+    def fail():
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        flight.do('key', fail)
+
+    # Reentrant calls don't deadlock.
+    assert flight.do('key', lambda: flight.do('key', slow)) == (
+        ('result', False), False)
+
+
+def test_decorator_thread_coalescing(tmpdir):
+    """Threads missing the same key call the function once."""
+    bucket = Bucket(str(tmpdir))
+    calls = []
+
+    @bucket
+    def slow_square(a):
+        calls.append(a)
+        time.sleep(0.2)
+        return a ** 2
+
+    results = []
+    _run_threads(lambda: results.append(slow_square(4)))
+
+    assert calls == [4]
+    assert results == [16] * 8
+
+
+def test_read_coalescing(tmpdir):
+    """Threads reading the same cold key load its file once."""
+    bucket = Bucket(str(tmpdir))
+    bucket['key'] = 'value'
+    bucket.unload_key('key')
+
+    loads = []
+    from_file = PickleBackend.from_file
+
+    def slow_from_file(fp, config=None):
+        loads.append(1)
+        time.sleep(0.2)
+        return from_file(fp, config=config)
+
+    results = []
+    with patch.object(PickleBackend, 'from_file', side_effect=slow_from_file):
+        _run_threads(lambda: results.append(bucket['key']))
+
+    assert len(loads) == 1
+    assert results == ['value'] * 8
+
+
+def test_thread_safe_bucket(tmpdir):
+    """Concurrent reads, writes and deletes of overlapping keys don't raise
+    unexpected exceptions.
+    """
+    bucket = Bucket(str(tmpdir), thread_safe=True, max_memory_entries=20)
+    errors = []
+
+    def work():
+        try:
+            for i in range(200):
+                key = i % 10
+                bucket[key] = i
+                with suppress(KeyError):
+                    bucket[key]
+                with suppress(KeyError):
+                    del bucket[key]
+                key in bucket
+                bucket.unload_key(key)
+        except Exception as e:
+            errors.append(e)
+
+    _run_threads(work)
+    assert errors == []
+
+    for key in range(10):
+        bucket[key] = key
+    for key in range(10):
+        assert bucket[key] == key
@@ -0,0 +1,98 @@
+from __future__ import absolute_import, division
+
+import gc
+import time
+
+import pytest
+
+from bucketcache import Bucket
+from bucketcache.maintenance import MaintenanceWorker
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_expired_files_left_for_maintenance(tmpdir):
+    with Bucket(str(tmpdir), milliseconds=50, index=True,
+                maintenance_interval=3600) as bucket:
+        assert bucket.thread_safe
+        bucket['a'] = 'a'
+        time.sleep(0.1)
+
+        # Reads don't delete the expired file.
+        assert 'a' not in bucket
+        with pytest.raises(KeyError):
+            bucket['a']
+        assert bucket._path_for_key('a').exists()
+
+        bucket._run_maintenance(bucket._maintenance.throttle)
+        assert not bucket._path_for_key('a').exists()
+        assert bucket.disk_usage().num == 0
+
+    # Without the thread, reads delete expired files again.
+    assert bucket._maintenance is None
+
+
+def test_maintenance_interval(tmpdir):
+    bucket = Bucket(str(tmpdir), milliseconds=50, maintenance_interval=0.05)
+    bucket['a'] = 'a'
+    assert _wait_for(lambda: not bucket._path_for_key('a').exists())
+    bucket.close()
+    assert not bucket._path_for_key('a').exists()
+
+
+def test_maintenance_disk_limits(tmpdir):
+    with Bucket(str(tmpdir), max_disk_entries=2,
+                maintenance_interval=3600) as bucket:
+        for i in range(5):
+            bucket[i] = i
+        # Writes wake the thread instead of evicting files themselves.
+        assert _wait_for(lambda: bucket.disk_usage().num == 2)
+
+
+def test_maintenance_compacts_index(tmpdir):
+    with Bucket(str(tmpdir), index=True, maintenance_interval=3600) as bucket:
+        for _ in range(10):
+            bucket['a'] = 'a'
+        assert bucket._index.redundant_records >= 9
+        bucket._run_maintenance(bucket._maintenance.throttle)
+        assert bucket._index.redundant_records == 0
+
+
+def test_worker_throttle(tmpdir):
+    bucket = Bucket(str(tmpdir))
+    worker = MaintenanceWorker(bucket, interval=3600, io_rate=20)
+    start = time.time()
+    for _ in range(5):
+        assert worker.throttle()
+    assert time.time() - start >= 0.15
+
+    worker.stop()
+    assert not worker.throttle()
+
+
+def test_worker_stop(tmpdir):
+    bucket = Bucket(str(tmpdir), maintenance_interval=3600)
+    thread = bucket._maintenance._thread
+    assert thread.is_alive()
+    bucket.close()
+    assert not thread.is_alive()
+    bucket.close()
+
+    # The thread doesn't keep its bucket alive, and stops when it's gone.
+    bucket = Bucket(str(tmpdir), maintenance_interval=0.01)
+    thread = bucket._maintenance._thread
+    del bucket
+    gc.collect()
+    assert _wait_for(lambda: not thread.is_alive())
+
+    with pytest.raises(ValueError):
+        Bucket(str(tmpdir), maintenance_interval=0)
+
+
+if __name__ == '__main__':
+    pytest.main()
@@ -0,0 +1,140 @@
+from __future__ import absolute_import, division
+
+import random
+
+import pytest
+
+from bucketcache import Bucket, DeferredWriteBucket
+from bucketcache.memory import (
+    ARCPolicy, LFUPolicy, LRUPolicy, MemoryCache, TinyLFUPolicy)
+
+policies = [LRUPolicy, LFUPolicy, ARCPolicy, TinyLFUPolicy]
+policy_ids = ['lru', 'lfu', 'arc', 'tinylfu']
+
+
+@pytest.yield_fixture(params=policies, ids=policy_ids)
+def policies_all(request):
+    yield request.param
+
+
+def test_max_entries(policies_all):
+    cache = MemoryCache(max_entries=10, policy=policies_all())
+
+    for i in range(100):
+        cache[i] = i
+        assert len(cache) <= 10
+
+    # Every resident entry is still correct.
+    for key in cache:
+        assert cache[key] == key
+
+
+def test_max_bytes(policies_all):
+    cache = MemoryCache(max_bytes=100, policy=policies_all())
+
+    for i in range(50):
+        cache.set(i, str(i), size=10)
+        assert cache.total_bytes <= 100
+    assert len(cache) == 10
+
+    # Entries larger than the limit are not held, and replace stale values.
+    cache.set(5, 'small', size=10)
+    assert not cache.set(5, 'large', size=101)
+    assert 5 not in cache
+
+    del cache[next(iter(cache))]
+    assert cache.total_bytes == 10 * (len(cache))
+
+
+def test_lru_order():
+    evicted = []
+    cache = MemoryCache(max_entries=2, policy=LRUPolicy(),
+                        on_evict=lambda key, value: evicted.append(key))
+    cache['a'] = 1
+    cache['b'] = 2
+    cache['a']
+    cache['c'] = 3
+    assert evicted == ['b']
+
+
+def test_lfu_order():
+    evicted = []
+    cache = MemoryCache(max_entries=2, policy=LFUPolicy(),
+                        on_evict=lambda key, value: evicted.append(key))
+    cache['a'] = 1
+    cache['b'] = 2
+    for _ in range(3):
+        cache['b']
+    cache['a']
+    cache['c'] = 3
+    assert evicted == ['a']
+
+
+def _trace_hits(policy):
+    """Return number of hits for a trace of a small set of hot keys mixed
+    with keys that are only read once.
+    """
+    rng = random.Random(0)
+    cache = MemoryCache(max_entries=100, policy=policy)
+    hits = 0
+    for i in range(50000):
+        if rng.random() < 0.5:
+            key = 'hot{}'.format(rng.randrange(50))
+        else:
+            key = i
+        if key in cache:
+            cache[key]
+            hits += 1
+        else:
+            cache[key] = key
+    return hits
+
+
+def test_frequent_keys_survive_scan(policies_all):
+    """Scan resistant policies keep frequently used keys resident while many
+    keys are read once, so they get more hits than LRU.
+    """
+    if policies_all is LRUPolicy:
+        pytest.skip('LRU is not scan resistant.')
+
+    assert _trace_hits(policies_all()) > _trace_hits(LRUPolicy()) * 1.2
+
+
+def test_invalid_limits():
+    with pytest.raises(ValueError):
+        MemoryCache(max_entries=0)
+
+    with pytest.raises(TypeError):
+        MemoryCache(policy=object())
+
+
+def test_bucket_memory_limit(tmpdir, policies_all):
+    """Objects evicted from memory are reloaded from file."""
+    bucket = Bucket(str(tmpdir), max_memory_entries=5,
+                    memory_policy=policies_all())
+
+    for i in range(20):
+        bucket[i] = i * 2
+        assert len(bucket._cache) <= 5
+
+    for i in range(20):
+        assert bucket[i] == i * 2
+
+    for i in range(20):
+        del bucket[i]
+        assert i not in bucket
+
+
+def test_deferred_memory_limit(tmpdir):
+    """Unsynced objects evicted from memory aren't lost."""
+    bucket = DeferredWriteBucket(str(tmpdir), max_memory_entries=5)
+
+    for i in range(20):
+        bucket[i] = i
+    for i in range(20):
+        assert bucket[i] == i
+
+    bucket.sync()
+    newbucket = Bucket(str(tmpdir))
+    for i in range(20):
+        assert newbucket[i] == i
@@ -0,0 +1,193 @@
+from __future__ import absolute_import, division
+
+import os
+import time
+
+import pytest
+
+from bucketcache import (
+    JSONBackend, PackBucket, PickleBackend, deferred_write)
+from bucketcache.locks import fcntl_available
+
+from . import *
+
+
+@pytest.mark.parametrize('backend', [JSONBackend, PickleBackend])
+def test_pack_bucket(tmpdir, backend):
+    with PackBucket(str(tmpdir), backend=backend) as bucket:
+        bucket['a'] = 'a'
+        bucket['b'] = [1, 2]
+        bucket['a'] = 'new a'
+        bucket['c'] = 'c'
+        del bucket['c']
+
+        bucket.unload_key('a')
+        assert bucket['a'] == 'new a'
+        assert 'c' not in bucket
+        with pytest.raises(KeyError):
+            bucket['c']
+        assert bucket.disk_usage().num == 2
+
+        # One segment file, rather than a file per key.
+        assert len(tmpdir.listdir(lambda p: p.ext == '.pack')) == 1
+
+    # The locations of objects are rebuilt from the segments.
+    with PackBucket(str(tmpdir), backend=backend) as bucket:
+        assert bucket['a'] == 'new a'
+        assert bucket['b'] == [1, 2]
+        assert 'c' not in bucket
+        assert bucket.disk_usage().num == 2
+
+
+def test_pack_bulk_access(tmpdir):
+    with PackBucket(str(tmpdir)) as bucket:
+        bucket.set_many({i: i * 2 for i in range(10)})
+        bucket.unload_key(3)
+        result = bucket.get_many([3, 4, 'missing'])
+        assert result.found == {3: 6, 4: 8}
+        assert result.missing == ['missing']
+        assert bucket.delete_many([1, 'missing']) == ['missing']
+        assert 1 not in bucket
+
+
+def test_pack_truncated_record(tmpdir):
+    with PackBucket(str(tmpdir)) as bucket:
+        bucket['a'] = 'a'
+        bucket['b'] = 'b'
+        path = bucket._active.path
+        size = bucket._active.size
+
+    # Cut short by a crash while writing 'b'.
+    with open(str(path), 'r+b') as f:
+        f.truncate(size - 3)
+
+    with PackBucket(str(tmpdir)) as bucket:
+        assert bucket['a'] == 'a'
+        assert 'b' not in bucket
+        assert os.path.getsize(str(path)) < size - 3
+        bucket['b'] = 'new b'
+
+    with PackBucket(str(tmpdir)) as bucket:
+        assert bucket['b'] == 'new b'
+
+
+def test_pack_compaction(tmpdir):
+    bucket = PackBucket(str(tmpdir), segment_size=1024, compaction_ratio=0.5,
+                        maintenance_interval=3600)
+    bucket['deleted'] = 'x'
+    for i in range(50):
+        bucket['a'] = 'a' * 100
+        bucket['b'] = i
+    del bucket['deleted']
+    assert len(bucket._segments) > 3
+    size = bucket.disk_usage().size
+
+    assert bucket.compact() > 0
+    assert bucket.disk_usage().size < size / 2
+    assert bucket['a'] == 'a' * 100
+    assert bucket['b'] == 49
+    assert 'deleted' not in bucket
+    bucket.close()
+
+    # Deleted keys don't come back when objects from older segments are
+    # replayed.
+    with PackBucket(str(tmpdir), segment_size=1024) as bucket:
+        assert bucket['b'] == 49
+        assert 'deleted' not in bucket
+        assert bucket.disk_usage().num == 2
+
+
+def test_pack_compaction_corrupt_record(tmpdir):
+    """Segments with corrupt records aren't deleted by compaction, so
+    objects after the corrupt record can still be read.
+    """
+    with PackBucket(str(tmpdir)) as bucket:
+        for key in 'abc':
+            bucket[key] = key * 100
+        segment = bucket._active
+        b = bucket._entries[bucket._hash_for_key('b')]
+        with bucket._write_lock:
+            bucket._start_segment()
+
+        # Corrupt the value of 'b'.
+        with open(str(segment.path), 'r+b') as f:
+            f.seek(b.offset + b.length - 1)
+            f.write(b'!')
+
+        assert bucket._compact_segment(segment) == 0
+        assert segment.path.exists()
+        bucket.unload_key('a')
+        bucket.unload_key('c')
+        assert bucket['a'] == 'a' * 100
+        assert bucket['c'] == 'c' * 100
+
+
+def test_pack_missing_segment(tmpdir):
+    """Entries in a segment that no longer exists are invalid, rather than
+    waited on.
+    """
+    with PackBucket(str(tmpdir)) as bucket:
+        bucket['a'] = 'a'
+        bucket.unload_key('a')
+        key_hash = bucket._hash_for_key('a')
+        with bucket._write_lock:
+            bucket._start_segment()
+            del bucket._segments[bucket._entries[key_hash].segment]
+
+        with pytest.raises(KeyError):
+            bucket['a']
+
+
+def test_pack_prune(tmpdir):
+    with PackBucket(str(tmpdir), milliseconds=50) as bucket:
+        bucket['a'] = 'a'
+        bucket['b'] = 'b'
+        time.sleep(0.1)
+        bucket['c'] = 'c'
+
+        # The only partition was pruned before.
+        assert bucket.prune_directory(resume_from='').num == 0
+        assert bucket.disk_usage().num == 3
+
+        pruned = bucket.prune_directory()
+        assert pruned.num == 2
+        assert bucket.disk_usage().num == 1
+
+
+def test_pack_md5_compat(tmpdir):
+    with PackBucket(str(tmpdir)) as bucket:
+        bucket['a'] = 'a'
+
+    with PackBucket(str(tmpdir), hash_algorithm='sha256',
+                    md5_compat=True) as bucket:
+        assert bucket['a'] == 'a'
+        assert bucket.disk_usage().num == 1
+
+    with PackBucket(str(tmpdir), hash_algorithm='sha256') as bucket:
+        assert bucket['a'] == 'a'
+
+
+@pytest.mark.skipif(not fcntl_available, reason='Requires fcntl')
+def test_pack_single_process(tmpdir):
+    with PackBucket(str(tmpdir)):
+        with pytest.raises(RuntimeError):
+            PackBucket(str(tmpdir))
+    PackBucket(str(tmpdir)).close()
+
+
+def test_pack_unsupported(tmpdir):
+    with pytest.raises(ValueError):
+        PackBucket(str(tmpdir), index=True)
+    with pytest.raises(ValueError):
+        PackBucket(str(tmpdir), fanout_depth=2)
+    with pytest.raises(ValueError):
+        PackBucket(str(tmpdir), compaction_ratio=1)
+
+    with PackBucket(str(tmpdir)) as bucket:
+        with pytest.raises(TypeError):
+            with deferred_write(bucket):
+                pass
+
+
+if __name__ == '__main__':
+    pytest.main()
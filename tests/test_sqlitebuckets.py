@@ -0,0 +1,131 @@
+from __future__ import absolute_import, division
+
+import multiprocessing
+import time
+
+import pytest
+
+from bucketcache import (
+    JSONBackend, PickleBackend, SQLiteBucket, deferred_write)
+
+from . import *
+
+
+@pytest.mark.parametrize('backend', [JSONBackend, PickleBackend])
+def test_sqlite_bucket(tmpdir, backend):
+    with SQLiteBucket(str(tmpdir), backend=backend) as bucket:
+        bucket['a'] = 'a'
+        bucket['b'] = [1, 2]
+        bucket['a'] = 'new a'
+        bucket['c'] = 'c'
+        del bucket['c']
+
+        bucket.unload_key('a')
+        assert bucket['a'] == 'new a'
+        assert 'c' not in bucket
+        with pytest.raises(KeyError):
+            bucket['c']
+        assert bucket.disk_usage().num == 2
+        assert tmpdir.listdir(lambda p: p.ext == '.pickle') == []
+
+    # Another bucket (e.g. in another process) sees the same objects.
+    with SQLiteBucket(str(tmpdir), backend=backend) as bucket:
+        assert bucket['a'] == 'new a'
+        assert bucket['b'] == [1, 2]
+        assert 'c' not in bucket
+
+
+def test_sqlite_bulk_access(tmpdir):
+    with SQLiteBucket(str(tmpdir)) as bucket:
+        bucket.set_many({i: i * 2 for i in range(10)})
+        bucket.unload_key(3)
+        result = bucket.get_many([3, 4, 'missing'])
+        assert result.found == {3: 6, 4: 8}
+        assert result.missing == ['missing']
+        assert bucket.delete_many([1, 'missing']) == ['missing']
+        assert 1 not in bucket
+
+
+def test_sqlite_expiration(tmpdir):
+    with SQLiteBucket(str(tmpdir), milliseconds=50) as bucket:
+        bucket['a'] = 'a'
+        bucket['b'] = 'b'
+        time.sleep(0.1)
+        bucket['c'] = 'c'
+
+        bucket.unload_key('a')
+        assert 'a' not in bucket
+        with pytest.raises(KeyError):
+            bucket['b']
+
+        bucket['d'] = 'd'
+        time.sleep(0.1)
+        bucket['e'] = 'e'
+        # The only partition was pruned before.
+        assert bucket.prune_directory(resume_from='').num == 0
+        usage = bucket.disk_usage()
+        assert usage.num == 3
+
+        progress = list(bucket.iter_prune_directory())[-1]
+        assert progress.num == 2
+        assert progress.checked == 3
+        assert progress.size == usage.size - bucket.disk_usage().size
+        assert bucket.disk_usage().num == 1
+
+    # Objects saved with a longer lifetime have expired.
+    with SQLiteBucket(str(tmpdir), milliseconds=10) as bucket:
+        assert bucket.prune_directory().num == 1
+        assert bucket.disk_usage().num == 0
+
+
+def test_sqlite_md5_compat(tmpdir):
+    with SQLiteBucket(str(tmpdir)) as bucket:
+        bucket['a'] = 'a'
+
+    with SQLiteBucket(str(tmpdir), hash_algorithm='sha256',
+                      md5_compat=True) as bucket:
+        assert bucket['a'] == 'a'
+        assert bucket.disk_usage().num == 1
+
+    with SQLiteBucket(str(tmpdir), hash_algorithm='sha256') as bucket:
+        assert bucket['a'] == 'a'
+
+
+def _set_keys(path, start):
+    with SQLiteBucket(path) as bucket:
+        for i in range(start, start + 50):
+            bucket[i] = i
+
+
+def test_sqlite_processes(tmpdir):
+    processes = [
+        multiprocessing.Process(target=_set_keys, args=(str(tmpdir), i * 50))
+        for i in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    with SQLiteBucket(str(tmpdir)) as bucket:
+        assert bucket.disk_usage().num == 200
+        assert bucket[123] == 123
+
+
+def test_sqlite_unsupported(tmpdir):
+    with pytest.raises(ValueError):
+        SQLiteBucket(str(tmpdir), max_disk_entries=10)
+    with pytest.raises(ValueError):
+        SQLiteBucket(str(tmpdir), fanout_depth=2)
+
+    bucket = SQLiteBucket(str(tmpdir))
+    with pytest.raises(TypeError):
+        with deferred_write(bucket):
+            pass
+    bucket.close()
+    with pytest.raises(ValueError):
+        bucket['a'] = 'a'
+
+
+if __name__ == '__main__':
+    pytest.main()
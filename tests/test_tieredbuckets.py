@@ -0,0 +1,177 @@
+from __future__ import absolute_import, division
+
+import time
+
+import pytest
+
+from bucketcache import Bucket, JSONBackend, PackBucket, TieredBucket
+from bucketcache.utilities import PruneProgress
+
+from . import *
+
+
+def make_tiers(tmpdir, **kwargs):
+    local = Bucket(str(tmpdir.mkdir('local')), **kwargs)
+    shared = Bucket(str(tmpdir.mkdir('shared')), **kwargs)
+    return local, shared
+
+
+def test_tiered_promotion(tmpdir):
+    local, shared = make_tiers(tmpdir)
+    shared['a'] = 'a'
+
+    with TieredBucket([local, shared]) as bucket:
+        assert bucket.path == shared.path
+        assert bucket['a'] == 'a'
+        # Promoted to the local tier.
+        assert local._path_for_key('a').exists()
+
+        bucket.unload_key('a')
+        assert bucket['a'] == 'a'
+        assert bucket['a'] == 'a'
+        with pytest.raises(KeyError):
+            bucket['missing']
+
+        memory, local_stats, shared_stats = bucket.tier_stats
+        assert (memory.hits, memory.misses) == (1, 3)
+        assert (local_stats.hits, local_stats.misses) == (1, 2)
+        assert (shared_stats.hits, shared_stats.misses) == (1, 1)
+        assert memory.hit_rate == 0.25
+
+        bucket.reset_tier_stats()
+        assert bucket.tier_stats[0].hits == 0
+
+
+@pytest.mark.parametrize('write_policy', ['through', 'behind', 'around'])
+def test_tiered_write_policy(tmpdir, write_policy):
+    local, shared = make_tiers(tmpdir)
+    local['a'] = 'old'
+
+    with TieredBucket([local, shared], write_policy=write_policy) as bucket:
+        bucket['a'] = 'new'
+        bucket['b'] = 'b'
+        assert bucket['a'] == 'new'
+
+    shared.unload_key('a')
+    assert shared['a'] == 'new'
+    if write_policy == 'around':
+        # Stale copies in faster tiers are removed.
+        assert not local._path_for_key('a').exists()
+        assert not local._path_for_key('b').exists()
+    else:
+        assert local._path_for_key('b').exists()
+
+
+@pytest.mark.parametrize('write_policy', ['through', 'around'])
+def test_tiered_direct_tier_reads(tmpdir, write_policy):
+    """Tiers read directly don't return objects replaced through the
+    tiered bucket.
+    """
+    local, shared = make_tiers(tmpdir)
+    local['a'] = 'old'
+    shared['a'] = 'old'
+    assert local['a'] == 'old'
+    assert shared['a'] == 'old'
+
+    with TieredBucket([local, shared], write_policy=write_policy) as bucket:
+        bucket['a'] = 'new'
+
+    assert shared['a'] == 'new'
+    if write_policy == 'around':
+        with pytest.raises(KeyError):
+            local['a']
+    else:
+        assert local['a'] == 'new'
+
+
+@pytest.mark.parametrize('write_policy', ['through', 'behind'])
+def test_tiered_delete(tmpdir, write_policy):
+    local, shared = make_tiers(tmpdir)
+    with TieredBucket([local, shared], write_policy=write_policy) as bucket:
+        bucket['a'] = 'a'
+        shared['b'] = 'b'
+        del bucket['a']
+        assert 'a' not in bucket
+        assert 'b' in bucket
+        assert bucket.delete_many(['b', 'c']) == ['c']
+        assert bucket.disk_usage().num == 0
+
+
+def test_tiered_expiration(tmpdir):
+    # Pack buckets record exact expiration dates, rather than rounding them
+    # to the next second.
+    local = PackBucket(str(tmpdir.mkdir('local')), milliseconds=50)
+    shared = PackBucket(str(tmpdir.mkdir('shared')), milliseconds=50)
+    with TieredBucket([local, shared], milliseconds=50) as bucket:
+        bucket['a'] = 'a'
+        time.sleep(0.1)
+
+        # An expired copy in a faster tier doesn't hide a newer one.
+        obj = shared.backend(
+            'new', expiration_date=bucket._object_expiration_date())
+        shared._write_obj_with_hash(bucket._hash_for_key('a'), obj)
+        bucket.unload_key('a')
+        assert 'a' in bucket
+        assert bucket['a'] == 'new'
+
+        bucket['b'] = 'b'
+        time.sleep(0.1)
+        pruned = bucket.prune_directory()
+        assert pruned.num == 4
+        assert bucket.disk_usage().num == 0
+
+
+def test_tiered_resume_from_last_tier(tmpdir):
+    local, shared = make_tiers(tmpdir, milliseconds=50)
+    with TieredBucket([local, shared], milliseconds=50) as bucket:
+        bucket['a'] = 'a'
+        time.sleep(0.1)
+
+        progress = list(bucket.iter_prune_directory(resume_from='1'))
+        assert progress == [PruneProgress(size=0, num=0, checked=0,
+                                          checkpoint='1')]
+        assert bucket.prune_directory(resume_from='1').num == 0
+        assert bucket.prune_directory().num == 2
+
+
+def test_tiered_resume_within_tier(tmpdir):
+    local, shared = make_tiers(tmpdir, milliseconds=50, fanout_depth=1)
+    with TieredBucket([local, shared], milliseconds=50) as bucket:
+        for i in range(10):
+            bucket[i] = i
+        time.sleep(0.1)
+
+        # Interrupt after the first partition of the first tier, then resume.
+        progress = bucket.iter_prune_directory()
+        first = next(progress)
+        progress.close()
+        assert first.checkpoint.startswith('0:')
+
+        results = list(bucket.iter_prune_directory(
+            resume_from=first.checkpoint))
+        assert '0' in [result.checkpoint for result in results]
+        assert results[-1].checkpoint == '1'
+        assert first.num + results[-1].num == 20
+        assert bucket.disk_usage().num == 0
+
+
+def test_tiered_backends(tmpdir):
+    local = PackBucket(str(tmpdir.mkdir('local')), backend=JSONBackend)
+    shared = Bucket(str(tmpdir.mkdir('shared')), compression='zlib')
+    with TieredBucket([local, shared]) as bucket:
+        assert bucket.backend is JSONBackend
+        bucket['a'] = {'a': 1}
+        bucket.unload_key('a')
+        assert bucket['a'] == {'a': 1}
+        # Keys are hashed with the tiered bucket's backend name.
+        key_hash = bucket._hash_for_key('a')
+        assert shared._load_obj_with_hash(key_hash)[0].value == {'a': 1}
+
+    with pytest.raises(ValueError):
+        TieredBucket([])
+    with pytest.raises(ValueError):
+        TieredBucket([Bucket(str(tmpdir))], write_policy='sometimes')
+
+
+if __name__ == '__main__':
+    pytest.main()